@@ -2,12 +2,15 @@
 
 import copy
 import glob
+import hashlib
+import multiprocessing as mp
 import os.path
-from typing import Sequence, Tuple, Union
+from typing import List, Sequence, Tuple, Union
 import pathlib
 import pickle
 import re
 
+import h5py
 import numpy as np
 import pandas as pd
 import scipy.io
@@ -16,7 +19,6 @@ from janelia_core.dataprocessing.dataset import ROIDataset
 from janelia_core.dataprocessing.roi import ROI
 from janelia_core.fileio.data_handlers import NDArrayHandler
 from janelia_core.fileio.exp_reader import find_images
-from janelia_core.math.basic_functions import find_disjoint_intervals
 from janelia_core.math.basic_functions import copy_and_delay
 from janelia_core.utils.searching import dict_find
 
@@ -41,6 +43,9 @@ FULL_ANNOT_BEH_CODES = {'F': ['fw'],
                         'TL': ['left turn'],
                         'TR': ['right turn']}
 
+# Environment variable which can be used to provide a folder to cache parsed full annotations in
+ANNOT_CACHE_DIR_ENV_VAR = 'KELLER_ZLATIC_VNC_ANNOT_CACHE_DIR'
+
 # Dictionary defining A00c segment codes
 A00C_SEG_CODES = {1: 'antL',
                   2: 'antR',
@@ -221,6 +226,201 @@ def calc_dff(f: np.ndarray, b: np.ndarray, background: float, ep: float) -> np.n
     return (f-b)/(b-background+ep)
 
 
+def calc_dff_chunked(f, b, background: float, ep: float, out: np.ndarray = None, chunk_n_time_pts: int = 1000,
+                     chunk_n_rois: int = None) -> np.ndarray:
+    """ Calculates dff in chunks, so that f and b never need to be fully held in memory.
+
+    dff is calculated as in calc_dff, but f and b are read one chunk of time points and rois at a time and results are
+    written directly into out.  Beyond out, the only memory used is for the values of f and b for a single chunk.
+
+    Args:
+
+        f: fluorescence over time, of shape n_time_pts*n_rois.  Can be any object with a shape attribute that supports
+        numpy style slicing along its first two dimensions, such as a numpy array, memory mapped array or h5py dataset.
+
+        b: baseline over time, of same shape as f and supporting the same slicing
+
+        background: background value
+
+        ep: value to add to the denominator to promote stable calculations of dff
+
+        out: Array of the same shape as f to write dff into.  This can be a memory mapped array.  If None, a single
+        precision array will be allocated.
+
+        chunk_n_time_pts: The number of time points in each chunk
+
+        chunk_n_rois: The number of rois in each chunk.  If None, each chunk will contain all rois, which is best when
+        f and b are stored with time along the first dimension without chunking (as are the hdf5 files produced by
+        raw_data_processing).
+
+    Returns:
+
+        out: The calculated dff
+
+    Raises:
+
+        ValueError: If f, b and out are not all the same shape.
+
+    """
+
+    n_time_pts, n_rois = f.shape
+    if tuple(b.shape) != (n_time_pts, n_rois):
+        raise(ValueError('f and b must be the same shape.'))
+
+    if out is None:
+        out = np.empty([n_time_pts, n_rois], dtype=np.float32)
+    elif tuple(out.shape) != (n_time_pts, n_rois):
+        raise(ValueError('out must be the same shape as f.'))
+
+    if chunk_n_rois is None:
+        chunk_n_rois = n_rois
+
+    for t_start in range(0, n_time_pts, chunk_n_time_pts):
+        t_slice = slice(t_start, min(t_start + chunk_n_time_pts, n_time_pts))
+        for r_start in range(0, n_rois, chunk_n_rois):
+            r_slice = slice(r_start, min(r_start + chunk_n_rois, n_rois))
+
+            f_chunk = np.array(f[t_slice, r_slice], dtype=out.dtype)
+            b_chunk = np.array(b[t_slice, r_slice], dtype=out.dtype)
+
+            np.subtract(f_chunk, b_chunk, out=f_chunk)
+            b_chunk -= background
+            b_chunk += ep
+            np.divide(f_chunk, b_chunk, out=out[t_slice, r_slice])
+
+    return out
+
+
+def calc_dff_from_h5(f_file: Union[pathlib.Path, str], b_file: Union[pathlib.Path, str], background: float,
+                     ep: float, out_file: Union[pathlib.Path, str] = None, data_set_name: str = 'data',
+                     chunk_n_time_pts: int = 1000, chunk_n_rois: int = None) -> np.ndarray:
+    """ Calculates dff directly from hdf5 files of fluorescence and baseline values without loading them into memory.
+
+    This is intended for use with the extracted_f.h5 and baseline_f.h5 files produced by
+    raw_data_processing.video_to_roi_baselines.  See calc_dff_chunked for how values are read.
+
+    Args:
+
+        f_file: The hdf5 file with fluorescence values
+
+        b_file: The hdf5 file with baseline values
+
+        background: background value
+
+        ep: value to add to the denominator to promote stable calculations of dff
+
+        out_file: If provided, dff will be written to a single precision memory mapped .npy file at this path and the
+        memory mapped array will be returned.  If None, dff will be returned in a single precision array in memory.
+
+        data_set_name: The name of the data set holding values in f_file and b_file
+
+        chunk_n_time_pts: The number of time points to process at once
+
+        chunk_n_rois: The number of rois to process at once.  If None, all rois will be processed at once.
+
+    Returns:
+
+        dff: The calculated dff
+
+    """
+
+    with h5py.File(f_file, 'r') as f_h5, h5py.File(b_file, 'r') as b_h5:
+        f = f_h5[data_set_name]
+        b = b_h5[data_set_name]
+
+        if out_file is None:
+            out = None
+        else:
+            out = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32, shape=f.shape)
+
+        out = calc_dff_chunked(f=f, b=b, background=background, ep=ep, out=out, chunk_n_time_pts=chunk_n_time_pts,
+                               chunk_n_rois=chunk_n_rois)
+
+    if out_file is not None:
+        out.flush()
+
+    return out
+
+
+def calc_dff_prefix_sums(dff: np.ndarray) -> np.ndarray:
+    """ Calculates cumulative sums of dff over time, for quickly computing mean dff in windows.
+
+    The sum of dff over the time points [start, stop) for all rois is prefix_sums[stop, :] - prefix_sums[start, :], so
+    once prefix sums are calculated for a subject, the mean in any window can be calculated with two row look ups and a
+    subtraction (see calc_window_means).
+
+    Args:
+
+        dff: Matrix of dff values of shape [n_time_pts, n_rois]
+
+    Returns:
+
+        prefix_sums: Matrix of shape [n_time_pts + 1, n_rois].  prefix_sums[t, :] is the sum of dff over the first t time
+        points.  Sums are accumulated in double precision.
+
+    """
+    prefix_sums = np.zeros([dff.shape[0] + 1, dff.shape[1]])
+    np.cumsum(dff, axis=0, dtype=np.float64, out=prefix_sums[1:, :])
+    return prefix_sums
+
+
+def calc_window_means(prefix_sums: np.ndarray, starts: np.ndarray, stops: np.ndarray,
+                      out_of_range: str = 'nan') -> np.ndarray:
+    """ Calculates mean dff for all rois in many windows at once.
+
+    Args:
+
+        prefix_sums: Prefix sums of dff, as returned by calc_dff_prefix_sums
+
+        starts: Array of the start index of each window
+
+        stops: Array of the stop index of each window.  Windows are over the time points [start, stop).
+
+        out_of_range: Specifies how windows which do not fall entirely within the recorded data are handled:
+
+            nan: The mean for any window which starts before the first time point or stops after the last time point
+            is nan.  Otherwise windows are interpreted as python slices (see below).  This matches calc_mean_dff in the
+            spontaneous module.
+
+            slice: Windows are interpreted as python slices, so that the mean for each window is the same as
+            np.mean(dff[start:stop, :], axis=0) (e.g., negative indices are counted from the end of the data, and
+            windows are truncated to the recorded data).
+
+        In both cases, the mean for empty windows is nan.
+
+    Returns:
+
+        mn_vls: Matrix of shape [n_windows, n_rois] with the mean in each window.
+
+    Raises:
+
+        ValueError: If out_of_range is not one of the expected strings.
+
+    """
+    n_tm_pts = prefix_sums.shape[0] - 1
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+
+    if out_of_range == 'nan':
+        bad_windows = (starts < 0) | (stops > n_tm_pts)
+    elif out_of_range == 'slice':
+        bad_windows = np.zeros(len(starts), dtype=bool)
+    else:
+        raise(ValueError('out_of_range must be one of the following strings: nan, slice'))
+
+    starts = _normalize_slice_inds(starts, n_tm_pts)
+    stops = _normalize_slice_inds(stops, n_tm_pts)
+
+    n_window_pts = stops - starts
+    bad_windows = bad_windows | (n_window_pts <= 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mn_vls = (prefix_sums[stops, :] - prefix_sums[starts, :])/n_window_pts[:, np.newaxis]
+    mn_vls[bad_windows, :] = np.nan
+
+    return mn_vls
+
+
 def combine_turns(tbl: pd.DataFrame):
     """ Combines annotations for TL and TR into a single T annotation in a transition table.
 
@@ -239,6 +439,135 @@ def combine_turns(tbl: pd.DataFrame):
     tbl['beh_after'][tbl['beh_after'] == 'TR'] = 'T'
 
 
+def extract_peri_event_dff(dff: np.ndarray, event_tbl: pd.DataFrame, align_col: str, lags: Sequence[int],
+                           ref_offset: int = 0, out_file: Union[pathlib.Path, str] = None,
+                           chunk_n_events: int = 100) -> np.ndarray:
+    """ Extracts DFF for all rois at a range of lags around each event in a table.
+
+    The returned tensor holds the full time course of DFF around each event, so that mean DFF in any window (or DFF at
+    any single lag) can be pulled out of it without returning to the original data.  For example, mean DFF in the
+    window of lags [l_0, l_1) is np.mean(tensor[:, l_0_i:l_1_i, :], axis=1), where l_0_i and l_1_i are the positions of
+    l_0 and l_1 in lags.
+
+    Args:
+
+        dff: Matrix of dff values of shape [n_time_pts, n_rois].  This can be a memory mapped array.
+
+        event_tbl: Table with marked events.  Should have at least one column with a label as given by align_col.
+
+        align_col: The name of the column in event_tbl with the indices into dff which lags are relative to.
+
+        lags: The lags to extract dff at.
+
+        ref_offset: An offset to add to the indices in align_col before applying lags.
+
+        out_file: If provided, the tensor will be saved in a memory mapped .npy file at this path and the memory mapped
+        array will be returned.  This is useful when the tensor is large.  If None, the tensor will be held in memory.
+
+        chunk_n_events: The number of events to extract dff for at once.
+
+    Returns:
+
+        tensor: A single precision array of shape [n_events, n_lags, n_rois].  tensor[e, l, :] is dff at the time
+        point event_tbl[align_col].iloc[e] + ref_offset + lags[l].  Values at time points outside of the recorded data
+        are nan.
+
+    """
+
+    lags = np.asarray(lags, dtype=np.int64)
+    n_time_pts, n_rois = dff.shape
+    n_events = len(event_tbl)
+    n_lags = len(lags)
+
+    if out_file is None:
+        tensor = np.empty([n_events, n_lags, n_rois], dtype=np.float32)
+    else:
+        tensor = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32, shape=(n_events, n_lags, n_rois))
+
+    ref_inds = event_tbl[align_col].to_numpy().astype(np.int64) + ref_offset
+    for e_start in range(0, n_events, chunk_n_events):
+        e_slice = slice(e_start, min(e_start + chunk_n_events, n_events))
+        t_inds = ref_inds[e_slice, np.newaxis] + lags
+        in_range = (t_inds >= 0) & (t_inds < n_time_pts)
+
+        chunk = np.full([t_inds.shape[0], n_lags, n_rois], np.nan, dtype=np.float32)
+        chunk[in_range, :] = dff[t_inds[in_range], :]
+        tensor[e_slice, :, :] = chunk
+
+    if out_file is not None:
+        tensor.flush()
+
+    return tensor
+
+
+def extract_peri_event_dff_for_subjects(dffs: Sequence[Union[np.ndarray, pathlib.Path, str]],
+                                        event_tbls: Sequence[pd.DataFrame], align_col: str, lags: Sequence[int],
+                                        ref_offset: int = 0, out_folder: Union[pathlib.Path, str] = None,
+                                        n_workers: int = None) -> list:
+    """ Extracts peri-event dff tensors for multiple subjects in parallel.
+
+    See extract_peri_event_dff for details of the tensors.
+
+    Args:
+
+        dffs: dffs[i] is the dff for subject i.  This can be either a matrix of shape [n_time_pts, n_rois] or the path
+        to a .npy file holding this matrix (such as the entries of a dff cache - see the dff_cache module).  Passing
+        files avoids sending dff to worker processes, as files will be memory mapped by each worker.
+
+        event_tbls: event_tbls[i] is the table of events for subject i
+
+        align_col: The name of the column in the event tables with the indices which lags are relative to.
+
+        lags: The lags to extract dff at.
+
+        ref_offset: An offset to add to the indices in align_col before applying lags.
+
+        out_folder: If provided, the tensor for subject i will be saved in the memory mapped file
+        peri_event_dff_<i>.npy in this folder.  If None, tensors will be returned in memory.
+
+        n_workers: The number of processes to use.  If None, the number of cpus on the machine will be used.  If 1,
+        subjects will be processed in the calling process.
+
+    Returns:
+
+        tensors: tensors[i] is the tensor for subject i.  If out_folder is provided, these will be read only, memory
+        mapped arrays.
+
+    Raises:
+
+        ValueError: If the number of dffs and event tables are not the same.
+
+    """
+
+    if len(dffs) != len(event_tbls):
+        raise(ValueError('dffs and event_tbls must be the same length.'))
+
+    if out_folder is None:
+        out_files = [None]*len(dffs)
+    else:
+        out_folder = pathlib.Path(out_folder)
+        if not os.path.isdir(out_folder):
+            os.makedirs(out_folder)
+        out_files = [out_folder / ('peri_event_dff_' + str(s_i) + '.npy') for s_i in range(len(dffs))]
+
+    par_input = [(dff, event_tbl, align_col, lags, ref_offset, out_file)
+                 for dff, event_tbl, out_file in zip(dffs, event_tbls, out_files)]
+
+    if n_workers is None:
+        n_workers = mp.cpu_count()
+
+    if n_workers == 1:
+        tensors = [_extract_peri_event_dff_for_subject(*args) for args in par_input]
+    else:
+        with mp.Pool(n_workers) as pool:
+            tensors = pool.starmap(_extract_peri_event_dff_for_subject, par_input)
+
+    if out_folder is not None:
+        tensors = [np.load(out_file, mmap_mode='r') for out_file in out_files]
+
+    return tensors
+
+
 def extract_transitions(raw_trans_table: pd.DataFrame, cutoff_time:float = np.inf) -> Tuple[dict, pd.DataFrame]:
     """ Calculates new behavior transitions, using a cutoff time for behaviors after the stimulus.
 
@@ -774,7 +1103,7 @@ def produce_table_of_extracted_data(act_data: dict, annot_data: dict,
     return full_data_frame
 
 
-def read_full_annotations(file: pathlib.Path) -> pd.DataFrame:
+def read_full_annotations(file: pathlib.Path, cache_dir: Union[pathlib.Path, str] = None) -> pd.DataFrame:
     """ Reads full annotations from a csv file.
 
     The full annotations are those provided by Nadine marking all events for a sample.
@@ -782,9 +1111,15 @@ def read_full_annotations(file: pathlib.Path) -> pd.DataFrame:
     This function will also return these annotations in a new format, matching the convention
     used in the rest of the project.
 
+    Parsed annotations can be cached, so later reads of the same file skip parsing the csv.  Cached annotations are
+    identified by the path, modification time and size of the csv file, so they are reparsed if the file changes.
+
     Args:
         file: The csv file to open
 
+        cache_dir: Folder to cache parsed annotations in.  If None, the folder given by the environment variable
+        ANNOT_CACHE_DIR_ENV_VAR will be used.  If that is not set, annotations are not cached.
+
     Returns:
 
         annots: The annotations.  This is a DataFrame with three columns: Start (marking
@@ -801,6 +1136,14 @@ def read_full_annotations(file: pathlib.Path) -> pd.DataFrame:
     BASIC_BEHS = ['F', 'B', 'S', 'H', 'T', 'O', 'P']
     TURN_BEHS = ['TL', 'TR']
 
+    if cache_dir is None:
+        cache_dir = os.environ.get(ANNOT_CACHE_DIR_ENV_VAR)
+
+    if cache_dir is not None:
+        cache_file = _annot_cache_file(file=file, cache_dir=cache_dir)
+        if os.path.exists(cache_file):
+            return pd.read_pickle(cache_file)
+
     # Read in the original annotations
     annots = pd.read_csv(file, delimiter=';')
 
@@ -810,31 +1153,31 @@ def read_full_annotations(file: pathlib.Path) -> pd.DataFrame:
     col_mapper['END'] = 'end'
     annots.rename(columns=col_mapper, inplace=True)
 
-    # Get the annotated behavior for each event
-    beh_col_dict = dict()
-    for r in annots.index:
-        event_annots = annots.loc[r, BASIC_BEHS].to_numpy()
-
-        match_ind = np.argwhere(np.logical_not(np.isnan(event_annots)))
-        if not match_ind.size == 0:
-            beh = BASIC_BEHS[match_ind[0][0]]
-            if beh == 'T':
-                turn_annots = annots.loc[r, TURN_BEHS].to_numpy()
-                turn_match_ind = np.argwhere(np.logical_not(np.isnan(turn_annots)))
-                if turn_match_ind.size == 0:
-                    raise (RuntimeError('Found a turn without a marked direction.'))
-                beh = TURN_BEHS[turn_match_ind[0][0]]
-            beh_col_dict[r] = beh
-        else:
-            beh_col_dict[r] = np.nan
+    # Get the annotated behavior for each event; this is the first basic behavior marked for the event
+    beh_marked = np.logical_not(np.isnan(annots[BASIC_BEHS].to_numpy(dtype=float)))
+    has_beh = np.any(beh_marked, axis=1)
+    behs = np.asarray(BASIC_BEHS, dtype=object)[np.argmax(beh_marked, axis=1)]
+
+    # For turns, we get the direction of the turn
+    turn_rows = has_beh & (behs == 'T')
+    if np.any(turn_rows):
+        turn_marked = np.logical_not(np.isnan(annots.loc[turn_rows, TURN_BEHS].to_numpy(dtype=float)))
+        if not np.all(np.any(turn_marked, axis=1)):
+            raise (RuntimeError('Found a turn without a marked direction.'))
+        behs[turn_rows] = np.asarray(TURN_BEHS, dtype=object)[np.argmax(turn_marked, axis=1)]
+
+    behs[np.logical_not(has_beh)] = np.nan
 
     # Create a new formatted annotations data frame
     formatted_annots = annots[['start', 'end']].copy()
-    formatted_annots['beh'] = pd.Series(beh_col_dict)
+    formatted_annots['beh'] = pd.Series(behs, index=annots.index)
 
     # Adjust annotations so they are zero-indexed
     formatted_annots[['start', 'end']] = formatted_annots[['start', 'end']] - 1
 
+    if cache_dir is not None:
+        _write_annot_cache_file(annots=formatted_annots, cache_file=cache_file)
+
     return formatted_annots
 
 
@@ -1005,7 +1348,8 @@ def recode_beh(table: pd.DataFrame, col):
 
 
 def single_cell_extract_dff_trace(activity_tbl: pd.DataFrame, event_tbl: pd.DataFrame,
-                                  align_col: str, ref_offset: int, window_l: int) -> pd.DataFrame:
+                                  align_col: str, ref_offset: int, window_l: int, return_dff_matrix: bool = False) \
+        -> Union[pd.DataFrame, Tuple[pd.DataFrame, np.ndarray]]:
     """ Extracts DFF traces for single cells around a given set of events and puts results in a table.
 
     If there are no events for a cell, that cell will be omitted in the produced table.
@@ -1030,41 +1374,50 @@ def single_cell_extract_dff_trace(activity_tbl: pd.DataFrame, event_tbl: pd.Data
         DFF is calculated in windows of a fixed length for each event. These windows start a fixed offset from
         a given event, specified by the align_col above.
 
+        return_dff_matrix: If False, the DFF trace for each cell and event is stored as an array in the 'dff' column of
+        the returned table.  If True, the table will not have a 'dff' column and traces will instead be returned in a
+        separate matrix.
+
     Returns:
 
         full_tbl: A table with the extracted DFF for each cell and event.  Will have the columns: 'subject_id',
-        'cell_id', 'cell_type', 'event_id', 'beh_before', 'beh_after', 'beh' and 'dff'.
+        'cell_id', 'cell_type', 'event_id', 'beh_before', 'beh_after', 'beh' and (if return_dff_matrix is False) 'dff'.
+        Rows are ordered by cell (in the order of activity_tbl) and then by event (in the order of event_tbl).
 
-    Raises:
-
-        ValueError: If window_type is not start_aligned or start_end_aligned
+        dff_matrix: Only returned if return_dff_matrix is True.  A matrix of shape [n_rows, window_l].
+        dff_matrix[i, :] is the DFF trace for the cell and event in row i of full_tbl.  Points of windows which fall
+        outside of the recorded trace for a cell are nan.  (In contrast, when return_dff_matrix is False, windows are
+        interpreted as python slices of each trace.)
 
     """
 
-    full_tbl = pd.DataFrame(columns=['subject_id', 'cell_id', 'cell_type', 'event_id', 'beh_before', 'beh_after',
-                                     'beh', 'dff'])
-
-    # Iterate through cells
-    for _, cell in activity_tbl.iterrows():
-        # Find all events for this cell
-        cell_events = event_tbl[event_tbl['subject_id'] == cell['subject_id']]
-        for _, event in cell_events.iterrows():
-            # Pull out DFF in the requested window
-            start_ind = event[align_col] + ref_offset
-            stop_ind = start_ind + window_l
-            dff = cell['dff'][start_ind:stop_ind]
-
-            # Add dff with annotations to the full table
-            row_dict = {'subject_id': cell['subject_id'],
-                        'cell_type': cell['cell_type'],
-                        'cell_id': cell['cell_id'],
-                        'event_id': event['event_id'],
-                        'beh_before': event['beh_before'],
-                        'beh_after': event['beh_after'],
-                        'beh': event['beh'],
-                        'dff': dff}
-            full_tbl = full_tbl.append(row_dict, ignore_index=True)
-
+    cell_rows, event_rows = _match_cells_to_events(activity_tbl, event_tbl)
+    full_tbl = _single_cell_event_tbl(activity_tbl, event_tbl, cell_rows, event_rows)
+
+    start_inds = event_tbl[align_col].to_numpy().astype(np.int64) + ref_offset
+    pair_start_inds = start_inds[event_rows]
+
+    # Pull out DFF for all events for each group of cells with the same subject and trace length at once
+    dff_matrix = np.full([len(cell_rows), window_l], np.nan)
+    offsets = np.arange(window_l)
+    for traces, pair_cols, g_pairs in _single_cell_trace_groups(activity_tbl, cell_rows):
+        t_inds = pair_start_inds[g_pairs][:, np.newaxis] + offsets
+        in_range = (t_inds >= 0) & (t_inds < traces.shape[0])
+        g_vls = traces[np.clip(t_inds, 0, traces.shape[0] - 1), pair_cols[:, np.newaxis]]
+        g_vls[~in_range] = np.nan
+        dff_matrix[g_pairs, :] = g_vls
+
+    if return_dff_matrix:
+        return full_tbl, dff_matrix
+
+    # Windows which do not fall completely within a trace are pulled out as slices of the trace
+    dffs = list(dff_matrix)
+    trace_lens = np.asarray([len(trace) for trace in activity_tbl['dff']], dtype=np.int64)[cell_rows]
+    for p_i in np.flatnonzero((pair_start_inds < 0) | (pair_start_inds + window_l > trace_lens)):
+        trace = activity_tbl['dff'].iloc[cell_rows[p_i]]
+        dffs[p_i] = trace[pair_start_inds[p_i]:pair_start_inds[p_i] + window_l]
+
+    full_tbl['dff'] = pd.Series(dffs, dtype=object)
     return full_tbl
 
 
@@ -1110,7 +1463,8 @@ def single_cell_extract_dff_with_anotations(activity_tbl: pd.DataFrame, event_tb
     Returns:
 
         full_tbl: A table with the extracted DFF for each cell and event.  Will have the columns: 'subject_id',
-        'cell_id', 'cell_type', 'event_id', 'beh_before', 'beh_after', 'beh' and 'dff'.
+        'cell_id', 'cell_type', 'event_id', 'beh_before', 'beh_after', 'beh' and 'dff'.  Rows are ordered by cell (in
+        the order of activity_tbl) and then by event (in the order of event_tbl).
 
     Raises:
 
@@ -1121,40 +1475,32 @@ def single_cell_extract_dff_with_anotations(activity_tbl: pd.DataFrame, event_tb
     if not (window_type == 'start_aligned' or window_type == 'start_end_aligned'):
         raise(ValueError('window_type must be either start_aligned or start_end_aligned'))
 
-    full_tbl = pd.DataFrame(columns=['subject_id', 'cell_id', 'cell_type', 'event_id', 'beh_before', 'beh_after',
-                                     'beh', 'dff'])
-
-    # Iterate through cells
-    for _, cell in activity_tbl.iterrows():
-        # Find all events for this cell
-        cell_events = event_tbl[event_tbl['subject_id'] == cell['subject_id']]
-        for _, event in cell_events.iterrows():
-            # Calculate DFF in the requested window
-            start_ind = event[align_col] + ref_offset
-            if window_type == 'start_aligned':
-                stop_ind = start_ind + window_l
-            else:
-                stop_ind = event[end_align_col] + end_ref_offset
-            dff = np.mean(cell['dff'][start_ind:stop_ind])
-
-            # Add dff with annotations to the full table
-            row_dict = {'subject_id': cell['subject_id'],
-                        'cell_type': cell['cell_type'],
-                        'cell_id': cell['cell_id'],
-                        'event_id': event['event_id'],
-                        'beh_before': event['beh_before'],
-                        'beh_after': event['beh_after'],
-                        'beh': event['beh'],
-                        'dff': dff}
-            full_tbl = full_tbl.append(row_dict, ignore_index=True)
+    cell_rows, event_rows = _match_cells_to_events(activity_tbl, event_tbl)
+    full_tbl = _single_cell_event_tbl(activity_tbl, event_tbl, cell_rows, event_rows)
 
+    start_inds = event_tbl[align_col].to_numpy().astype(np.int64) + ref_offset
+    if window_type == 'start_aligned':
+        stop_inds = start_inds + window_l
+    else:
+        stop_inds = event_tbl[end_align_col].to_numpy().astype(np.int64) + end_ref_offset
+
+    # Calculate DFF in the requested windows for each group of cells with the same subject and trace length at once
+    dff = np.full(len(cell_rows), np.nan)
+    for traces, pair_cols, g_pairs in _single_cell_trace_groups(activity_tbl, cell_rows):
+        g_events, pair_event_rows = np.unique(event_rows[g_pairs], return_inverse=True)
+        g_means = calc_window_means(calc_dff_prefix_sums(traces), start_inds[g_events], stop_inds[g_events],
+                                    out_of_range='slice')
+        dff[g_pairs] = g_means[pair_event_rows, pair_cols]
+
+    full_tbl['dff'] = dff
     return full_tbl
 
 
 def whole_brain_extract_dff_with_annotations(dff: np.ndarray, event_tbl: pd.DataFrame,
                                              align_col: str, ref_offset: int, window_l: int,
                                              window_type: str = 'start_aligned', end_align_col: str = None,
-                                             end_ref_offset: int = 0) -> pd.DataFrame:
+                                             end_ref_offset: int = 0, return_dff_matrix: bool = True) \
+        -> Union[pd.DataFrame, Tuple[pd.DataFrame, np.ndarray]]:
     """ Extracts DFF for all rois in a data matrix for a given set of events and puts results in a table with annotations.
 
     DFF will be extracted as the mean DFF value in windows for each event. By default, these windows are of a fixed
@@ -1188,10 +1534,18 @@ def whole_brain_extract_dff_with_annotations(dff: np.ndarray, event_tbl: pd.Data
         end_ref_offset: If window_type is 'start_end_aligned' this is the offset to add to the indices in end_align_col
         when positioning the end of the window for calculating DFF.
 
+        return_dff_matrix: If True, DFF for all events is returned in a separate matrix and the table will not have a
+        'dff' column.  This avoids storing an array in each row of the table and is better for large numbers of
+        events and rois.  If False, DFF for each event is instead stored as an array in the 'dff' column of the
+        returned table, as was done in earlier versions of this function.
+
     Returns:
 
         full_tbl: A table with the extracted DFF for and event.  Will have the columns: 'subject_id',
-        'manipulation_tgt', 'event_id', 'beh_before', 'beh_after', 'beh' and 'dff'.
+        'manipulation_tgt', 'event_id', 'beh_before', 'beh_after', 'beh' and (if return_dff_matrix is False) 'dff'.
+
+        dff_matrix: Only returned if return_dff_matrix is True (the default).  A single precision matrix of shape
+        [n_events, n_rois].  dff_matrix[i, :] is the DFF for the event in row i of full_tbl.
 
     Raises:
 
@@ -1202,29 +1556,23 @@ def whole_brain_extract_dff_with_annotations(dff: np.ndarray, event_tbl: pd.Data
     if not (window_type == 'start_aligned' or window_type == 'start_end_aligned'):
         raise(ValueError('window_type must be either start_aligned or start_end_aligned'))
 
-    full_tbl = pd.DataFrame(columns=['subject_id', 'manipulation_tgt', 'event_id', 'beh_before', 'beh_after', 'beh', 'dff'])
+    # Calculate DFF in the requested window for all events at once
+    start_inds = event_tbl[align_col].to_numpy().astype(np.int64) + ref_offset
+    if window_type == 'start_aligned':
+        stop_inds = start_inds + window_l
+    else:
+        stop_inds = event_tbl[end_align_col].to_numpy().astype(np.int64) + end_ref_offset
+    event_dffs = calc_window_means(calc_dff_prefix_sums(dff), start_inds, stop_inds, out_of_range='slice')
 
-    # Iterate through cells
-    for _, event in event_tbl.iterrows():
-        # Calculate DFF in the requested window
-        start_ind = event[align_col] + ref_offset
-        if window_type == 'start_aligned':
-            stop_ind = start_ind + window_l
-        else:
-            stop_ind = event[end_align_col] + end_ref_offset
-        event_dff = np.mean(dff[start_ind:stop_ind, :], axis=0)
-
-        # Add dff with annotations to the full table
-        row_dict = {'subject_id': event['subject_id'],
-                    'manipulation_tgt': event['manipulation_tgt'],
-                    'event_id': event['event_id'],
-                    'beh_before': event['beh_before'],
-                    'beh_after': event['beh_after'],
-                    'beh': event['beh'],
-                    'dff': event_dff}
-        full_tbl = full_tbl.append(row_dict, ignore_index=True)
+    # Form the table of annotations, with one row per event
+    annot_cols = ['subject_id', 'manipulation_tgt', 'event_id', 'beh_before', 'beh_after', 'beh']
+    full_tbl = event_tbl[annot_cols].reset_index(drop=True)
 
-    return full_tbl
+    if return_dff_matrix:
+        return full_tbl, event_dffs.astype(np.float32)
+    else:
+        full_tbl['dff'] = pd.Series(list(event_dffs), dtype=object)
+        return full_tbl
 
 
 def count_transitions(table: pd.DataFrame, behs: Sequence[str] = None,
@@ -1244,19 +1592,11 @@ def count_transitions(table: pd.DataFrame, behs: Sequence[str] = None,
         table: The table with counts for each transition.  Rows are before behavior; columns are after behavior.
     """
 
-    if behs is None:
-        behs = list(set(table[before_str].unique().tolist() + table[after_str].unique().tolist()))
-        behs.sort()
+    behs, trans_codes, n_codes = _transition_codes(table=table, behs=behs, before_str=before_str, after_str=after_str)
 
-    n_behs = len(behs)
-    n_trans = np.zeros([n_behs, n_behs])
-    for b_i, b_b in enumerate(behs):
-        for a_i, a_b in enumerate(behs):
-            trans_rows = np.logical_and((table[before_str] == b_b).to_numpy(),
-                                        (table[after_str] == a_b).to_numpy())
-            n_trans[b_i, a_i] = len(table[trans_rows])
+    n_trans = np.bincount(trans_codes[trans_codes >= 0], minlength=n_codes**2).reshape([n_codes, n_codes]).astype(float)
 
-    return pd.DataFrame(n_trans, index=behs, columns=behs)
+    return _transition_count_tbl(n_trans, behs)
 
 
 def count_unique_subjs_per_transition(table: pd.DataFrame, behs: Sequence[str] = None,
@@ -1277,19 +1617,16 @@ def count_unique_subjs_per_transition(table: pd.DataFrame, behs: Sequence[str] =
         after behavior.
     """
 
-    if behs is None:
-        behs = list(set(table[before_str].unique().tolist() + table[after_str].unique().tolist()))
-        behs.sort()
+    behs, trans_codes, n_codes = _transition_codes(table=table, behs=behs, before_str=before_str, after_str=after_str)
 
-    n_behs = len(behs)
-    n_subjs_per_trans = np.zeros([n_behs, n_behs])
-    for b_i, b_b in enumerate(behs):
-        for a_i, a_b in enumerate(behs):
-            trans_rows = np.logical_and((table[before_str] == b_b).to_numpy(),
-                                        (table[after_str] == a_b).to_numpy())
-            n_subjs_per_trans[b_i, a_i] = len(table[trans_rows][smp_str].unique())
+    # Count each (transition, subject) pair once
+    smp_codes, smps = pd.factorize(table[smp_str], use_na_sentinel=False)
+    keep_rows = trans_codes >= 0
+    smp_trans_codes = np.unique(trans_codes[keep_rows]*len(smps) + smp_codes[keep_rows])
+    n_subjs_per_trans = np.bincount(smp_trans_codes // max(len(smps), 1),
+                                    minlength=n_codes**2).reshape([n_codes, n_codes]).astype(float)
 
-    return pd.DataFrame(n_subjs_per_trans, index=behs, columns=behs)
+    return _transition_count_tbl(n_subjs_per_trans, behs)
 
 
 def down_select_events(tbl_1: pd.DataFrame, tbl_2: pd.DataFrame) -> pd.DataFrame:
@@ -1337,15 +1674,20 @@ def find_clean_events(annotations: pd.DataFrame, clean_def: str = 'dj') -> np.nd
         keep_events: A boolean array which can be used to index annotations to return only the clean events
     """
 
+    if not (clean_def == 'dj' or clean_def == 'po'):
+        raise(ValueError('The clean_def ' + clean_def + ' is not recognized.'))
+
     ints = copy.deepcopy(annotations[['start', 'end']].to_numpy())
     ints[:, 1] = ints[:, 1] + 1  # Account for inclusive end indexing in the original data
 
+    # Both definitions of clean events are determined from the same counts of overlapping events
+    overlap_counts = find_interval_overlap_counts(ints)
+
     if clean_def == 'dj':
-        disjoint_events = find_disjoint_intervals(ints)
-    elif clean_def == 'po':
-        disjoint_events = find_usable_partial_overlap_events(ints)
+        disjoint_events = ((overlap_counts['start'] == 0) & (overlap_counts['stop'] == 0) &
+                           (overlap_counts['contained'] == 0) & (overlap_counts['contained_within'] == 0))
     else:
-        raise(ValueError('The clean_def ' + clean_def + ' is not recognized.'))
+        disjoint_events = find_usable_partial_overlap_events(ints, overlap_counts=overlap_counts)
 
     return disjoint_events
 
@@ -1364,6 +1706,14 @@ def find_before_and_after_events(events: pd.DataFrame, all_events: pd.DataFrame)
     events equally close to the event of interest, than the before or after values returned for the event of
     interest will be nan.
 
+    Each event of interest is matched to its own row in all_events by index, and that row is never returned as its
+    before or after event (even if its start and end in all_events differ from those in events).  Indices of
+    all_events should therefore be unique.
+
+    For historical reasons, if there is exactly one event in all_events other than the event of interest, that event
+    is returned as both the before and after event, even if it does not come before or after the event of interest.
+    If there are no other events, before and after values will be nan.
+
     Args:
 
         events: The events we are interested in finding events before and after.  Should have the columns:
@@ -1382,47 +1732,45 @@ def find_before_and_after_events(events: pd.DataFrame, all_events: pd.DataFrame)
         of behavior.  It will also have corresponding columns for the 'After' event.
     """
 
-    before_after_events_dict = dict()
-
-    all_event_indices = all_events.index.to_numpy()
-
-    events_of_interest_indices = events.index
-    for ind in events_of_interest_indices:
-
-        cur_start = events.loc[ind, 'start']
-        cur_end = events.loc[ind, 'end']
-
-        # Find events before and after this one
-        pull_events = (all_event_indices != ind)
-        pull_indices = all_event_indices[pull_events]
-        pull_start = all_events['start'][pull_indices].to_numpy()
-        pull_end = all_events['end'][pull_indices].to_numpy()
-
-        before_time_diffs = (pull_end - cur_start).astype('float')
-        before_time_diffs[(pull_end - cur_end) >= 0] = -np.inf # Weed out any events which start at the same time as or after the current one ends
-        max_inds = np.argwhere(before_time_diffs == np.max(before_time_diffs)).squeeze(axis=1)
-        if len(max_inds) == 1:
-            before_index = pull_indices[max_inds[0]]
-            row_data = [all_events['beh'][before_index], all_events['start'][before_index],
-                        all_events['end'][before_index]]
-        else:  # This means we had no before event or we had multiple with the same end time
-            row_data = [np.nan, np.nan, np.nan]
-
-        after_time_diffs = (pull_start - cur_end).astype('float')
-        after_time_diffs[(pull_start - cur_start) <= 0] = np.inf # Weed out any events which start at the same time as or before the current one starts
-        min_inds = np.argwhere(after_time_diffs == np.min(after_time_diffs)).squeeze(axis=1)
-        if len(min_inds) == 1:
-            after_index = pull_indices[min_inds[0]]
-            row_data += [all_events['beh'][after_index], all_events['start'][after_index],
-                             all_events['end'][after_index]]
-        else:
-            row_data += [np.nan, np.nan, np.nan]
-
-        before_after_events_dict[ind] = row_data
-
-    before_after_events = pd.DataFrame.from_dict(before_after_events_dict, orient='index',
-                                                 columns=['beh_before', 'beh_before_start', 'beh_before_end',
-                                                          'beh_after', 'beh_after_start', 'beh_after_end'])
+    all_starts = all_events['start'].to_numpy()
+    all_ends = all_events['end'].to_numpy()
+    n_all_events = len(all_events)
+
+    cur_starts = events['start'].to_numpy()
+    cur_ends = events['end'].to_numpy()
+
+    # Each event of interest is excluded from the events searched through for it
+    self_rows = all_events.index.get_indexer(events.index)
+    n_candidates = n_all_events - (self_rows >= 0)
+
+    # When there is exactly one candidate event, it is in row 1 if the event of interest is in row 0 of all_events
+    # (so all_events has two rows) and in row 0 otherwise
+    only_candidate_rows = np.where(self_rows == 0, 1, 0)
+
+    # The before event is the one with the latest end that is strictly before the end of the event of interest, and
+    # the after event is the one with the earliest start that is strictly after the start of the event of interest
+    # (found by negating starts, so the after event is the one with the latest negated start before the negated start)
+    before_rows, before_n_ties = _find_latest_prior_rows(vls=all_ends, ths=cur_ends, exclude_rows=self_rows)
+    after_rows, after_n_ties = _find_latest_prior_rows(vls=-all_starts, ths=-cur_starts, exclude_rows=self_rows)
+
+    before_found = (before_n_ties == 1) | ((before_n_ties == 0) & (n_candidates == 1))
+    before_rows[before_n_ties == 0] = only_candidate_rows[before_n_ties == 0]
+    after_found = (after_n_ties == 1) | ((after_n_ties == 0) & (n_candidates == 1))
+    after_rows[after_n_ties == 0] = only_candidate_rows[after_n_ties == 0]
+
+    col_vls = dict()
+    for col_prefix, rows, found in [('beh_before', before_rows, before_found), ('beh_after', after_rows, after_found)]:
+        beh_vls = np.full(len(events), np.nan, dtype=object)
+        start_vls = np.full(len(events), np.nan)
+        end_vls = np.full(len(events), np.nan)
+        beh_vls[found] = all_events['beh'].to_numpy()[rows[found]]
+        start_vls[found] = all_starts[rows[found]]
+        end_vls[found] = all_ends[rows[found]]
+        col_vls[col_prefix] = beh_vls
+        col_vls[col_prefix + '_start'] = start_vls
+        col_vls[col_prefix + '_end'] = end_vls
+
+    before_after_events = pd.DataFrame(col_vls, index=events.index).infer_objects()
 
     before_after_events = before_after_events.astype({'beh_before_start': pd.Int64Dtype(),
                                                       'beh_before_end': pd.Int64Dtype(),
@@ -1466,19 +1814,52 @@ def find_quiet_periods(annots: pd.DataFrame, q_th: float, q_start_offset: int, q
 
         quiet_tbl: A table of marked quiet events, with the columns 'start', 'end' and 'beh'
 
+    Raises:
+
+        ValueError: If q_th, q_start_offset or q_end_offset are less than 1, or if q_start_offset is greater than
+        q_th - q_end_offset + 1.
+
     """
 
-    if q_th < 1:
-        raise (ValueError('q_th must be greater than or equal to 1'))
+    return find_quiet_periods_for_params(annots=annots, params=[(q_th, q_start_offset, q_end_offset)])[0]
 
-    if q_start_offset < 1:
-        raise(ValueError('q_start_offset must be greater than or equal to 1'))
 
-    if q_end_offset < 1:
-        raise(ValueError('q_end_offset must be greater than or equal to 1'))
+def find_quiet_periods_for_params(annots: pd.DataFrame, params: Sequence[Tuple[float, int, int]]) -> List[pd.DataFrame]:
+    """ Finds quiet periods between marked events for many sets of parameters at once.
+
+    This produces the same results as calling find_quiet_periods for each set of parameters, but the gap between the
+    end of each event and the nearest start of a later ending event is only found once and then reused for all
+    parameters.  Gaps are found by sorting events by their end and taking a running minimum of start times, so this
+    runs in O(n log n) time for n events.
+
+    Args:
+
+        annots: The annotations to search through
 
-    if q_start_offset > (q_th - q_end_offset + 1):
-        raise(ValueError('q_start_offset cannot be greater than q_th - q_end_offset + 1'))
+        params: Each entry is a tuple of the form (q_th, q_start_offset, q_end_offset).  See find_quiet_periods.
+
+    Returns:
+
+        quiet_tbls: quiet_tbls[i] is the table of quiet events for params[i]
+
+    Raises:
+
+        ValueError: If any set of parameters is not valid (see find_quiet_periods).
+
+    """
+
+    for q_th, q_start_offset, q_end_offset in params:
+        if q_th < 1:
+            raise (ValueError('q_th must be greater than or equal to 1'))
+
+        if q_start_offset < 1:
+            raise(ValueError('q_start_offset must be greater than or equal to 1'))
+
+        if q_end_offset < 1:
+            raise(ValueError('q_end_offset must be greater than or equal to 1'))
+
+        if q_start_offset > (q_th - q_end_offset + 1):
+            raise(ValueError('q_start_offset cannot be greater than q_th - q_end_offset + 1'))
 
     # Determine the end of the first event and the start of the last - we only look for quiet periods between these
     # two times
@@ -1488,28 +1869,79 @@ def find_quiet_periods(annots: pd.DataFrame, q_th: float, q_start_offset: int, q
     all_starts = annots['start'].to_numpy()
     all_ends = annots['end'].to_numpy()
 
-    # Look for quiet periods
-    quiet_starts = []
-    quiet_ends = []
-    for end in all_ends:
-        if end > first_end and end < last_start:
+    search_ends = all_ends[(all_ends > first_end) & (all_ends < last_start)]
+
+    # For each end, find the nearest start of the events which end after it.  We sort events by their end, so these
+    # events are always at the end of the sorted list, and take a running minimum of starts from the end of the list.
+    end_order = np.argsort(all_ends, kind='stable')
+    sorted_ends = all_ends[end_order]
+    next_starts = np.minimum.accumulate(all_starts[end_order][::-1])[::-1]
+
+    first_later = np.searchsorted(sorted_ends, search_ends, side='right')
+    has_later = first_later < len(all_ends)
+    search_ends = search_ends[has_later]
+    smallest_deltas = next_starts[first_later[has_later]] - search_ends - 1
+
+    # Form quiet events for each set of parameters
+    quiet_tbls = []
+    for q_th, q_start_offset, q_end_offset in params:
+        is_quiet = smallest_deltas >= q_th
+        quiet_starts = (search_ends[is_quiet] + q_start_offset).tolist()
+        quiet_ends = (search_ends[is_quiet] + smallest_deltas[is_quiet] - q_end_offset + 1).tolist()
+        quiet_tbls.append(pd.DataFrame({'start': quiet_starts, 'end': quiet_ends, 'beh': ['Q'] * len(quiet_starts)}))
+
+    return quiet_tbls
 
-            # Find events which end after this one
-            search_events = all_ends > end
-            search_starts = all_starts[search_events]
 
-            # Now that we know which events we are looking at, find the event that starts nearest to the end
-            # of this one
-            smallest_delta = np.min(search_starts - end) - 1
-            if smallest_delta >= q_th:
-                quiet_starts.append(end + q_start_offset)
-                quiet_ends.append(end + smallest_delta - q_end_offset + 1)
+def find_interval_overlap_counts(ints: np.ndarray) -> dict:
+    """ Counts the ways each interval in a set overlaps with the others.
 
-    # Return table of quiet annotations
-    return pd.DataFrame({'start': quiet_starts, 'end': quiet_ends, 'beh': ['Q'] * len(quiet_starts)})
+    Counts of intervals starting or ending within each interval are found by sorting interval starts and ends once and
+    then searching through them, in O(n log n) time for n intervals.  Counts of contained intervals are found with
+    _count_dominated_points, which takes O(n log^2 n) time, so this is the cost overall.
 
+    Args:
+        ints: The intervals of events. Each row is an interval.  The first column gives the starting index
+        and the second column gives the end index + 1 (so the convention for representing intervals
+        is the same used in slices.)
+
+    Returns:
+        overlap_counts: A dictionary with the following keys.  Each value is an integer array giving, for each
+        interval, the number of *other* intervals:
+
+            start: which start within the interval
+
+            stop: which end within the interval
+
+            contained: which start and end within the interval
+
+            contained_within: which start at or before the interval starts and end at or after it ends
 
-def find_usable_partial_overlap_events(ints: np.ndarray):
+    """
+
+    # Make end indices inclusive
+    starts = np.asarray(ints[:, 0])
+    stops = np.asarray(ints[:, 1]) - 1
+
+    # An interval starts and stops within itself if it is not empty, so we don't count it in these cases
+    not_empty = (starts <= stops).astype(np.int64)
+
+    sorted_starts = np.sort(starts)
+    sorted_stops = np.sort(stops)
+    start_counts = np.maximum(np.searchsorted(sorted_starts, stops, side='right') -
+                              np.searchsorted(sorted_starts, starts, side='left'), 0) - not_empty
+    stop_counts = np.maximum(np.searchsorted(sorted_stops, stops, side='right') -
+                             np.searchsorted(sorted_stops, starts, side='left'), 0) - not_empty
+
+    # Intervals are always contained in and contain themselves, so we don't count them for these
+    contained_counts = _count_dominated_points(starts, stops) - 1
+    contained_within_counts = _count_dominated_points(-starts, -stops) - 1
+
+    return {'start': start_counts, 'stop': stop_counts, 'contained': contained_counts,
+            'contained_within': contained_within_counts}
+
+
+def find_usable_partial_overlap_events(ints: np.ndarray, overlap_counts: dict = None):
     """
     Finds events that are appropriate to use when we allow partial overlap.
 
@@ -1529,55 +1961,19 @@ def find_usable_partial_overlap_events(ints: np.ndarray):
         is the same used in slices.  For example, in interval that covered indices 0, 1 & 2, would have
         a start index of 0 and an end index of 3.)
 
-    Returns:
-        usable_ints: The row indices of events which are usable.
+        overlap_counts: Counts of overlapping intervals, as returned by find_interval_overlap_counts.  If None, these
+        will be calculated.
 
+    Returns:
         good_rows: Boolean array for rows into ints which correspond to usable intervals
 
     """
 
-    def _find_overlapping_ints(query_int, all_other_ints, all_other_rows):
-
-        # Make end indices inclusive
-        start_ind = query_int[0]
-        stop_ind = query_int[1] - 1
-        all_other_ints[:, 1] = all_other_ints[:, 1] - 1
-
-        # Find intervals where the query interval overlaps their start
-        start_overlaps = np.logical_and(all_other_ints[:, 0] >= start_ind,
-                                        all_other_ints[:, 0] <= stop_ind)
-
-        # Find intervals where the query interval overlaps their end
-        stop_overlaps = np.logical_and(all_other_ints[:, 1] >= start_ind,
-                                       all_other_ints[:, 1] <= stop_ind)
-
-        # Find intervals where the query interval contains the start and stop of the other intervals
-        contained_overlaps = np.logical_and(all_other_ints[:, 0] >= start_ind,
-                                            all_other_ints[:, 1] <= stop_ind)
-
-        # Find intervals where the query interval is contained with them
-        contained_within_overlaps = np.logical_and(all_other_ints[:, 0] <= start_ind,
-                                                   all_other_ints[:, 1] >= stop_ind)
-
-        overlap_ints = dict()
-        overlap_ints['start_ints'] = all_other_rows[start_overlaps]
-        overlap_ints['stop_ints'] = all_other_rows[stop_overlaps]
-        overlap_ints['contained_ints'] = all_other_rows[contained_overlaps]
-        overlap_ints['contained_within_ints'] = all_other_rows[contained_within_overlaps]
-
-        return overlap_ints
+    if overlap_counts is None:
+        overlap_counts = find_interval_overlap_counts(ints)
 
-    n_events = ints.shape[0]
-    good_rows = np.zeros(n_events, dtype=np.bool)
-    for e_i in range(n_events):
-        cur_rows = np.delete(np.arange(n_events), e_i)
-        cur_overlapping_events = _find_overlapping_ints(ints[e_i, :], ints[cur_rows, :], cur_rows)
-
-        if (len(cur_overlapping_events['contained_within_ints']) == 0 and
-            len(cur_overlapping_events['contained_ints']) == 0 and
-            len(cur_overlapping_events['stop_ints']) <= 1 and
-            len(cur_overlapping_events['start_ints']) == 0):
-            good_rows[e_i] = True
+    good_rows = ((overlap_counts['contained_within'] == 0) & (overlap_counts['contained'] == 0) &
+                 (overlap_counts['stop'] <= 1) & (overlap_counts['start'] == 0))
 
     return good_rows
 
@@ -1642,4 +2038,345 @@ def get_basic_clean_annotations_from_full(full_annots: pd.DataFrame, clean_def:
     keep_events = np.logical_not(np.logical_or(np.logical_or(stim_events, before_stim_events), after_stim_events))
     basic_clean_annots = basic_clean_annots.loc[keep_events]
 
-    return basic_clean_annots
\ No newline at end of file
+    return basic_clean_annots
+
+
+def read_clean_annotations(file: pathlib.Path, q_th: float, q_start_offset: int, q_end_offset: int,
+                           clean_def: str = 'dj', co_th: int = 3, max_event_length: int = 100, subject_id=None,
+                           cache_dir: Union[pathlib.Path, str] = None) -> pd.DataFrame:
+    """ Reads full annotations from a csv file and produces clean annotations with cut off times applied.
+
+    This runs the standard annotation stage for a single subject:
+        1) Full annotations are read - see the function read_full_annotations
+        2) Quiet periods are found and added to the full annotations - see the function find_quiet_periods
+        3) Basic clean annotations are produced - see the function get_basic_clean_annotations_from_full
+        4) Cut off times are applied - see the function apply_cutoff_times
+
+    The result only depends on the annotation file and the parameters of these steps, so it can be cached and reused
+    across analyses which vary other parameters.  Cached annotations are identified by a hash of the contents of the
+    csv file and the values of all parameters to this function.
+
+    Args:
+        file: The csv file with the full annotations
+
+        q_th: The threshold to use when finding quiet periods. See find_quiet_periods.
+
+        q_start_offset: The start offset to use when finding quiet periods. See find_quiet_periods.
+
+        q_end_offset: The end offset to use when finding quiet periods. See find_quiet_periods.
+
+        clean_def: The definition to use when searching for clean events.  See function find_clean_events
+
+        co_th: The cut off threshold to apply.  See apply_cutoff_times.
+
+        max_event_length: The maximum length (in frames) for any event.  See get_basic_clean_annotations_from_full.
+
+        subject_id: If not None, a 'subject_id' column with this value is added to the annotations.
+
+        cache_dir: Folder to cache annotations in.  If None, the folder given by the environment variable
+        ANNOT_CACHE_DIR_ENV_VAR will be used.  If that is not set, annotations are not cached.
+
+    Returns:
+
+        annots: The clean annotations, as produced by apply_cutoff_times.
+    """
+
+    if cache_dir is None:
+        cache_dir = os.environ.get(ANNOT_CACHE_DIR_ENV_VAR)
+
+    if cache_dir is not None:
+        cache_file = _stage_annot_cache_file(file=file, cache_dir=cache_dir, stage='clean',
+                                             params=[q_th, q_start_offset, q_end_offset, clean_def, co_th,
+                                                     max_event_length, subject_id])
+        if os.path.exists(cache_file):
+            return pd.read_pickle(cache_file)
+
+    annots = read_full_annotations(file, cache_dir=cache_dir)
+    quiet_annots = find_quiet_periods(annots=annots, q_th=q_th, q_start_offset=q_start_offset,
+                                      q_end_offset=q_end_offset)
+    annots = pd.concat([annots, quiet_annots], ignore_index=True)
+    if subject_id is not None:
+        annots['subject_id'] = subject_id
+
+    annots = get_basic_clean_annotations_from_full(annots, clean_def=clean_def, max_event_length=max_event_length)
+    annots = apply_cutoff_times(annots=annots, co_th=co_th)
+
+    if cache_dir is not None:
+        _write_annot_cache_file(annots=annots, cache_file=cache_file)
+
+    return annots
+
+
+def read_stimulus_annotations(file: pathlib.Path, subject_id: str, manipulation_tgt: str,
+                              cache_dir: Union[pathlib.Path, str] = None) -> pd.DataFrame:
+    """ Reads full annotations from a csv file and produces a table of stimulus events for a subject.
+
+    This runs the standard stimulus annotation stage for a single subject in the closed loop experiments:
+        1) Full annotations are read - see the function read_full_annotations
+        2) Stimulus events are pulled out and labeled with the subject, an event id and the manipulation target
+        3) The behaviors before and after each stimulus event are found - see the function
+           find_before_and_after_events
+
+    As with read_clean_annotations, results can be cached and are identified by a hash of the contents of the csv
+    file and the values of all parameters to this function.
+
+    Args:
+        file: The csv file with the full annotations
+
+        subject_id: The id of the subject.  Saved in the 'subject_id' column of the returned table.
+
+        manipulation_tgt: The manipulation target for the subject (e.g., 'A4' or 'A9').  Saved in the
+        'manipulation_tgt' column of the returned table.
+
+        cache_dir: Folder to cache annotations in.  If None, the folder given by the environment variable
+        ANNOT_CACHE_DIR_ENV_VAR will be used.  If that is not set, annotations are not cached.
+
+    Returns:
+
+        stim_annots: A table with one row per stimulus event.  Will have the columns 'subject_id', 'event_id' and
+        'manipulation_tgt', the columns of the full annotations and the columns produced by
+        find_before_and_after_events.
+    """
+
+    if cache_dir is None:
+        cache_dir = os.environ.get(ANNOT_CACHE_DIR_ENV_VAR)
+
+    if cache_dir is not None:
+        cache_file = _stage_annot_cache_file(file=file, cache_dir=cache_dir, stage='stim',
+                                             params=[subject_id, manipulation_tgt])
+        if os.path.exists(cache_file):
+            return pd.read_pickle(cache_file)
+
+    tbl = read_full_annotations(file, cache_dir=cache_dir)
+
+    stim_tbl = copy.deepcopy(tbl[tbl['beh'] == 'S'])
+    stim_tbl.insert(0, 'subject_id', subject_id)
+    stim_tbl.insert(1, 'event_id', range(stim_tbl.shape[0]))
+    stim_tbl.insert(2, 'manipulation_tgt', manipulation_tgt)
+    before_after_tbl = find_before_and_after_events(events=stim_tbl, all_events=tbl)
+    stim_annots = pd.concat([stim_tbl, before_after_tbl], axis=1)
+
+    if cache_dir is not None:
+        _write_annot_cache_file(annots=stim_annots, cache_file=cache_file)
+
+    return stim_annots
+
+
+# Helper functions go here
+
+def _match_cells_to_events(activity_tbl: pd.DataFrame, event_tbl: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """ Pairs each cell with all events for the same subject.
+
+    Returns the positions of the cell and event in activity_tbl and event_tbl for each pair.  Pairs are ordered by cell
+    and then event.
+    """
+    cells = pd.DataFrame({'subject_id': activity_tbl['subject_id'].to_numpy(),
+                          'cell_row': np.arange(len(activity_tbl))})
+    events = pd.DataFrame({'subject_id': event_tbl['subject_id'].to_numpy(),
+                           'event_row': np.arange(len(event_tbl))})
+    pairs = cells.merge(events, on='subject_id', how='inner').sort_values(['cell_row', 'event_row'])
+    return pairs['cell_row'].to_numpy(), pairs['event_row'].to_numpy()
+
+
+def _single_cell_event_tbl(activity_tbl: pd.DataFrame, event_tbl: pd.DataFrame, cell_rows: np.ndarray,
+                           event_rows: np.ndarray) -> pd.DataFrame:
+    """ Forms the table of annotations for pairs of cells and events. """
+    return pd.DataFrame({'subject_id': activity_tbl['subject_id'].to_numpy()[cell_rows],
+                         'cell_id': activity_tbl['cell_id'].to_numpy()[cell_rows],
+                         'cell_type': activity_tbl['cell_type'].to_numpy()[cell_rows],
+                         'event_id': event_tbl['event_id'].to_numpy()[event_rows],
+                         'beh_before': event_tbl['beh_before'].to_numpy()[event_rows],
+                         'beh_after': event_tbl['beh_after'].to_numpy()[event_rows],
+                         'beh': event_tbl['beh'].to_numpy()[event_rows]})
+
+
+def _single_cell_trace_groups(activity_tbl: pd.DataFrame, cell_rows: np.ndarray):
+    """ Groups the traces of cells with the same subject and trace length into matrices.
+
+    Yields a tuple (traces, pair_cols, g_pairs) for each group.  traces is a matrix of shape
+    [n_time_pts, n_group_cells], g_pairs are the indices of the cell-event pairs for cells in the group and pair_cols
+    gives the column of traces for the cell in each of these pairs.
+    """
+    subjs = activity_tbl['subject_id'].to_numpy()
+    trace_lens = np.asarray([len(trace) for trace in activity_tbl['dff']], dtype=np.int64)
+    cell_groups = pd.DataFrame({'subject_id': subjs, 'trace_len': trace_lens}).groupby(['subject_id', 'trace_len'],
+                                                                                      sort=False).indices
+
+    cell_cols = np.zeros(len(activity_tbl), dtype=np.int64)
+    for g_cells in cell_groups.values():
+        g_pairs = np.flatnonzero(np.isin(cell_rows, g_cells))
+        if len(g_pairs) == 0:
+            continue
+        cell_cols[g_cells] = np.arange(len(g_cells))
+        traces = np.stack([np.asarray(activity_tbl['dff'].iloc[c_i]) for c_i in g_cells], axis=1)
+        yield traces, cell_cols[cell_rows[g_pairs]], g_pairs
+
+
+def _transition_codes(table: pd.DataFrame, behs: Sequence[str], before_str: str,
+                      after_str: str) -> Tuple[list, np.ndarray, int]:
+    """ Encodes the transition of each row of a table as a single integer code.
+
+    Returns the list of behaviors (formed from the table if behs is None), the code of each row and the number of unique
+    behaviors, n_codes.  The code of a transition from the i-th to the j-th unique behavior is i*n_codes + j.  Rows
+    with a before or after behavior not in behs are given a code of -1.
+    """
+    if behs is None:
+        behs = list(set(table[before_str].unique().tolist() + table[after_str].unique().tolist()))
+        behs.sort()
+
+    behs = list(behs)
+    codes = pd.Index(list(dict.fromkeys(behs)), dtype=object)
+    n_codes = len(codes)
+
+    before_codes = codes.get_indexer(table[before_str].to_numpy(dtype=object))
+    after_codes = codes.get_indexer(table[after_str].to_numpy(dtype=object))
+    trans_codes = np.where((before_codes >= 0) & (after_codes >= 0), before_codes*n_codes + after_codes, -1)
+
+    return behs, trans_codes, n_codes
+
+
+def _transition_count_tbl(counts: np.ndarray, behs: list) -> pd.DataFrame:
+    """ Forms a labelled table of counts for transitions between behaviors, given counts for unique behaviors. """
+    inds = pd.Index(list(dict.fromkeys(behs)), dtype=object).get_indexer(behs)
+    return pd.DataFrame(counts[np.ix_(inds, inds)], index=behs, columns=behs)
+
+
+def _annot_cache_file(file: Union[pathlib.Path, str], cache_dir: Union[pathlib.Path, str]) -> pathlib.Path:
+    """ Gives the file parsed annotations for a csv file are cached in, creating the cache folder if needed. """
+    file = pathlib.Path(file).resolve()
+    file_stats = os.stat(file)
+    key_str = str(file) + ':' + str(file_stats.st_mtime_ns) + ':' + str(file_stats.st_size)
+    key = hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+    cache_dir = pathlib.Path(cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    return cache_dir / (file.stem + '_' + key + '.pkl')
+
+
+def _stage_annot_cache_file(file: Union[pathlib.Path, str], cache_dir: Union[pathlib.Path, str], stage: str,
+                            params: list) -> pathlib.Path:
+    """ Gives the file the annotations produced by a stage for a csv file and set of parameters are cached in.
+
+    The cache folder is created if needed.
+    """
+    file = pathlib.Path(file)
+    with open(file, 'rb') as f:
+        key = hashlib.sha1(f.read())
+    key.update(repr(params).encode('utf-8'))
+
+    cache_dir = pathlib.Path(cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    return cache_dir / (file.stem + '_' + stage + '_' + key.hexdigest() + '.pkl')
+
+
+def _write_annot_cache_file(annots: pd.DataFrame, cache_file: pathlib.Path):
+    """ Writes annotations to a cache file.
+
+    Annotations are written to a temporary file first, so other processes never see a partially written entry.
+    """
+    tmp_file = cache_file.with_suffix('.' + str(os.getpid()) + '.tmp')
+    annots.to_pickle(tmp_file)
+    os.replace(tmp_file, cache_file)
+
+
+def _find_latest_prior_rows(vls: np.ndarray, ths: np.ndarray,
+                            exclude_rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ For each threshold, finds the row with the largest value strictly less than the threshold.
+
+    Args:
+        vls: The values to search through, of length n_rows.
+
+        ths: The thresholds to search for, of length n_searches.
+
+        exclude_rows: exclude_rows[i] is a row that should be ignored when searching for ths[i], or -1 if no row should
+        be ignored.
+
+    Returns:
+        rows: rows[i] is the row found for ths[i].  If there is more than one row with the largest value, this is one of
+        them.  If there is no row with a value less than ths[i], this is -1.
+
+        n_ties: n_ties[i] is the number of rows (other than the ignored row) with the same value as the row found for
+        ths[i].  This is 0 if no row was found.
+    """
+    order = np.argsort(vls, kind='stable')
+    sorted_vls = vls[order]
+    sorted_pos = np.empty(len(vls), dtype=np.int64)
+    sorted_pos[order] = np.arange(len(vls))
+
+    has_exclude = exclude_rows >= 0
+    exclude_pos = np.full(len(ths), -1, dtype=np.int64)
+    exclude_pos[has_exclude] = sorted_pos[exclude_rows[has_exclude]]
+
+    # The closest row is the last one before the threshold in sorted order, skipping over the ignored row if needed
+    n_prior = np.searchsorted(sorted_vls, ths, side='left')
+    closest_pos = n_prior - 1 - (exclude_pos == n_prior - 1)
+    found = closest_pos >= 0
+
+    closest_vls = sorted_vls[closest_pos[found]]
+    exclude_tied = (exclude_pos[found] >= 0) & (exclude_pos[found] < n_prior[found])
+    exclude_tied[exclude_tied] = vls[exclude_rows[found][exclude_tied]] == closest_vls[exclude_tied]
+
+    rows = np.full(len(ths), -1, dtype=np.int64)
+    rows[found] = order[closest_pos[found]]
+    n_ties = np.zeros(len(ths), dtype=np.int64)
+    n_ties[found] = (np.searchsorted(sorted_vls, closest_vls, side='right') -
+                     np.searchsorted(sorted_vls, closest_vls, side='left') - exclude_tied)
+
+    return rows, n_ties
+
+
+def _count_dominated_points(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """ For each point i, counts the points j (including i itself) with x[j] >= x[i] and y[j] <= y[i].
+
+    This is the number of points with y[j] <= y[i], less the number with x[j] < x[i] and y[j] <= y[i].  The second
+    count is found by splitting the ranks of x into blocks of doubling width.  Any pair of points with x[j] < x[i]
+    fall in the left and right halves of the same block at exactly one width, and for each width the points in left
+    halves can be counted for all points in right halves at once with np.searchsorted.  There are O(log n) widths, and
+    each requires a sort and search over O(n) points, which gives the O(n log^2 n) cost.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    x_ranks = np.unique(x, return_inverse=True)[1].ravel().astype(np.int64)
+    unique_y, y_ranks = np.unique(y, return_inverse=True)
+    y_ranks = y_ranks.ravel().astype(np.int64)
+    n_x_ranks = np.max(x_ranks) + 1 if len(x_ranks) > 0 else 0
+    n_y_ranks = len(unique_y)
+
+    counts = np.searchsorted(np.sort(y), y, side='right').astype(np.int64)
+
+    w = 1
+    while w < n_x_ranks:
+        in_right = (x_ranks // w) % 2 == 1
+        block_offsets = (x_ranks // (2*w))*n_y_ranks
+
+        # Keys order points by block and then by y, so each block's left half points can be searched separately
+        left_keys = np.sort((block_offsets + y_ranks)[~in_right])
+        right_offsets = block_offsets[in_right]
+        counts[in_right] -= (np.searchsorted(left_keys, right_offsets + y_ranks[in_right], side='right') -
+                             np.searchsorted(left_keys, right_offsets, side='left'))
+        w *= 2
+
+    return counts
+
+
+def _extract_peri_event_dff_for_subject(dff, event_tbl, align_col, lags, ref_offset, out_file) -> np.ndarray:
+    """ Extracts the peri-event tensor for one subject, loading dff from file if needed. """
+    if not isinstance(dff, np.ndarray):
+        dff = np.load(dff, mmap_mode='r')
+
+    tensor = extract_peri_event_dff(dff=dff, event_tbl=event_tbl, align_col=align_col, lags=lags,
+                                    ref_offset=ref_offset, out_file=out_file)
+
+    # Tensors saved to file are reopened by the calling process, so we don't send them back
+    return tensor if out_file is None else None
+
+
+def _normalize_slice_inds(inds: np.ndarray, n: int) -> np.ndarray:
+    """ Converts indices to the non-negative, in-range values python slicing would use for a sequence of length n. """
+    inds = np.where(inds < 0, inds + n, inds)
+    return np.clip(inds, 0, n)
@@ -0,0 +1,174 @@
+""" Tools for caching Delta F/F calculated from datasets on disk.
+
+Calculating dff for a subject requires unpickling a full ROIDataset and reading its fluorescence and baseline data in
+full.  Here we store the dff for each subject (in single precision) in a .npy file, so that later runs can memory map
+the dff instead of recalculating it.  Entries are calculated by streaming fluorescence and baseline data from the
+dataset one chunk at a time, so neither they nor the dff are ever held in memory in full.
+
+Cached dff is identified by the dataset file, the fields of timestamp data used for fluorescence and baseline, the
+background and epsilon values used in the dff calculation and the modification times of the dataset file and the other
+files in its folder (which hold the data the dataset refers to).  If any of these change, dff will be recalculated.
+
+The total size of a cache can be capped.  When a new entry is added, the least recently used entries are removed
+until the cache is under its size limit.
+
+The cache folder can be provided directly to load_dff or set with the environment variable given by CACHE_DIR_ENV_VAR.
+If neither is provided, no caching is performed.
+
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import pickle
+from typing import Tuple, Union
+
+import numpy as np
+
+from janelia_core.dataprocessing.dataset import ROIDataset
+
+from keller_zlatic_vnc.data_processing import calc_dff
+from keller_zlatic_vnc.data_processing import calc_dff_chunked
+
+# Environment variable which can be used to provide a cache folder
+CACHE_DIR_ENV_VAR = 'KELLER_ZLATIC_VNC_DFF_CACHE_DIR'
+
+# Default cap on the total size of a cache, in bytes
+DEFAULT_MAX_CACHE_BYTES = 100*(1024**3)
+
+
+def load_dff(dataset_file: Union[Path, str], f_ts_str: str, bl_ts_str: str, background: float, ep: float,
+             cache_dir: Union[Path, str] = None, max_cache_bytes: int = DEFAULT_MAX_CACHE_BYTES) -> np.ndarray:
+    """ Loads a dataset and calculates dff, using a cache on disk if one is available.
+
+    Args:
+
+        dataset_file: The pickle file of the ROIDataset to calculate dff for
+
+        f_ts_str: a string indicating the field of timestamp data in the dataset where we will find the fluorescence
+        data we are to process when forming Delta F/F
+
+        bl_ts_str: a string indicating the field of timestamp data in the dataset where we will find the baseline
+        data we are to process
+
+        background: the background value to use when calculating dff
+
+        ep: the epsilon value to use when calculating dff
+
+        cache_dir: The folder of the cache.  If None, the folder given by the environment variable CACHE_DIR_ENV_VAR
+        will be used.  If that is not set, dff will be calculated without caching.
+
+        max_cache_bytes: The maximum total size of the cache.  Least recently used entries are removed when adding a
+        new entry would put the cache over this size.
+
+    Returns:
+
+        dff: The calculated dff of shape n_time_pts*n_rois.  If a cache is used, this is a read only, memory mapped,
+        single precision array.  If no cache is used, dff is calculated with calc_dff, at the precision of the data in
+        the dataset.
+
+    """
+
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV_VAR)
+
+    if cache_dir is None:
+        return _calc_dataset_dff(dataset_file=dataset_file, f_ts_str=f_ts_str, bl_ts_str=bl_ts_str,
+                                 background=background, ep=ep)
+
+    cache_dir = Path(cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    key_vls = _cache_key_vls(dataset_file=dataset_file, f_ts_str=f_ts_str, bl_ts_str=bl_ts_str,
+                             background=background, ep=ep)
+    key = hashlib.sha1(json.dumps(key_vls, sort_keys=True).encode('utf-8')).hexdigest()
+    entry_file = cache_dir / (key + '.npy')
+
+    if os.path.exists(entry_file):
+        # Mark the entry as recently used
+        os.utime(entry_file)
+        return np.load(entry_file, mmap_mode='r')
+
+    # Write to a temporary file first, so other processes never see a partially written entry.  dff is calculated
+    # directly into the memory mapped file, streaming f and b from the dataset, so we never hold any of them in memory
+    # in full.
+    tmp_file = cache_dir / (key + '.' + str(os.getpid()) + '.tmp.npy')
+    f, b = _load_dataset_f_and_b(dataset_file=dataset_file, f_ts_str=f_ts_str, bl_ts_str=bl_ts_str)
+    dff = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=f.shape)
+    calc_dff_chunked(f=f, b=b, background=background, ep=ep, out=dff)
+    dff.flush()
+    del f, b, dff
+    os.replace(tmp_file, entry_file)
+    with open(cache_dir / (key + '.json'), 'w') as f:
+        json.dump(key_vls, f)
+
+    evict_lru_entries(cache_dir=cache_dir, max_cache_bytes=max_cache_bytes, keep_files=[entry_file])
+
+    return np.load(entry_file, mmap_mode='r')
+
+
+def evict_lru_entries(cache_dir: Union[Path, str], max_cache_bytes: int, keep_files: list = None):
+    """ Removes least recently used entries from a dff cache until it is under a size limit.
+
+    Args:
+
+        cache_dir: The folder of the cache.
+
+        max_cache_bytes: The maximum total size of the cache.
+
+        keep_files: Entries which should not be removed, even if they are the least recently used.
+
+    """
+
+    cache_dir = Path(cache_dir)
+    keep_files = set() if keep_files is None else set([Path(f).name for f in keep_files])
+
+    entries = []
+    for entry_file in cache_dir.glob('*.npy'):
+        if entry_file.name.endswith('.tmp.npy'):
+            continue
+        try:
+            stats = os.stat(entry_file)
+        except OSError:
+            continue
+        entries.append((stats.st_mtime, stats.st_size, entry_file))
+
+    total_bytes = sum([e[1] for e in entries])
+    for _, n_bytes, entry_file in sorted(entries, key=lambda e: e[0]):
+        if total_bytes <= max_cache_bytes:
+            break
+        if entry_file.name in keep_files:
+            continue
+        try:
+            os.remove(entry_file)
+        except OSError:
+            # The entry may be open in another process (e.g., on Windows) or already removed
+            continue
+        total_bytes -= n_bytes
+        meta_file = entry_file.with_suffix('.json')
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+
+
+# Helper functions go here
+
+def _calc_dataset_dff(dataset_file, f_ts_str, bl_ts_str, background, ep) -> np.ndarray:
+    f, b = _load_dataset_f_and_b(dataset_file=dataset_file, f_ts_str=f_ts_str, bl_ts_str=bl_ts_str)
+    return calc_dff(f=f[:], b=b[:], background=background, ep=ep)
+
+
+def _load_dataset_f_and_b(dataset_file, f_ts_str, bl_ts_str) -> Tuple:
+    # Values are returned as stored in the dataset (e.g., as h5py datasets), without reading them into memory
+    with open(dataset_file, 'rb') as f:
+        dataset = ROIDataset.from_dict(pickle.load(f))
+
+    return dataset.ts_data[f_ts_str]['vls'], dataset.ts_data[bl_ts_str]['vls']
+
+
+def _cache_key_vls(dataset_file, f_ts_str, bl_ts_str, background, ep) -> dict:
+    dataset_file = Path(dataset_file).resolve()
+    src_mtimes = {p.name: os.stat(p).st_mtime_ns for p in sorted(dataset_file.parent.iterdir()) if p.is_file()}
+    return {'dataset_file': str(dataset_file), 'f_ts_str': f_ts_str, 'bl_ts_str': bl_ts_str,
+            'background': float(background), 'ep': float(ep), 'src_mtimes': src_mtimes}
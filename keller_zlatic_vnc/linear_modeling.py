@@ -5,16 +5,17 @@
 """
 
 import re
-from typing import Sequence
+from typing import Sequence, Tuple
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+import scipy.sparse
 
 
 def one_hot_from_table(table: pd.DataFrame, beh_before: list, beh_after: list, enc_subjects: bool = False,
                        enc_beh_interactions: bool = False, beh_interactions: list = None,
-                       beh_before_str: str = 'beh_before', beh_after_str: str = 'beh_after'):
+                       beh_before_str: str = 'beh_before', beh_after_str: str = 'beh_after', sparse: bool = False):
     """ Generates one-hot representation of data in tables produced by data_processing.produce_table_of_extracted data.
 
     Args:
@@ -35,6 +36,9 @@ def one_hot_from_table(table: pd.DataFrame, beh_before: list, beh_after: list, e
         beh_before_str: The column name in table that before behaviors are stored under
         beh_after_str: The column name in table that after behaviors are stored under
 
+        sparse: True if encoding should be returned as a scipy.sparse.csr_matrix instead of a numpy array.  This is
+        useful when encoding subjects for large tables, as most entries of the encoding will then be zero.
+
     Returns:
 
         encoding: The one hot encoded variables. Of shame n_smps*n_vars, where n_smps is the number of rows in table
@@ -54,73 +58,50 @@ def one_hot_from_table(table: pd.DataFrame, beh_before: list, beh_after: list, e
 
     n_smps = len(table)
 
-    encoding = np.zeros([n_smps, 0])
+    # We find the rows and columns of all non-zero entries of the encoding, and then scatter ones into them at the end
+    enc_rows = []
+    enc_cols = []
     var_strs = []
 
+    def __add_vars(smp_codes, var_codes, var_names):
+        rows, cols = _one_hot_inds(smp_codes, var_codes)
+        enc_rows.append(rows)
+        enc_cols.append(cols + len(var_strs))
+        var_strs.extend(var_names)
+
     # Process before behaviors
     if beh_before is not None:
-        n_before_beh = len(beh_before)
-        beh_before_enc = np.zeros([n_smps, n_before_beh])
-        for b_i in range(n_before_beh):
-            beh_before_enc[:, b_i][table[beh_before_str] == beh_before[b_i]] = True
-            var_strs.append(beh_before_str + '_' + beh_before[b_i])
-        encoding = np.concatenate([encoding, beh_before_enc], axis=1)
+        smp_codes, var_codes = _beh_codes(table[beh_before_str], beh_before)
+        __add_vars(smp_codes, var_codes, [beh_before_str + '_' + b for b in beh_before])
 
     # Process after behaviors
     if beh_after is not None:
-        n_after_beh = len(beh_after)
-        beh_after_enc = np.zeros([n_smps, n_after_beh])
-        for b_i in range(n_after_beh):
-            beh_after_enc[:, b_i][table[beh_after_str] == beh_after[b_i]] = True
-            var_strs.append(beh_after_str + '_' + beh_after[b_i])
-        encoding = np.concatenate([encoding, beh_after_enc], axis=1)
+        smp_codes, var_codes = _beh_codes(table[beh_after_str], beh_after)
+        __add_vars(smp_codes, var_codes, [beh_after_str + '_' + b for b in beh_after])
 
     # Process all interaction terms if we are suppose to
     if enc_beh_interactions:
-        n_before_beh = len(beh_before)
-        n_after_beh = len(beh_after)
-
-        beh_i_encoding = np.zeros([n_smps, n_before_beh*n_after_beh])
-
-        i_col = 0
-        for bb_i in range(n_before_beh):
-            before_enc = np.zeros(n_smps)
-            before_enc[table[beh_before_str] == beh_before[bb_i]] = True
-
-            for ba_i in range(n_after_beh):
-                after_enc = np.zeros(n_smps)
-                after_enc[table[beh_after_str] == beh_after[ba_i]] = True
-                beh_i_encoding[:, i_col] = before_enc*after_enc
-                var_strs.append('beh_interact_' + beh_before[bb_i] + beh_after[ba_i])
-                i_col+= 1
-
-        encoding = np.concatenate([encoding, beh_i_encoding], axis=1)
+        interactions = [(bb, ba) for bb in beh_before for ba in beh_after]
+        smp_codes, var_codes = _interaction_codes(table[beh_before_str], table[beh_after_str], interactions)
+        __add_vars(smp_codes, var_codes, ['beh_interact_' + bb + ba for bb, ba in interactions])
 
     if beh_interactions is not None:
-        n_interact_terms = len(beh_interactions)
-
-        beh_i_encoding = np.zeros([n_smps, n_interact_terms])
-        for bb_i in range(n_interact_terms):
-            before_enc = np.zeros(n_smps)
-            after_enc = np.zeros(n_smps)
-
-            before_enc[table[beh_before_str] == beh_interactions[bb_i][0]] = True
-            after_enc[table[beh_after_str] == beh_interactions[bb_i][1]] = True
-
-            beh_i_encoding[:, bb_i] = before_enc*after_enc
-            var_strs.append('beh_interact_' + beh_interactions[bb_i][0] + beh_interactions[bb_i][1])
-
-        encoding = np.concatenate([encoding, beh_i_encoding], axis=1)
+        smp_codes, var_codes = _interaction_codes(table[beh_before_str], table[beh_after_str], beh_interactions)
+        __add_vars(smp_codes, var_codes, ['beh_interact_' + bb + ba for bb, ba in beh_interactions])
 
     # Encode subjects
     if enc_subjects:
-        unique_sub_ids = table['subject_id'].unique()
-        n_subjects = len(unique_sub_ids)
-        sub_id_enc = np.zeros([n_smps, n_subjects])
-        for s_i, sub_id in enumerate(unique_sub_ids):
-            sub_id_enc[:, s_i][table['subject_id'] == sub_id] = True
-            var_strs.append('subject_' + sub_id)
-        encoding = np.concatenate([encoding, sub_id_enc], axis=1)
+        smp_codes, unique_sub_ids = pd.factorize(table['subject_id'])
+        __add_vars(smp_codes, np.arange(len(unique_sub_ids)), ['subject_' + sub_id for sub_id in unique_sub_ids])
+
+    enc_rows = np.concatenate(enc_rows) if len(enc_rows) > 0 else np.zeros(0, dtype=int)
+    enc_cols = np.concatenate(enc_cols) if len(enc_cols) > 0 else np.zeros(0, dtype=int)
+    if sparse:
+        encoding = scipy.sparse.csr_matrix((np.ones(len(enc_rows)), (enc_rows, enc_cols)),
+                                           shape=(n_smps, len(var_strs)))
+    else:
+        encoding = np.zeros([n_smps, len(var_strs)])
+        encoding[enc_rows, enc_cols] = 1
 
     return [encoding, var_strs]
 
@@ -158,14 +139,13 @@ def spont_beh_one_hot_encoding(tbl: pd.DataFrame, prev_str: str = None, suc_str:
 
     n_events = tbl.shape[0]
     one_hot = np.zeros([n_events, n_vars])
-    for ev_i in range(n_events):
-        before_beh_i = tbl[prev_str].iloc[ev_i]
-        after_beh_i = tbl[suc_str].iloc[ev_i]
-        before_match = np.argwhere(before_behs == before_beh_i)
-        if len(before_match) > 0:
-            one_hot[ev_i, before_match[0][0]] = 1
-        after_match = np.argwhere(after_behs == after_beh_i)
-        one_hot[ev_i, n_before_behs + after_match[0][0]] = 1
+
+    before_cols = pd.Index(before_behs, dtype=object).get_indexer(tbl[prev_str].to_numpy(dtype=object))
+    before_rows = np.flatnonzero(before_cols >= 0)
+    one_hot[before_rows, before_cols[before_rows]] = 1
+
+    after_cols = pd.Index(after_behs, dtype=object).get_indexer(tbl[suc_str].to_numpy(dtype=object))
+    one_hot[np.arange(n_events), n_before_behs + after_cols] = 1
 
     return one_hot, all_vars
 
@@ -359,3 +339,50 @@ def order_and_color_interaction_terms(terms: Sequence[str], colors: dict = None,
 
     return [order, clrs]
 
+
+# Helper functions go here
+
+def _beh_codes(smp_behs: pd.Series, var_behs: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+    """ Encodes the behaviors of samples and variables with shared integer codes.
+
+    Codes index the unique values of var_behs.  Samples with behaviors not in var_behs are given a code of -1.
+    """
+    codes = pd.Index(list(dict.fromkeys(var_behs)), dtype=object)
+    return codes.get_indexer(smp_behs.to_numpy(dtype=object)), codes.get_indexer(list(var_behs))
+
+
+def _interaction_codes(smp_before: pd.Series, smp_after: pd.Series,
+                       interactions: Sequence[Tuple]) -> Tuple[np.ndarray, np.ndarray]:
+    """ Encodes (before, after) behavior pairs of samples and interaction variables with shared integer codes.
+
+    Samples with a pair of behaviors which is not one of the interactions are given a code of -1.
+    """
+    before_smp_codes, before_var_codes = _beh_codes(smp_before, [bb for bb, _ in interactions])
+    after_smp_codes, after_var_codes = _beh_codes(smp_after, [ba for _, ba in interactions])
+    n_after = max(len(set(after_var_codes)), 1)
+    smp_codes = np.where((before_smp_codes >= 0) & (after_smp_codes >= 0),
+                         before_smp_codes*n_after + after_smp_codes, -1)
+    return smp_codes, before_var_codes*n_after + after_var_codes
+
+
+def _one_hot_inds(smp_codes: np.ndarray, var_codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Finds the non-zero entries of a one-hot encoding.
+
+    Each sample has a one for all variables with the same code as it.  Returns the row (sample) and column (variable)
+    indices of all ones, in no particular order.
+    """
+    var_codes = np.asarray(var_codes, dtype=int)
+    n_codes = int(np.max(var_codes)) + 1 if len(var_codes) > 0 else 0
+
+    # Order variables by code, so all variables for a code are contiguous
+    var_order = np.argsort(var_codes, kind='stable')
+    code_counts = np.bincount(var_codes, minlength=n_codes)
+    code_starts = np.cumsum(code_counts) - code_counts
+
+    smp_codes = np.asarray(smp_codes)
+    smps = np.flatnonzero((smp_codes >= 0) & (smp_codes < n_codes))
+    n_smp_vars = code_counts[smp_codes[smps]]
+    rows = np.repeat(smps, n_smp_vars)
+    var_offsets = np.arange(len(rows)) - np.repeat(np.cumsum(n_smp_vars) - n_smp_vars, n_smp_vars)
+    cols = var_order[np.repeat(code_starts[smp_codes[smps]], n_smp_vars) + var_offsets]
+    return rows, cols
@@ -0,0 +1,475 @@
+""" Tools for computing statistics for all ROIs in the brain at once.
+
+The functions in this module compute the same statistics as the per-ROI functions used elsewhere in the whole_brain
+package, but operate on matrices of data holding values for all ROIs.  Any quantity that is shared between ROIs
+(e.g., the factorization of a design matrix) is computed only once.
+
+"""
+
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import scipy.stats
+
+
+def grouped_linear_regression_ols_batch(x: np.ndarray, y: np.ndarray, g: np.ndarray, alpha: float,
+                                        y_std_th: float = 1E-10, block_size: int = 10000) -> dict:
+    """ Fits linear regression models with grouped errors to many response variables which share a design.
+
+    This computes the same quantities as calling grouped_linear_regression_ols_estimator and then
+    grouped_linear_regression_acm_stats separately for each column of y, but does so by:
+
+        1) Factoring the design matrix x a single time (with a QR decomposition)
+
+        2) Computing coefficients and residuals for all columns of y with matrix products
+
+        3) Computing the per-group score vectors, x_g^T e_g, for all columns of y at once and forming the middle
+        term of the sandwich estimator for the asymptotic covariance matrix from these
+
+    As with _init_fit_multi_subj_stats_f in the spontaneous module, stats are not computed for any column of y with a
+    standard deviation less than or equal to y_std_th.  For these columns, beta, acm, non_zero_p, c_ints and n_grps
+    are set to nan and computed is set to False.
+
+    Args:
+
+        x: The design matrix of shape n_smps*n_vars.  Must be full rank.
+
+        y: The response variables of shape n_smps*n_rois.
+
+        g: Group labels of length n_smps.  g[i] gives the group that sample i belongs to.
+
+        alpha: The significance level to form (1 - alpha) confidence intervals with.
+
+        y_std_th: The threshold on the standard deviation of y values for computing stats (see above).
+
+        block_size: The number of columns of y to process at once.  This bounds the memory used for intermediate
+        calculations.
+
+    Returns:
+
+        stats: A dictionary with the keys:
+
+            beta: Estimated coefficients of shape n_rois*n_vars
+
+            acm: Estimated asymptotic covariance matrices of shape n_rois*n_vars*n_vars
+
+            non_zero_p: p-values testing that each coefficient is non-zero, of shape n_rois*n_vars
+
+            c_ints: Confidence intervals for each coefficient, of shape n_rois*2*n_vars.  c_ints[:, 0, :] and
+            c_ints[:, 1, :] are the lower and upper bounds of the intervals.
+
+            n_grps: The number of groups used for the stats for each roi, of shape n_rois
+
+            computed: Boolean array of shape n_rois indicating which rois stats were computed for
+
+    """
+
+    if y.ndim == 1:
+        y = y[:, np.newaxis]
+
+    n_smps, n_vars = x.shape
+    n_rois = y.shape[1]
+
+    # Factor the design matrix once; (x^T x)^-1 = r^-1 r^-T
+    q, r = np.linalg.qr(x)
+    r_inv = np.linalg.inv(r)
+    x_t_x_inv = np.matmul(r_inv, r_inv.T)
+    proj = np.matmul(r_inv, q.T)  # Maps y to beta
+
+    # Determine group membership once
+    grps, grp_inds = np.unique(g, return_inverse=True)
+    n_grps = len(grps)
+    grp_rows = [np.flatnonzero(grp_inds == g_i) for g_i in range(n_grps)]
+    grp_x_t = [x[rows, :].T for rows in grp_rows]
+
+    # Allocate outputs
+    beta = np.full([n_rois, n_vars], np.nan)
+    acm = np.full([n_rois, n_vars, n_vars], np.nan)
+    non_zero_p = np.full([n_rois, n_vars], np.nan)
+    c_ints = np.full([n_rois, 2, n_vars], np.nan)
+    computed = np.std(y, axis=0) > y_std_th
+    roi_n_grps = np.where(computed, n_grps, np.nan)
+
+    compute_inds = np.flatnonzero(computed)
+    for b_start in range(0, len(compute_inds), block_size):
+        b_inds = compute_inds[b_start:b_start + block_size]
+        y_b = y[:, b_inds]
+
+        beta_b = np.matmul(proj, y_b)
+        resid_b = y_b - np.matmul(x, beta_b)
+
+        # Scores for each group of shape n_grps*n_vars*n_block_rois
+        scores = np.stack([np.matmul(x_t, resid_b[rows, :]) for x_t, rows in zip(grp_x_t, grp_rows)])
+        middle = np.einsum('gvr,gwr->rvw', scores, scores)
+        acm_b = np.matmul(np.matmul(x_t_x_inv, middle), x_t_x_inv)
+
+        beta[b_inds, :] = beta_b.T
+        acm[b_inds, :, :] = acm_b
+        acm_diag_b = np.diagonal(acm_b, axis1=1, axis2=2)
+        non_zero_p[b_inds, :] = _non_zero_p_vls(beta=beta_b.T, acm_diag=acm_diag_b, n_grps=n_grps)
+        c_ints[b_inds, :, :] = _c_ints(beta=beta_b.T, acm_diag=acm_diag_b, n_grps=n_grps, alpha=alpha)
+
+    return {'beta': beta, 'acm': acm, 'non_zero_p': non_zero_p, 'c_ints': c_ints, 'n_grps': roi_n_grps,
+            'computed': computed}
+
+
+def grouped_linear_regression_ols_batch_out_specs(n_rois: int, n_vars: int) -> dict:
+    """ Gives output specifications for holding the stats of grouped_linear_regression_ols_batch for many ROIs.
+
+    Args:
+
+        n_rois: The number of ROIs stats will be computed for.
+
+        n_vars: The number of variables in the design matrix.
+
+    Returns:
+
+        out_specs: A dictionary with the same keys as the stats returned by grouped_linear_regression_ols_batch, in
+        the format expected by parallel.run_roi_blocks.
+
+    """
+    return {'beta': ((n_rois, n_vars), np.float64, np.nan),
+            'acm': ((n_rois, n_vars, n_vars), np.float64, np.nan),
+            'non_zero_p': ((n_rois, n_vars), np.float64, np.nan),
+            'c_ints': ((n_rois, 2, n_vars), np.float64, np.nan),
+            'n_grps': ((n_rois,), np.float64, np.nan),
+            'computed': ((n_rois,), np.bool_, False)}
+
+
+def test_for_diff_than_mean_vls_batch(beta: np.ndarray, acm: np.ndarray, n_grps: np.ndarray, computed: np.ndarray,
+                                      var_names: Sequence[str], mn_th: float = 1e-10,
+                                      beh_groups: list = None) -> dict:
+    """ Batched version of test_for_diff_than_mean_vls, which computes post-hoc statistics for all ROIs at once.
+
+    This produces the same results as calling test_for_diff_than_mean_vls for each ROI.  The contrast matrices
+    comparing each coefficient in a group to the mean of the other coefficients in the group are formed only once,
+    and Wald statistics for every contrast and ROI are computed with einsum operations over the stacked beta and acm
+    arrays.
+
+    The same rules as in test_for_diff_than_mean_vls are applied to decide which stats to compute:
+
+        1) No stats are computed for an ROI if its coefficients are all within mn_th of their mean and the initial
+        fit for the ROI was not computed.  (This is the condition test_for_diff_than_mean_vls applies, given
+        the precedence of the operators it uses.)
+
+        2) p-values for groups with only one coefficient are set to 1, and beta is left as nan.
+
+        3) p-values for groups with an asymptotic covariance matrix with an all 0 diagonal are set to 1, and beta is
+        left as nan.
+
+    Args:
+
+        beta: Coefficients for all ROIs of shape n_rois*n_vars.
+
+        acm: Asymptotic covariance matrices for all ROIs of shape n_rois*n_vars*n_vars.
+
+        n_grps: The number of groups used in the initial fit for each ROI, of shape n_rois.
+
+        computed: Boolean array of shape n_rois indicating if the initial fit for each ROI was computed.
+
+        var_names: list of variable names we compare, as saved by fit_initial_models
+
+        mn_th: The threshold to apply when determining if coefficients for different behaviors are different enough
+        to justify performing further statistics (see test_for_diff_than_mean_vls)
+
+        beh_groups: Strings prepended to variable names, denoting groups.  If None, ['before', 'after'] will be used.
+
+    Returns:
+
+        new_stats: Dictionary with the keys 'beta', 'eq_mean_p' and 'computed', each holding an array of shape
+        n_rois*n_vars, with the values test_for_diff_than_mean_vls would return for each ROI.
+
+    """
+
+    if beh_groups is None:
+        beh_groups = ['before', 'after']
+
+    n_rois, n_vars = beta.shape
+    computed = np.asarray(computed).astype(bool)
+
+    new_beta = np.full([n_rois, n_vars], np.nan)
+    p_vls = np.full([n_rois, n_vars], np.nan)
+    new_computed = np.zeros([n_rois, n_vars])
+
+    with np.errstate(invalid='ignore'):
+        all_close = np.all(np.abs(beta - np.mean(beta, axis=1, keepdims=True)) < mn_th, axis=1)
+    process_rois = all_close | computed
+
+    for grp_b in beh_groups:
+        grp_cols = np.flatnonzero([b[0:b.rfind('_')] == grp_b for b in var_names])
+        n_grp_coefs = len(grp_cols)
+        if n_grp_coefs == 0:
+            continue
+
+        p_vls[np.ix_(process_rois, grp_cols)] = 1
+        if n_grp_coefs == 1:
+            continue
+
+        grp_beta = beta[:, grp_cols]
+        grp_acm = acm[:, grp_cols, :][:, :, grp_cols]
+        test_rois = process_rois & ~np.all(np.diagonal(grp_acm, axis1=1, axis2=2) == 0, axis=1)
+
+        # Row i of contrasts compares coefficient i to the mean of the other coefficients in the group
+        contrasts = np.ones([n_grp_coefs, n_grp_coefs])/(n_grp_coefs - 1)
+        np.fill_diagonal(contrasts, -1)
+
+        grp_beta = grp_beta[test_rois]
+        grp_acm = grp_acm[test_rois]
+        contrast_vls = np.matmul(grp_beta, contrasts.T)
+        contrast_vars = np.einsum('iv,rvw,iw->ri', contrasts, grp_acm, contrasts)
+        grp_p_vls = _restriction_p_vls(contrast_vls=contrast_vls, contrast_vars=contrast_vars,
+                                       n_grps=n_grps[test_rois][:, np.newaxis])
+
+        test_inds = np.flatnonzero(test_rois)
+        p_vls[np.ix_(test_inds, grp_cols)] = grp_p_vls
+        new_beta[np.ix_(test_inds, grp_cols)] = (grp_beta - (np.sum(grp_beta, axis=1, keepdims=True) - grp_beta)
+                                                 / (n_grp_coefs - 1))
+        new_computed[np.ix_(test_inds, grp_cols)] = 1
+
+    return {'beta': new_beta, 'eq_mean_p': p_vls, 'computed': new_computed}
+
+
+def grouped_sign_flips(n_perms: int, n_grps: int, seed: int = None) -> np.ndarray:
+    """ Generates random sign flips for groups of samples, for use in grouped permutation tests.
+
+    Args:
+
+        n_perms: The number of permutations to generate sign flips for.
+
+        n_grps: The number of groups.
+
+        seed: Seed for the random number generator.  Providing the same seed will produce the same sign flips.
+
+    Returns:
+
+        flips: Array of shape n_perms*n_grps.  flips[p, g] is 1 or -1 indicating if the sign of values in group g is
+        flipped in permutation p.
+
+    """
+    rng = np.random.default_rng(seed)
+    return 1.0 - 2.0*rng.integers(0, 2, size=[n_perms, n_grps])
+
+
+def paired_grouped_perm_test_batch(x0: np.ndarray, x1: np.ndarray, grp_ids: np.ndarray, n_perms: int = 1000,
+                                   seed: int = None, perm_block_size: int = 100,
+                                   record_max_stats: bool = False, seq_alpha: float = None) -> dict:
+    """ Performs paired, grouped sign-flip permutation tests for many variables at once.
+
+    For each variable (column of x0 and x1), we test the null hypothesis that the mean of the paired differences,
+    x1 - x0, is zero.  Samples are grouped (e.g., by subject), and under the null distribution the signs of the
+    differences for all samples in a group are flipped together.
+
+    A single set of sign flips (see grouped_sign_flips) is shared by all variables.  Because the permuted statistic
+    for each variable is a sum of per-group sums of differences, weighted by the sign flips, the permuted statistics
+    for all variables are computed with a matrix product between the sign flips and the per-group sums.  This is done
+    for blocks of permutations at a time, so memory use is on the order of perm_block_size*n_vars.
+
+    Optionally, the maximum statistic across all variables can be recorded for each permutation, in the same pass
+    used to compute the uncorrected p-values, and used to compute p-values adjusted for the family-wise error rate
+    with the single-step max-statistic procedure of Westfall & Young (see westfall_young_p_vls).  Because
+    variables may have very different variances, the maximum is taken over standardized statistics: for each
+    variable the sum of differences is divided by its standard deviation under the sign-flip null distribution,
+    sqrt(sum_g d_g^2), where d_g is the sum of differences in group g.  This scaling is constant across permutations
+    for each variable, so it does not change the uncorrected p-values.  Variables with all zero differences are
+    given standardized statistics of 0, and variables with nan values are ignored when taking the maximum.
+
+    Also optionally, permutations can be stopped early for each variable with the sequential procedure of Besag &
+    Clifford.  Permutations for a variable are stopped once the number of permutations with statistics at least as
+    large as the observed statistic reaches h = floor(seq_alpha*n_perms) + 1, as at that point the p-value computed
+    with all n_perms permutations could not be less than or equal to seq_alpha.  The p-value for a stopped variable is
+    then h/l, where l is the number of permutations it used.  Variables which are not stopped early use all
+    permutations, and their p-values are computed as usual.  After each block of permutations, stopped variables are
+    removed from further computation, so smaller values of perm_block_size allow more work to be skipped.
+
+    Args:
+
+        x0: Base values of shape n_smps*n_vars.
+
+        x1: Paired values of shape n_smps*n_vars to compare to the base values.
+
+        grp_ids: Group labels of length n_smps.  grp_ids[i] gives the group that sample i belongs to.
+
+        n_perms: The number of permutations to perform.
+
+        seed: Seed for the random number generator generating sign flips.
+
+        perm_block_size: The number of permutations to compute statistics for at once.
+
+        record_max_stats: True if the maximum standardized statistic across variables should be recorded for each
+        permutation and FWER adjusted p-values computed.
+
+        seq_alpha: If not None, the significance level used to stop permutations early (see above).  Cannot be used
+        with record_max_stats, as recording the max statistic requires all permutations for all variables.
+
+    Returns:
+
+        stats: A dictionary with the keys:
+
+            beta: The mean difference, x1 - x0, for each variable, of shape n_vars.
+
+            p: Two-sided p-values for each variable, of shape n_vars.  This is the fraction of permutations with a
+            mean difference at least as large in magnitude as beta.  p-values are nan for variables with nan values.
+
+            max_stats: Only included if record_max_stats is True.  The maximum absolute standardized statistic across
+            variables for each permutation, of shape n_perms.
+
+            p_fwer: Only included if record_max_stats is True.  FWER adjusted p-values for each variable, of shape
+            n_vars.
+
+            n_perms_used: Only included if seq_alpha is not None.  The number of permutations used for each variable,
+            of shape n_vars.
+
+    Raises:
+
+        ValueError: If record_max_stats is True and seq_alpha is not None.
+
+    """
+
+    if record_max_stats and (seq_alpha is not None):
+        raise(ValueError('record_max_stats cannot be used with seq_alpha'))
+
+    if x0.ndim == 1:
+        x0 = x0[:, np.newaxis]
+        x1 = x1[:, np.newaxis]
+
+    n_smps = x0.shape[0]
+
+    # Form per-group sums of differences, of shape n_grps*n_vars
+    grps, grp_inds = np.unique(grp_ids, return_inverse=True)
+    grp_sums = np.stack([np.sum(x1[grp_inds == g_i, :] - x0[grp_inds == g_i, :], axis=0)
+                         for g_i in range(len(grps))])
+
+    beta = np.sum(grp_sums, axis=0)/n_smps
+    # Allow for round off, so the permutation that flips no signs always counts as being as large as beta
+    abs_beta_th = np.abs(beta)*(1 - 1E-10)
+
+    if record_max_stats:
+        null_std = np.sqrt(np.sum(grp_sums**2, axis=0))
+        std_scales = np.zeros(len(beta))
+        std_scales[null_std > 0] = n_smps/null_std[null_std > 0]
+        max_stats = np.zeros(n_perms)
+
+    flips = grouped_sign_flips(n_perms=n_perms, n_grps=len(grps), seed=seed)
+    n_exceed = np.zeros(len(beta))
+
+    if seq_alpha is None:
+        for b_start in range(0, n_perms, perm_block_size):
+            perm_vls = np.abs(np.matmul(flips[b_start:b_start + perm_block_size, :], grp_sums)/n_smps)
+            n_exceed += np.sum(perm_vls >= abs_beta_th, axis=0)
+            if record_max_stats:
+                max_stats[b_start:b_start + perm_block_size] = np.fmax.reduce(perm_vls*std_scales, axis=1)
+        n_perms_used = n_perms
+    else:
+        n_stop_exceed = np.floor(seq_alpha*n_perms) + 1
+        n_perms_used = np.full(len(beta), n_perms)
+        active = np.arange(len(beta))
+        for b_start in range(0, n_perms, perm_block_size):
+            if len(active) == 0:
+                break
+            perm_vls = np.abs(np.matmul(flips[b_start:b_start + perm_block_size, :], grp_sums[:, active])/n_smps)
+            cum_exceed = n_exceed[active] + np.cumsum(perm_vls >= abs_beta_th[active], axis=0)
+            stopped = cum_exceed[-1] >= n_stop_exceed
+            stop_inds = np.argmax(cum_exceed[:, stopped] >= n_stop_exceed, axis=0)
+            n_perms_used[active[stopped]] = b_start + stop_inds + 1
+            n_exceed[active] = np.minimum(cum_exceed[-1], n_stop_exceed)
+            active = active[~stopped]
+
+    p_vls = n_exceed/n_perms_used
+    p_vls[np.isnan(beta)] = np.nan
+
+    stats = {'beta': beta, 'p': p_vls}
+    if seq_alpha is not None:
+        stats['n_perms_used'] = n_perms_used
+    if record_max_stats:
+        stats['max_stats'] = max_stats
+        stats['p_fwer'] = westfall_young_p_vls(stats=np.abs(beta)*std_scales, max_stats=max_stats)
+
+    return stats
+
+
+def westfall_young_p_vls(stats: np.ndarray, max_stats: np.ndarray) -> np.ndarray:
+    """ Computes single-step max-statistic (Westfall & Young) FWER adjusted p-values.
+
+    The adjusted p-value for a variable is the fraction of permutations in which the maximum statistic across all
+    variables was at least as large as the observed statistic for that variable.
+
+    Args:
+
+        stats: The observed statistics for each variable, of shape n_vars.  Larger values should indicate stronger
+        evidence against the null hypothesis (e.g., absolute values for two-sided tests).
+
+        max_stats: The maximum statistic across all variables for each permutation, of shape n_perms.
+
+    Returns:
+
+        p_vls: The adjusted p-values, of shape n_vars.  p-values are nan for variables with nan statistics.  Since
+        permutations are sampled at random, no permutation may have a max statistic as large as the statistic for a
+        variable, so p-values are floored at 1/n_perms.
+
+    """
+    sorted_max_stats = np.sort(max_stats)
+    # Allow for round off, so the permutation that flips no signs always counts as being as large as the statistic
+    n_less = np.searchsorted(sorted_max_stats, stats*(1 - 1E-10), side='left')
+    p_vls = np.maximum(len(max_stats) - n_less, 1)/len(max_stats)
+    p_vls[np.isnan(stats)] = np.nan
+    return p_vls
+
+
+def unpack_batch_stats(stats: dict) -> List[dict]:
+    """ Converts stats for all ROIs, as returned by the batch functions in this module, to a list of per-ROI dicts.
+
+    This allows results of batched computations to be saved in the same format as results computed one ROI at a time.
+    When there is a single computed value per ROI, the per-ROI dictionaries also match the types of the per-ROI
+    fitting functions: computed is a bool, n_grps is an int (or nan if stats were not computed) and c_ints is only
+    included for ROIs that stats were computed for.
+
+    Args:
+
+        stats: A dictionary of stats.  Each value should be an array with a first dimension equal to the number of
+        rois.
+
+    Returns:
+
+        roi_stats: roi_stats[i] is a dictionary with the same keys as stats, holding the values for roi i.
+
+    """
+    n_rois = len(stats['computed'])
+    roi_stats = [{k: (vl[r_i].copy() if isinstance(vl[r_i], np.ndarray) else vl[r_i]) for k, vl in stats.items()}
+                 for r_i in range(n_rois)]
+
+    if np.ndim(stats['computed']) == 1:
+        for s in roi_stats:
+            s['computed'] = bool(s['computed'])
+            if 'n_grps' in s:
+                s['n_grps'] = int(s['n_grps']) if s['computed'] else np.nan
+            if not s['computed']:
+                s.pop('c_ints', None)
+
+    return roi_stats
+
+
+# Helper functions go here
+
+def _non_zero_p_vls(beta: np.ndarray, acm_diag: np.ndarray, n_grps: int) -> np.ndarray:
+    """ Computes two-sided p-values that coefficients are non-zero using a t-distribution with n_grps - 1 dof. """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_vls = beta/np.sqrt(acm_diag)
+    return 2*scipy.stats.t.cdf(-1*np.abs(t_vls), df=n_grps - 1)
+
+
+def _c_ints(beta: np.ndarray, acm_diag: np.ndarray, n_grps: int, alpha: float) -> np.ndarray:
+    """ Computes (1 - alpha) confidence intervals for coefficients using a t-distribution with n_grps - 1 dof.
+
+    Returns an array of shape n_rois*2*n_vars, with lower bounds in [:, 0, :] and upper bounds in [:, 1, :].
+    """
+    half_widths = scipy.stats.t.ppf(1 - alpha/2, df=n_grps - 1)*np.sqrt(acm_diag)
+    return np.stack([beta - half_widths, beta + half_widths], axis=1)
+
+
+def _restriction_p_vls(contrast_vls: np.ndarray, contrast_vars: np.ndarray, n_grps: np.ndarray) -> np.ndarray:
+    """ Computes p-values of Wald tests of single linear restrictions, r^T beta = 0.
+
+    For a single restriction, the Wald F statistic with (1, n_grps - 1) dof is the square of a t statistic with
+    n_grps - 1 dof, so we compute two-sided t-test p-values.
+    """
+    return _non_zero_p_vls(beta=contrast_vls, acm_diag=contrast_vars, n_grps=n_grps)
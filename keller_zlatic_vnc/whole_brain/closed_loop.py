@@ -1,7 +1,6 @@
 """Tools for fitting models to whole brain data."""
 
 import itertools
-import multiprocessing as mp
 from pathlib import Path
 import pickle
 
@@ -12,16 +11,18 @@ from keller_zlatic_vnc.data_processing import count_transitions
 from keller_zlatic_vnc.data_processing import count_unique_subjs_per_transition
 from keller_zlatic_vnc.linear_modeling import one_hot_from_table
 from keller_zlatic_vnc.whole_brain import spontaneous
+from keller_zlatic_vnc.whole_brain.results_store import save_results
 
 
-def fit_init_models(ps: dict):
+def fit_init_models(ps: dict, n_workers: int = None, block_size: int = 1000, results_format: str = 'pickle'):
     """ A function for fitting initial models to whole-brain closed loop activity.
 
     This function will:
 
         1) Load preprocessed data, produced by the notebook dff_extraction.  This notebook takes care of annotating
         quiet events preceding or following each stimulus and extracting DFF for each stimulus event for all ROIs in
-        the brain.
+        the brain.  DFF is read from the 'subject_event_dff' matrix when present, and otherwise from the 'dff' column
+        of the event table, as saved by earlier versions of the notebook.
 
         2) Down-select event based on manipulation target.
 
@@ -47,6 +48,14 @@ def fit_init_models(ps: dict):
             min_n_succ_subjs - Minimum number of subjects we must see a succeeding behavior in to include in the analysis
             ref_beh - The reference behavior for modeling.
             ind_alpha - The significance level we reject individual null hypotheses at at
+
+        n_workers: The number of worker processes to fit models with.  If None, the number of cpus on the machine
+        will be used.
+
+        block_size: The number of rois each worker fits models for at a time.
+
+        results_format: The format to save results in.  Either 'pickle' or 'columnar' (see the results_store
+        module).
     """
 
     # ==================================================================================================================
@@ -54,6 +63,10 @@ def fit_init_models(ps: dict):
     with open(ps['processed_data_file'], 'rb') as f:
         processed_data = pickle.load(f)
         subject_event_data = processed_data['subject_event_data']
+        subject_event_dff = processed_data.get('subject_event_dff', None)
+
+    # Index rows by position, so we can pull out DFF for the events we keep below
+    subject_event_data = subject_event_data.reset_index(drop=True)
 
     # Down select events based on manipulation target
     if ps['manipulation_tgt'] is not None:
@@ -127,17 +140,14 @@ def fit_init_models(ps: dict):
 
     # ==================================================================================================================
     # Fit models to each ROI and perform statistics
-    dff = np.stack(subject_event_data['dff'].to_numpy())
-
-    n_rois = dff.shape[1]
-    n_cpu = mp.cpu_count()
-    with mp.Pool(n_cpu) as pool:
-        full_stats = pool.starmap(spontaneous._init_fit_multi_subj_stats_f, [(one_hot_data_ref,
-                                                                              dff[:, r_i],
-                                                                              g,
-                                                                              ps['ind_alpha'])
-                                                                             for r_i in range(n_rois)]
-                                  )
+    if subject_event_dff is not None:
+        dff = subject_event_dff[subject_event_data.index.to_numpy(), :]
+    else:
+        dff = np.stack(subject_event_data['dff'].to_numpy())
+
+    full_stats = spontaneous._fit_all_rois(x=one_hot_data_ref, dff=dff, g=g, alpha=ps['ind_alpha'], multi_subj=True,
+                                           n_workers=n_workers, block_size=block_size)
+
     # Here we do multiple comparisons corrections
     p_vls = np.stack([s['non_zero_p'] for s in full_stats])
     computed_p_vls = np.stack([s['computed'] for s in full_stats])
@@ -164,6 +174,4 @@ def fit_init_models(ps: dict):
           'n_subjs_per_trans': analyzed_n_subjs_per_trans, 'n_trans': analyzed_n_trans,
           'mean_trans_vls': mean_trans_vls}
 
-    save_path = Path(ps['save_folder']) / ps['save_name']
-    with open(save_path, 'wb') as f:
-        pickle.dump(rs, f)
+    save_results(rs=rs, save_path=Path(ps['save_folder']) / ps['save_name'], results_format=results_format)
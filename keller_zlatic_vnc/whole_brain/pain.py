@@ -11,19 +11,23 @@ import numpy as np
 import pandas as pd
 from scipy.stats import ttest_rel
 
-from janelia_core.dataprocessing.dataset import ROIDataset
 from janelia_core.stats.permutation_tests import paired_grouped_perm_test
-from keller_zlatic_vnc.data_processing import calc_dff
+from keller_zlatic_vnc.dff_cache import load_dff
+from keller_zlatic_vnc.data_processing import calc_dff_prefix_sums
+from keller_zlatic_vnc.data_processing import calc_window_means
 from keller_zlatic_vnc.data_processing import generate_standard_id_for_full_annots
 from keller_zlatic_vnc.data_processing import generate_standard_id_for_volume
 from keller_zlatic_vnc.data_processing import read_full_annotations
+from keller_zlatic_vnc.whole_brain.batched_stats import paired_grouped_perm_test_batch
 
 
 def single_subject_pain_stats(analyze_subj: str, annot_folders: List[str], volume_loc_file: str, dataset_folder: str,
                               dataset_base_folder: str, f_ts_str: str, bl_ts_str: str, background: float,
                               ep: float, n_before_tm_pts: int, after_aligned: str, after_offset: int,
                               n_after_tm_pts: int, save_folder: str, save_name: str, min_stim_dur: int = 0,
-                              max_stim_dur: int = 100):
+                              max_stim_dur: int = 100, fwer_n_perms: int = None, seed: int = None,
+                              test_type: str = 't_test', n_perms: int = 10000, seq_alpha: float = None,
+                              dff_cache_dir: str = None):
     """ A function for detecting rois with significant responses to the optogenetic stimulus.
 
     This function will:
@@ -35,7 +39,10 @@ def single_subject_pain_stats(analyze_subj: str, annot_folders: List[str], volum
         2) It will then apply a statistical test to determine if there is a significant difference in DFF in
         the two windows
 
-        3) It will then save the results in a manner which is ready to be passed to the visualization function
+        3) Optionally, it will perform a permutation test across all rois at once, recording the maximum statistic
+        across rois for each permutation, to produce p-values adjusted for the family-wise error rate
+
+        4) It will then save the results in a manner which is ready to be passed to the visualization function
         make_whole_brain_videos_and_max_projs
 
     Args:
@@ -84,8 +91,42 @@ def single_subject_pain_stats(analyze_subj: str, annot_folders: List[str], volum
         max_stim_dur: In conjunction with min_stim_dur, used to filter events to include in the analysis based
         on stimulus duration (see min_stim_dur for more details).
 
+        fwer_n_perms: If not None, the number of permutations to use for computing FWER adjusted p-values with the
+        max-statistic procedure (see paired_grouped_perm_test_batch).  Each event is permuted on its own.  Adjusted
+        p-values are saved in the 'p_values_fwer' entry of the beh_stats in the results and the max statistic for each
+        permutation is saved in the 'perm_max_stats' entry of the results themselves (not of the beh_stats).
+
+        seed: Seed for generating permutations when computing FWER adjusted p-values or performing permutation tests.
+
+        test_type: The test to apply to determine if there is a significant difference in DFF before and after the
+        stimulus.  Options are:
+
+            t_test: A paired t-test, computed for all rois at once
+
+            perm: A paired sign-flip permutation test, computed for all rois at once (see
+            paired_grouped_perm_test_batch)
+
+        Rois with nan DFF values for any event are given p-values of 1.
+
+        n_perms: The number of permutations to use when test_type is 'perm'
+
+        seq_alpha: If not None and test_type is 'perm', permutations for each roi are stopped early once the p-value
+        for the roi could not be less than or equal to seq_alpha (see paired_grouped_perm_test_batch).  The number of
+        permutations used for each roi is saved in the 'n_perms_used' entry of the beh_stats in the results.
+
+        dff_cache_dir: Folder of a cache to store dff in, so later runs do not need to recalculate it (see the dff_cache
+        module).  If None, the folder given by the environment variable dff_cache.CACHE_DIR_ENV_VAR will be used if it
+        is set; otherwise dff is not cached.
+
+    Raises:
+
+        ValueError: If test_type is not one of the expected strings.
+
     """
 
+    if (test_type != 't_test') and (test_type != 'perm'):
+        raise(ValueError('test_type must be one of the following strings: t_test, perm'))
+
     # ==================================================================================================================
     # Get list of all subjects we can analyze
     #  These are those we have registered volumes for and annotations
@@ -142,73 +183,68 @@ def single_subject_pain_stats(analyze_subj: str, annot_folders: List[str], volum
                     Path(dataset_folder) / '*.pkl')
     dataset_file = glob.glob(str(dataset_path))[0]
 
-    with open(dataset_file, 'rb') as f:
-        dataset = ROIDataset.from_dict(pickle.load(f))
-
     # Calculate dff
-    f = dataset.ts_data[f_ts_str]['vls'][:]
-    b = dataset.ts_data[bl_ts_str]['vls'][:]
-    dff = calc_dff(f=f, b=b, background=background, ep=ep)
-
-    extracted_dff = dict()
-    for index in annotations.index:
-        event_start = annotations['start'][index]
-        event_stop = annotations['end'][index]
+    dff = load_dff(dataset_file=dataset_file, f_ts_str=f_ts_str, bl_ts_str=bl_ts_str, background=background, ep=ep,
+                   cache_dir=dff_cache_dir)
 
-        dff_before = np.mean(dff[event_start - n_before_tm_pts:event_start, :], axis=0)
+    # Windows follow python slicing conventions, as when indexing into dff for each event
+    dff_prefix_sums = calc_dff_prefix_sums(dff)
+    event_starts = annotations['start'].to_numpy()
+    event_stops = annotations['end'].to_numpy()
 
-        if after_aligned == 'start':
-            after_start_ind = event_start + after_offset
-        elif after_aligned == 'end':
-            after_start_ind = event_stop + after_offset
-        else:
-            raise ('Unable to recogonize value of after_aligned.')
-        after_stop_ind = after_start_ind + n_after_tm_pts
+    dff_before = calc_window_means(dff_prefix_sums, event_starts - n_before_tm_pts, event_starts, out_of_range='slice')
 
-        dff_after = np.mean(dff[after_start_ind:after_stop_ind, :], axis=0)
+    if after_aligned == 'start':
+        after_start_inds = event_starts + after_offset
+    elif after_aligned == 'end':
+        after_start_inds = event_stops + after_offset
+    else:
+        raise ('Unable to recogonize value of after_aligned.')
+    after_stop_inds = after_start_inds + n_after_tm_pts
 
-        extracted_dff[index] = (dff_before, dff_after)
+    dff_after = calc_window_means(dff_prefix_sums, after_start_inds, after_stop_inds, out_of_range='slice')
 
     # ==================================================================================================================
     # Remove any events where the $\Delta F /F$ window fell outside of the recorded data
 
-    bad_keys = [k for k, vl in extracted_dff.items() if np.all(np.isnan(vl[0]))]
-    for key in bad_keys:
-        del extracted_dff[key]
+    bad_events = np.all(np.isnan(dff_before), axis=1)
+    dff_before = dff_before[~bad_events]
+    dff_after = dff_after[~bad_events]
 
     # Drop same events in annotations, even though we don't use this table anymore, just for good house keeping
-    annotations.drop(bad_keys, axis='index', inplace=True)
+    annotations = annotations[~bad_events]
 
     # ==================================================================================================================
     # Calculate statistics
 
-    dff_before = np.stack([extracted_dff[i][0] for i in extracted_dff.keys()])
-    dff_after = np.stack([extracted_dff[i][1] for i in extracted_dff.keys()])
-
-    n_rois = dff.shape[1]
-    mn_stats = [None] * n_rois
-    for roi_i in range(n_rois):
-        mn_stats[roi_i] = _mean_t_test(dff_before[:, roi_i], dff_after[:, roi_i])
-        if roi_i % 50000 == 0:
-            print('Done with roi ' + str(roi_i) + ' of ' + str(n_rois) + '.')
+    if test_type == 't_test':
+        mn_stats = _mean_t_test_batch(dff_before, dff_after)
+    else:
+        mn_stats = _mean_perm_test_batch(dff_before, dff_after, n_perms=n_perms, seed=seed, seq_alpha=seq_alpha)
 
     # ==================================================================================================================
     # Package results
 
-    diff_vls = np.zeros(n_rois)
-    p_values = np.ones(n_rois)  # Default value is 1, which is what we leave if we couldn't calculate a p-value b/c the
-                                # means before and after stimulus were too close
+    diff_vls = mn_stats['after_mn'] - mn_stats['before_mn']
 
-    for roi_i in range(n_rois):
-        diff_vls[roi_i] = mn_stats[roi_i]['after_mn'] - mn_stats[roi_i]['before_mn']
-        if not (np.isnan(mn_stats[roi_i]['p'])):
-            p_values[roi_i] = mn_stats[roi_i]['p']
-        else:
-            p_values[roi_i] = 1.0
+    # We set p-values to 1 if we couldn't calculate a p-value b/c the means before and after stimulus were too close
+    # or because of nan values
+    p_values = mn_stats['p']
+    p_values[np.isnan(p_values)] = 1.0
 
     beh_stats = {'G_G': {'beta': diff_vls, 'p_values': p_values}}   # G_G = "grouped to grouped" condition transitions,
                                                                     # since we don't care what came before or after
                                                                     # stimulus
+    if seq_alpha is not None and test_type == 'perm':
+        beh_stats['G_G']['n_perms_used'] = mn_stats['n_perms_used']
+
+    if fwer_n_perms is not None:
+        perm_stats = paired_grouped_perm_test_batch(x0=dff_before, x1=dff_after, grp_ids=np.arange(len(dff_before)),
+                                                    n_perms=fwer_n_perms, seed=seed, record_max_stats=True)
+        p_values_fwer = perm_stats['p_fwer']
+        p_values_fwer[np.isnan(p_values_fwer)] = 1.0
+        beh_stats['G_G']['p_values_fwer'] = p_values_fwer
+
     full_stats = {'beh_stats': beh_stats}
 
     # ==================================================================================================================
@@ -229,10 +265,17 @@ def single_subject_pain_stats(analyze_subj: str, annot_folders: List[str], volum
           'n_after_tm_pts': n_after_tm_pts,
           'min_stim_dur': min_stim_dur,
           'max_stim_dur': max_stim_dur,
+          'fwer_n_perms': fwer_n_perms,
+          'seed': seed,
+          'test_type': test_type,
+          'n_perms': n_perms,
+          'seq_alpha': seq_alpha,
           'save_folder': save_folder,
           'save_name': save_name}
 
     rs = {'ps': ps, 'full_stats': full_stats}
+    if fwer_n_perms is not None:
+        rs['perm_max_stats'] = perm_stats['max_stats']
 
     save_path = Path(ps['save_folder']) / ps['save_name']
     with open(save_path, 'wb') as f:
@@ -249,6 +292,18 @@ def _mean_t_test(before_vls, after_vls):
         return {'after_mn': after_mn, 'before_mn': before_mn, 'p': p}
 
 
+def _mean_t_test_batch(before_vls, after_vls):
+    """ Applies _mean_t_test to all columns of the events*rois matrices before_vls and after_vls at once.
+
+    As with _mean_t_test, means and p-values are nan for rois with nan values for any event.
+    """
+    before_mn = np.mean(before_vls, axis=0)
+    after_mn = np.mean(after_vls, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        _, p = ttest_rel(a=before_vls, b=after_vls, axis=0)
+    return {'after_mn': after_mn, 'before_mn': before_mn, 'p': np.asarray(p, dtype=np.float64)}
+
+
 def _mean_perm_test(before_vls, after_vls, n_perms):
         before_mn = np.mean(before_vls)
         after_mn = np.mean(after_vls)
@@ -256,3 +311,17 @@ def _mean_perm_test(before_vls, after_vls, n_perms):
                                         grp_ids=np.arange(len(after_vls)), n_perms=n_perms)
         return {'after_mn': after_mn, 'before_mn': before_mn, 'p': p}
 
+
+def _mean_perm_test_batch(before_vls, after_vls, n_perms, seed=None, seq_alpha=None):
+    """ A batched alternative to _mean_perm_test, testing all columns of the events*rois matrices at once.
+
+    All rois share the same permutations.  p-values are nan for rois with nan values for any event.
+    """
+    before_mn = np.mean(before_vls, axis=0)
+    after_mn = np.mean(after_vls, axis=0)
+    perm_stats = paired_grouped_perm_test_batch(x0=before_vls, x1=after_vls, grp_ids=np.arange(before_vls.shape[0]),
+                                                n_perms=n_perms, seed=seed, seq_alpha=seq_alpha)
+    mn_stats = {'after_mn': after_mn, 'before_mn': before_mn, 'p': perm_stats['p']}
+    if seq_alpha is not None:
+        mn_stats['n_perms_used'] = perm_stats['n_perms_used']
+    return mn_stats
@@ -0,0 +1,126 @@
+""" Tools for running per-ROI computations in parallel without copying data to workers for every task.
+
+Input arrays (e.g., a design matrix, group labels and a matrix of dff values for all ROIs) are published once to
+shared memory, and each worker process attaches to them when it starts.  Work is then dispatched as contiguous blocks
+of ROIs, so the only thing sent to a worker for a task is the range of ROIs it should process.  Workers write their
+results directly into preallocated output arrays which are also held in shared memory.
+
+"""
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from typing import Callable, Sequence, Tuple
+
+import numpy as np
+
+
+# Holds the state of each worker process; populated by _init_worker
+_WORKER_STATE = dict()
+
+
+def run_roi_blocks(block_f: Callable, in_arrays: dict, out_specs: dict, n_rois: int, n_workers: int = None,
+                   block_size: int = 1000, f_kwargs: dict = None) -> dict:
+    """ Runs a function over contiguous blocks of ROIs in parallel, with inputs and outputs in shared memory.
+
+    Args:
+
+        block_f: The function to run on each block of ROIs.  It will be called as
+        block_f(in_arrays, out_arrays, rois, **f_kwargs), where in_arrays and out_arrays are dictionaries of
+        numpy arrays (with the same keys as in_arrays and out_specs provided to this function) and rois is a slice
+        object giving the ROIs to process.  block_f should write results for those ROIs into out_arrays.  block_f
+        must be defined at the top level of a module, so that it can be passed to worker processes.
+
+        in_arrays: Dictionary of input arrays which will be made available to all workers.
+
+        out_specs: Dictionary specifying the output arrays.  Each value is a tuple of the form (shape, dtype,
+        fill_value) giving the shape, data type and initial value for the corresponding output array.
+
+        n_rois: The total number of ROIs to process.
+
+        n_workers: The number of worker processes to use.  If None, the number of cpus on the machine will be used.
+        If 1, all blocks will be processed in the calling process without the use of shared memory.
+
+        block_size: The number of ROIs to process in each task.
+
+        f_kwargs: Extra keyword arguments to pass to block_f.
+
+    Returns:
+
+        out_arrays: Dictionary of output arrays, with the keys in out_specs.
+
+    """
+
+    if n_workers is None:
+        n_workers = mp.cpu_count()
+    if f_kwargs is None:
+        f_kwargs = dict()
+
+    blocks = [(b_start, min(b_start + block_size, n_rois)) for b_start in range(0, n_rois, block_size)]
+
+    if n_workers == 1:
+        out_arrays = {k: np.full(shape, fill_vl, dtype=dtype) for k, (shape, dtype, fill_vl) in out_specs.items()}
+        for b_start, b_stop in blocks:
+            block_f(in_arrays, out_arrays, slice(b_start, b_stop), **f_kwargs)
+        return out_arrays
+
+    shm_blocks = []
+    try:
+        # Publish inputs and allocate outputs in shared memory
+        in_descs = dict()
+        for k, arr in in_arrays.items():
+            arr = np.ascontiguousarray(arr)
+            shm, shm_arr = _create_shared_array(arr.shape, arr.dtype)
+            shm_arr[...] = arr
+            shm_blocks.append(shm)
+            in_descs[k] = (shm.name, arr.shape, arr.dtype)
+
+        out_descs = dict()
+        out_arrays = dict()
+        for k, (shape, dtype, fill_vl) in out_specs.items():
+            shm, shm_arr = _create_shared_array(shape, np.dtype(dtype))
+            shm_arr[...] = fill_vl
+            shm_blocks.append(shm)
+            out_descs[k] = (shm.name, tuple(shape), np.dtype(dtype))
+            out_arrays[k] = shm_arr
+
+        with mp.Pool(n_workers, initializer=_init_worker,
+                     initargs=(block_f, in_descs, out_descs, f_kwargs)) as pool:
+            pool.map(_run_block, blocks, chunksize=1)
+
+        # Copy results out of shared memory before it is released
+        return {k: np.array(vl) for k, vl in out_arrays.items()}
+
+    finally:
+        for shm in shm_blocks:
+            shm.close()
+            shm.unlink()
+
+
+# Helper functions go here
+
+def _create_shared_array(shape: Sequence[int], dtype: np.dtype) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    n_bytes = max(int(np.prod(shape))*dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=n_bytes)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _attach_shared_arrays(descs: dict) -> dict:
+    arrays = dict()
+    for k, (name, shape, dtype) in descs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _WORKER_STATE['shm'].append(shm)
+        arrays[k] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return arrays
+
+
+def _init_worker(block_f, in_descs, out_descs, f_kwargs):
+    _WORKER_STATE['shm'] = []
+    _WORKER_STATE['block_f'] = block_f
+    _WORKER_STATE['in_arrays'] = _attach_shared_arrays(in_descs)
+    _WORKER_STATE['out_arrays'] = _attach_shared_arrays(out_descs)
+    _WORKER_STATE['f_kwargs'] = f_kwargs
+
+
+def _run_block(block):
+    _WORKER_STATE['block_f'](_WORKER_STATE['in_arrays'], _WORKER_STATE['out_arrays'], slice(block[0], block[1]),
+                             **_WORKER_STATE['f_kwargs'])
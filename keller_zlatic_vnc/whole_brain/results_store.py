@@ -0,0 +1,306 @@
+""" Tools for saving and loading whole-brain results in a columnar, memory-mappable format.
+
+Results of whole-brain statistical tests have historically been pickled with one dictionary of small arrays per ROI.
+Loading a single map from these files requires unpickling everything.  Here we instead store each per-ROI quantity
+(e.g., beta, acm, p-values) for all ROIs as a single contiguous array in its own .npy file, which can be memory
+mapped.  All other results (parameters, variable names, transition counts, etc.) are pickled alongside in a small
+metadata file.
+
+A results store is a folder with the files:
+
+    meta.pkl: A pickled dictionary with the metadata of the results, as well as the entry 'fields', which is a
+    dictionary describing the stored fields.
+
+    <field>.npy: One file for each field.  On disk, ROIs are along the last axis, so that the values for a single
+    variable for all ROIs are contiguous.  Fields are presented with ROIs along the first axis when loaded.
+
+Field names are formed by joining the keys needed to reach a per-ROI quantity in the original results with periods.
+For example, beta values in full_stats are stored in the field 'full_stats.beta' and p-values for behavior 'F' in
+beh_stats are stored in the field 'beh_stats.F.p_values'.
+
+"""
+
+import os
+from pathlib import Path
+import pickle
+from typing import Sequence, Union
+
+import numpy as np
+
+META_FILE = 'meta.pkl'
+
+
+def save_results_store(folder: Union[Path, str], fields: dict, meta: dict, float_dtype: np.dtype = np.float64):
+    """ Saves results in the columnar format.
+
+    Args:
+
+        folder: The folder to save results into.  Will be created if it does not exist.
+
+        fields: Dictionary of per-ROI fields to save.  Keys are field names and values are arrays with ROIs along
+        the first dimension.
+
+        meta: Dictionary of other results to save with the fields.
+
+        float_dtype: The data type floating point fields are saved with.
+
+    """
+
+    folder = Path(folder)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    field_descs = dict()
+    for name, vls in fields.items():
+        vls = np.asarray(vls)
+        if np.issubdtype(vls.dtype, np.floating):
+            vls = vls.astype(float_dtype, copy=False)
+        field_descs[name] = {'shape': vls.shape, 'dtype': vls.dtype}
+        np.save(folder / (name + '.npy'), np.ascontiguousarray(np.moveaxis(vls, 0, -1)))
+
+    meta = dict(meta)
+    meta['fields'] = field_descs
+    with open(folder / META_FILE, 'wb') as f:
+        pickle.dump(meta, f)
+
+
+def results_to_store(rs: dict, folder: Union[Path, str], float_dtype: np.dtype = np.float64):
+    """ Saves a results dictionary, as produced by one of the whole-brain fitting or testing functions, as a store.
+
+    The 'full_stats', 'beh_stats' and 'lag_stats' entries of rs are broken up into fields.  full_stats may be either a
+    list with one dictionary per ROI, a dictionary with a list of (dictionary, pull index) tuples for each behavior (as
+    produced by whole_brain_other_ref_testing) or a dictionary with its own 'beh_stats' entry (as produced for pain
+    statistics).  lag_stats (as produced by fit_init_models when fitting lags) is a dictionary of arrays with ROIs
+    along the first dimension.  rs may also have a 'fields' entry, of the same form load_results_store returns, holding
+    per-ROI quantities which are already stacked into arrays with ROIs along the first dimension.  These are saved as
+    they are, so functions which compute stats for all ROIs at once can save them without first splitting them into
+    per-ROI dictionaries.  All other entries of rs are saved as metadata.
+
+    Values which are missing from the dictionaries of some ROIs (e.g., c_ints for ROIs stats were not computed for)
+    are saved as nan for those ROIs.
+
+    Args:
+
+        rs: The results dictionary to save.
+
+        folder: The folder to save the results store in.
+
+        float_dtype: The data type floating point fields are saved with.
+
+    """
+
+    fields = dict()
+    meta = {k: vl for k, vl in rs.items() if k not in {'full_stats', 'beh_stats', 'lag_stats', 'fields'}}
+
+    if 'fields' in rs:
+        fields.update(rs['fields'])
+
+    if 'lag_stats' in rs:
+        fields.update({'lag_stats.' + k: vls for k, vls in rs['lag_stats'].items()})
+
+    if 'beh_stats' in rs:
+        fields.update(_beh_stats_to_fields(rs['beh_stats'], 'beh_stats'))
+
+    if 'full_stats' in rs:
+        full_stats = rs['full_stats']
+        if isinstance(full_stats, dict) and 'beh_stats' in full_stats:
+            fields.update(_beh_stats_to_fields(full_stats['beh_stats'], 'full_stats.beh_stats'))
+        elif isinstance(full_stats, dict):
+            meta['full_stats_pull_inds'] = dict()
+            for b, b_stats in full_stats.items():
+                fields.update(_roi_dicts_to_fields([s for s, _ in b_stats], 'full_stats.' + b))
+                meta['full_stats_pull_inds'][b] = b_stats[0][1]
+        else:
+            fields.update(_roi_dicts_to_fields(full_stats, 'full_stats'))
+
+    save_results_store(folder=folder, fields=fields, meta=meta, float_dtype=float_dtype)
+
+
+def convert_results_pickle(pkl_file: Union[Path, str], folder: Union[Path, str] = None,
+                           float_dtype: np.dtype = np.float64) -> Path:
+    """ Converts a pickled results file to a results store.
+
+    Args:
+
+        pkl_file: The pickle file to convert.
+
+        folder: The folder to save the results store in.  If None, a folder with the same name as pkl_file (without
+        the .pkl extension) will be created next to it.
+
+        float_dtype: The data type floating point fields are saved with.
+
+    Returns:
+
+        folder: The folder the results store was saved in.
+
+    """
+
+    pkl_file = Path(pkl_file)
+    if folder is None:
+        folder = pkl_file.parent / pkl_file.stem
+
+    with open(pkl_file, 'rb') as f:
+        rs = pickle.load(f)
+
+    results_to_store(rs=rs, folder=folder, float_dtype=float_dtype)
+    return Path(folder)
+
+
+def results_path(save_path: Union[Path, str], results_format: str) -> Path:
+    """ Gives the path results are saved to by save_results for a given format.
+
+    Args:
+
+        save_path: The path to the pickle file results would be saved in.
+
+        results_format: The format results are saved in.  Either 'pickle' or 'columnar'.
+
+    Returns:
+
+        path: save_path if results_format is 'pickle', or the folder of the results store if results_format is
+        'columnar' (save_path without the file extension).
+
+    Raises:
+
+        ValueError: If results_format is not one of the expected strings.
+
+    """
+    if results_format == 'pickle':
+        return Path(save_path)
+    elif results_format == 'columnar':
+        return Path(save_path).with_suffix('')
+    else:
+        raise(ValueError('results_format must be one of the following strings: pickle, columnar'))
+
+
+def save_results(rs: dict, save_path: Union[Path, str], results_format: str = 'pickle') -> Path:
+    """ Saves a results dictionary either as a pickle file or as a results store.
+
+    Args:
+
+        rs: The results to save.
+
+        save_path: The path to the pickle file to save results in.  If saving a results store, the store will be
+        saved in a folder with the same path, but without the file extension (see results_path).
+
+        results_format: The format to save results in.  Either 'pickle' or 'columnar'.
+
+    Returns:
+
+        path: The path results were saved to.
+
+    """
+    path = results_path(save_path, results_format)
+    if results_format == 'pickle':
+        with open(path, 'wb') as f:
+            pickle.dump(rs, f)
+    else:
+        results_to_store(rs=rs, folder=path)
+    return path
+
+
+def load_results(path: Union[Path, str]) -> dict:
+    """ Loads results saved by save_results, in either format.
+
+    Args:
+
+        path: The pickle file or results store folder to load.
+
+    Returns:
+
+        rs: The loaded results.  See load_results_store for the format of results loaded from a store.
+
+    """
+    if os.path.isdir(path):
+        return load_results_store(path)
+    else:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def load_results_store(folder: Union[Path, str]) -> dict:
+    """ Loads a results store, memory mapping all fields.
+
+    No field data is read from disk until it is accessed.
+
+    Args:
+
+        folder: The folder of the results store.
+
+    Returns:
+
+        rs: A dictionary with all the metadata of the results as well as the entry 'fields', which is a dictionary
+        of memory mapped arrays, with ROIs along the first dimension.  If the store has beh_stats fields, these will
+        also be placed in a 'beh_stats' dictionary of the form used by make_whole_brain_videos_and_max_projs.
+
+    """
+
+    folder = Path(folder)
+    with open(folder / META_FILE, 'rb') as f:
+        rs = pickle.load(f)
+
+    rs['fields'] = {name: load_results_field(folder, name) for name in rs['fields'].keys()}
+
+    beh_stats = dict()
+    for name, vls in rs['fields'].items():
+        if name.startswith('beh_stats.'):
+            b, k = name[len('beh_stats.'):].rsplit('.', 1)
+            beh_stats.setdefault(b, dict())[k] = vls
+    if len(beh_stats) > 0:
+        rs['beh_stats'] = beh_stats
+
+    return rs
+
+
+def load_results_field(folder: Union[Path, str], field: str, var: Union[int, str] = None,
+                       var_names: Sequence[str] = None) -> np.ndarray:
+    """ Loads a single field, or the values of a single variable of a field, from a results store.
+
+    Args:
+
+        folder: The folder of the results store.
+
+        field: The name of the field to load.
+
+        var: If None, a memory mapped array for the whole field will be returned.  Otherwise, the variable to return
+        values for all ROIs for.  This can be either an integer index or the name of a variable.  Only the values for
+        this variable will be read from disk.
+
+        var_names: The names of variables, used to look up var if it is a string.  If None, var_names will be read
+        from the metadata of the store.
+
+    Returns:
+
+        vls: The requested values, with ROIs along the first dimension.
+
+    """
+
+    folder = Path(folder)
+    vls = np.moveaxis(np.load(folder / (field + '.npy'), mmap_mode='r'), -1, 0)
+
+    if var is None:
+        return vls
+
+    if isinstance(var, str):
+        if var_names is None:
+            with open(folder / META_FILE, 'rb') as f:
+                var_names = pickle.load(f)['var_names']
+        var = list(var_names).index(var)
+
+    return np.array(vls[:, var])
+
+
+# Helper functions go here
+
+def _roi_dicts_to_fields(roi_dicts: Sequence[dict], prefix: str) -> dict:
+    fields = dict()
+    for k in dict.fromkeys([k for d in roi_dicts for k in d.keys()]):
+        shape = np.shape(next(d[k] for d in roi_dicts if k in d))
+        fields[prefix + '.' + k] = np.stack([np.asarray(d[k]) if k in d else np.full(shape, np.nan)
+                                             for d in roi_dicts])
+    return fields
+
+
+def _beh_stats_to_fields(beh_stats: dict, prefix: str) -> dict:
+    return {prefix + '.' + b + '.' + k: np.asarray(vls) for b, b_stats in beh_stats.items()
+            for k, vls in b_stats.items()}
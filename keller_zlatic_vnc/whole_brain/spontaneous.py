@@ -5,31 +5,38 @@ import glob
 import itertools
 import os
 from pathlib import Path
-import pickle
-from typing import Tuple
+from typing import Callable, List, Sequence, Tuple, Union
 
-import multiprocessing as mp
 import numpy as np
 import pandas as pd
 
-from janelia_core.dataprocessing.dataset import ROIDataset
 from janelia_core.stats.multiple_comparisons import apply_by
 from janelia_core.stats.multiple_comparisons import apply_bonferroni
 from janelia_core.stats.regression import linear_regression_ols_estimator
 from janelia_core.stats.regression import grouped_linear_regression_acm_stats
 from janelia_core.stats.regression import grouped_linear_regression_ols_estimator
 
-from keller_zlatic_vnc.data_processing import apply_cutoff_times
+from keller_zlatic_vnc.dff_cache import load_dff
 from keller_zlatic_vnc.data_processing import count_unique_subjs_per_transition
 from keller_zlatic_vnc.data_processing import count_transitions
-from keller_zlatic_vnc.data_processing import calc_dff
-from keller_zlatic_vnc.data_processing import find_quiet_periods
+from keller_zlatic_vnc.data_processing import extract_peri_event_dff
+from keller_zlatic_vnc.data_processing import calc_dff_prefix_sums
+from keller_zlatic_vnc.data_processing import calc_window_means
 from keller_zlatic_vnc.data_processing import generate_standard_id_for_full_annots
 from keller_zlatic_vnc.data_processing import generate_standard_id_for_volume
-from keller_zlatic_vnc.data_processing import get_basic_clean_annotations_from_full
-from keller_zlatic_vnc.data_processing import read_full_annotations
+from keller_zlatic_vnc.data_processing import read_clean_annotations
 from keller_zlatic_vnc.linear_modeling import one_hot_from_table
-from keller_zlatic_vnc.whole_brain.whole_brain_stat_functions import test_for_diff_than_mean_vls
+from keller_zlatic_vnc.whole_brain.batched_stats import grouped_linear_regression_ols_batch
+from keller_zlatic_vnc.whole_brain.batched_stats import grouped_linear_regression_ols_batch_out_specs
+from keller_zlatic_vnc.whole_brain.batched_stats import test_for_diff_than_mean_vls_batch
+from keller_zlatic_vnc.whole_brain.batched_stats import unpack_batch_stats
+from keller_zlatic_vnc.whole_brain.parallel import run_roi_blocks
+from keller_zlatic_vnc.whole_brain.results_store import load_results
+from keller_zlatic_vnc.whole_brain.results_store import results_path
+from keller_zlatic_vnc.whole_brain.results_store import save_results
+
+# The parameters which can be set for each window when fitting models for multiple windows with fit_init_models
+WINDOW_SPEC_KEYS = {'window_type', 'window_offset', 'window_length', 'enforce_contained_events', 'save_name'}
 
 
 def apply_multiple_comparisons_corrections(p_vls: np.ndarray, computed_p_vls: np.ndarray):
@@ -107,7 +114,54 @@ def calc_mean_dff(x: np.ndarray, start: int, stop: int, window_type: str,
     return mn_vls, starts_within_event, stops_within_event
 
 
-def fit_init_models(ps: dict):
+def calc_mean_dff_batch(prefix_sums: np.ndarray, starts: np.ndarray, stops: np.ndarray, window_type: str,
+                        window_offset: int = None,
+                        window_length: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Calculates mean DFF in windows for many events at once.
+
+    This produces the same results as calling calc_mean_dff for each event, but works from prefix sums of DFF (see
+    calc_dff_prefix_sums), so the mean for each window is calculated with two row look ups and a subtraction.
+
+    Args:
+        prefix_sums: Prefix sums of DFF, as returned by calc_dff_prefix_sums
+        starts: start indices of the events
+        stops: stop indices of the events
+        window_type: Type of window.  Either 'whole_event' or 'start_locked'.
+        window_offset: The offset to the start of the window from event start if window type is start_locked.
+        window_length: The length of the window if the window tpe is start_locked.
+
+    Returns:
+         mn_vls: The mean values across all rois, of shape n_events*n_rois.  Rows for events with windows outside the
+         range of recorded data are nan.
+         starts_within_event: Boolean array, true for events where the window starts within the event.
+         stops_within_event: Boolean array, true for events where the window stops within the event.
+    """
+
+    starts = np.asarray(starts)
+    stops = np.asarray(stops)
+
+    if window_type == 'whole_event':
+        window_starts = starts
+        window_stops = stops
+        starts_within_event = np.ones(len(starts), dtype=bool)
+        stops_within_event = np.ones(len(starts), dtype=bool)
+    elif window_type == 'start_locked':
+        window_starts = starts + window_offset
+        window_stops = window_starts + window_length
+        starts_within_event = (stops >= window_starts) & (starts <= window_stops)
+        stops_within_event = (stops >= window_stops) & (starts <= window_stops)
+    else:
+        raise(ValueError('The window_type is not recogonized.'))
+
+    mn_vls = calc_window_means(prefix_sums=prefix_sums, starts=window_starts, stops=window_stops, out_of_range='nan')
+
+    return mn_vls, starts_within_event, stops_within_event
+
+
+def fit_init_models(ps: dict, n_workers: int = None, block_size: int = 1000, results_format: str = 'pickle',
+                    compute_mean_cmp_stats: bool = False, window_specs: Sequence[dict] = None,
+                    dff_cache_dir: str = None, lags: Sequence[int] = None, annot_cache_dir: str = None,
+                    window_done_f: Callable[[dict], None] = None) -> Union[tuple, List[dict]]:
     """ Fits initial models to spontaneous activity.
 
     This function will:
@@ -147,6 +201,9 @@ def fit_init_models(ps: dict):
 
         12) Package the results
 
+        13) Optionally, compare the coefficient for each behavior to the mean of the others in its group, while the
+        fit coefficients are still in memory (see compute_mean_cmp_stats below)
+
     Note: One subject (CW_17-11-03-L6-2) has a different name for its saved volume.  If this subject is included
     in the analysis, this function will make sure the correct volume is used.
 
@@ -226,16 +283,90 @@ def fit_init_models(ps: dict):
 
             save_name: Name of the file to save results in
 
+        n_workers: The number of worker processes to fit models with.  If None, the number of cpus on the machine
+        will be used.
+
+        block_size: The number of rois each worker fits models for at a time.
+
+        results_format: The format to save results in.  Either 'pickle' or 'columnar' (see the results_store
+        module).  Columnar results are saved in a folder named after save_name, without the file extension.  With
+        columnar results, the returned results hold the stats for all rois as arrays in a 'fields' entry, in place of
+        full_stats, as they would be loaded from the results store.
+
+        compute_mean_cmp_stats: True if the post-processed statistics produced by parallel_test_for_diff_than_mean_vls
+        should be computed in the same pass as the initial fits.  This avoids reloading the fitting results from disk.
+        If results are saved, the post-processed results are saved next to them, with the same name that
+        parallel_test_for_diff_than_mean_vls would use.
+
+        window_specs: If not None, a list of windows to fit models for.  Each entry is a dictionary which replaces
+        values in ps for that window, and may have the keys 'window_type', 'window_offset', 'window_length',
+        'enforce_contained_events' and 'save_name' (each window should be given its own save_name if results are
+        saved).  Annotations and neural data for each subject are read and dff is calculated only once.  Windows are
+        then processed one at a time: dff for a window is extracted for all events and models for the window are fit
+        and saved before moving on to the next window, so extracted dff is only held for one window at a time.
+
+        dff_cache_dir: Folder of a cache to store dff for each subject in, so later runs do not need to recalculate it
+        (see the dff_cache module).  If None, the folder given by the environment variable
+        dff_cache.CACHE_DIR_ENV_VAR will be used if it is set; otherwise dff is not cached.
+
+        lags: If not None, models are fit in a time-resolved manner.  Instead of mean dff in a window, dff at each of
+        these lags relative to the start of each event is regressed against the same design and grouping (see
+        extract_peri_event_dff in data_processing).  All lags and rois are fit in one batched call.  The
+        window_type, window_offset and window_length values in ps are not used, but if enforce_contained_events is
+        true, only events which contain all lags are analyzed.  Events for which any lag falls outside of the
+        recorded data are removed.  This cannot be used with compute_mean_cmp_stats or window_specs.
+
+        annot_cache_dir: Folder of a cache to store the clean annotations for each subject in, so later runs with the
+        same annotation parameters (q_th, q_start_offset, q_end_offset, clean_event_def and co_th) do not need to
+        recompute them (see read_clean_annotations in data_processing).  If None, the folder given by the environment
+        variable data_processing.ANNOT_CACHE_DIR_ENV_VAR will be used if it is set; otherwise annotations are not
+        cached.
+
+        window_done_f: If not None, a function which is called as window_done_f(w_ps) as soon as models for a window
+        have been fit (and saved, if ps['save_folder'] is not None), where w_ps is ps updated with the entries of the
+        window's spec.  This allows callers to record progress, so that a crash while fitting later windows does not
+        lose the windows that are already done.
+
     Returns:
 
-            rs: The fitting results
+        If window_specs is None, the tuple (rs, analyze_annotations) is returned, with mean_cmp_rs as a third value if
+        compute_mean_cmp_stats is True.  Otherwise, a list is returned with one entry for each window, in the same order
+        as window_specs.  Each entry is a dictionary with the keys 'rs', 'analyze_annotations' and 'mean_cmp_rs', where:
+
+            rs: The fitting results.  If lags is not None, rs will have the entries 'lags' and 'lag_stats' in place of
+            'full_stats'.  lag_stats is a dictionary with the entries 'beta', 'acm', 'non_zero_p', 'c_ints',
+            'non_zero_p_corrected_by', 'non_zero_p_corrected_bon', 'n_grps' and 'computed'.  Each of these is an array
+            with rois along the first dimension and lags along the second (e.g., beta is of shape
+            n_rois*n_lags*n_vars).  Multiple comparisons corrections are applied separately for each lag.  The entries
+            of mean_trans_vls will also have a lag dimension.
+
+            analyze_annotations: The annotations for all events that were used in model fitting
+
+            mean_cmp_rs: The post-processed results if compute_mean_cmp_stats is True; otherwise None.
 
-            ananlyze_annotations: The annotations for all events that were used in model fitting
+    Raises:
 
-            dff: The full recorded of dff for the last loaded subject (this is mainly provided for debugging)
+        ValueError: If an entry of window_specs has a key other than those listed above.
+
+        ValueError: If lags is provided with compute_mean_cmp_stats or window_specs.
 
     """
 
+    if lags is not None and (compute_mean_cmp_stats or window_specs is not None):
+        raise(ValueError('lags cannot be used with compute_mean_cmp_stats or window_specs.'))
+
+    # ==================================================================================================================
+    # Form parameters for each window we fit models for
+    if window_specs is None:
+        window_ps = [ps]
+    else:
+        for spec in window_specs:
+            unknown_keys = set(spec.keys()) - WINDOW_SPEC_KEYS
+            if len(unknown_keys) > 0:
+                raise(ValueError('Window specs can only have the keys: ' + ', '.join(sorted(WINDOW_SPEC_KEYS)) +
+                                 ', but found the keys: ' + ', '.join(sorted(unknown_keys))))
+        window_ps = [{**ps, **spec} for spec in window_specs]
+
     # ==================================================================================================================
     # Get list of all subjects we can analyze
 
@@ -280,23 +411,13 @@ def fit_init_models(ps: dict):
     # Read in the annotation data for all subjects we analyze.  We also generate cleaned and supplemented annotations
     # here
 
-    annotations = []
-    for s_id, d in subject_dict.items():
-        tbl = read_full_annotations(d['annot_file'])
-        quiet_tbl = find_quiet_periods(annots=tbl, q_th=ps['q_th'], q_start_offset=ps['q_start_offset'],
-                                       q_end_offset=ps['q_end_offset'])
-        tbl = pd.concat([tbl, quiet_tbl], ignore_index=True)
-        tbl['subject_id'] = s_id
-        annotations.append(tbl)
-
-    annotations = [get_basic_clean_annotations_from_full(annot, clean_def=ps['clean_event_def'])
-                   for annot in annotations]
+    annotations = [read_clean_annotations(d['annot_file'], q_th=ps['q_th'], q_start_offset=ps['q_start_offset'],
+                                          q_end_offset=ps['q_end_offset'], clean_def=ps['clean_event_def'],
+                                          co_th=ps['co_th'], subject_id=s_id, cache_dir=annot_cache_dir)
+                   for s_id, d in subject_dict.items()]
 
     annotations = pd.concat(annotations, ignore_index=True)
 
-    # Apply the cut off time threshold
-    annotations = apply_cutoff_times(annots=annotations, co_th=ps['co_th'])
-
     # ==================================================================================================================
     # Filter events by the behavior transitioned into or from if we are suppose to
     if ps['acc_behs'] is not None:
@@ -326,8 +447,10 @@ def fit_init_models(ps: dict):
         annotations = annotations.loc[~self_trans]
 
     # ==================================================================================================================
-    # Now we read in the Delta F\F data for all subjects
-    extracted_dff = dict()
+    # Now we read in the Delta F\F data for all subjects.  For windows, we keep prefix sums of dff for each subject, so
+    # that dff for each window can be extracted right before models for that window are fit.
+    lag_extracted_dff = dict()
+    subj_event_dff = dict()
     for s_id in analyze_subjs:
         print('Gathering neural data for subject ' + s_id)
 
@@ -339,30 +462,160 @@ def fit_init_models(ps: dict):
                         Path(ps['dataset_folder']) / '*.pkl')
         dataset_file = glob.glob(str(dataset_path))[0]
 
-        with open(dataset_file, 'rb') as f:
-            dataset = ROIDataset.from_dict(pickle.load(f))
-
         # Calculate dff
-        f = dataset.ts_data[ps['f_ts_str']]['vls'][:]
-        b = dataset.ts_data[ps['bl_ts_str']]['vls'][:]
-        dff = calc_dff(f=f, b=b, background=ps['background'], ep=ps['ep'])
+        dff = load_dff(dataset_file=dataset_file, f_ts_str=ps['f_ts_str'], bl_ts_str=ps['bl_ts_str'],
+                       background=ps['background'], ep=ps['ep'], cache_dir=dff_cache_dir)
+        dff_prefix_sums = calc_dff_prefix_sums(dff)
 
-        # Get the dff for each event
+        # Get the start and stop of each event
         s_events = annotations[annotations['subject_id'] == s_id]
-        for index in s_events.index:
-            event_start = s_events['start'][index]
-            event_stop = s_events['end'][index] + 1 # +1 to account for inclusive indexing in table
-            extracted_dff[index] = calc_mean_dff(dff, event_start, event_stop, ps['window_type'],
-                                                 ps['window_offset'], ps['window_length'])
+        event_starts = s_events['start'].to_numpy()
+        event_stops = s_events['end'].to_numpy() + 1  # +1 to account for inclusive indexing in table
+        if lags is not None:
+            # Determine which events contain all lags as if we had a window spanning them
+            _, starts_within_event, stops_within_event = calc_mean_dff_batch(dff_prefix_sums, event_starts,
+                                                                             event_stops, 'start_locked',
+                                                                             np.min(lags),
+                                                                             np.max(lags) - np.min(lags) + 1)
+            lag_dff = extract_peri_event_dff(dff=dff, event_tbl=s_events, align_col='start', lags=lags)
+            for e_i, index in enumerate(s_events.index):
+                lag_extracted_dff[index] = (lag_dff[e_i], starts_within_event[e_i], stops_within_event[e_i])
+        else:
+            subj_event_dff[s_id] = (dff_prefix_sums, s_events.index, event_starts, event_stops)
+
+    # ==================================================================================================================
+    # Fit models for each window
+    n_analyze_subjs = len(analyze_subjs)
+    window_rs = []
+    for w_ps in window_ps:
+        if lags is not None:
+            extracted_dff = lag_extracted_dff
+        else:
+            extracted_dff = _extract_window_dff(subj_event_dff=subj_event_dff, w_ps=w_ps)
+        window_rs.append(_fit_init_models_for_window(ps=w_ps, annotations=annotations, extracted_dff=extracted_dff,
+                                                     n_analyze_subjs=n_analyze_subjs, n_workers=n_workers,
+                                                     block_size=block_size, results_format=results_format,
+                                                     compute_mean_cmp_stats=compute_mean_cmp_stats, lags=lags))
+        del extracted_dff
+        if window_done_f is not None:
+            window_done_f(w_ps)
+
+    if window_specs is None:
+        w_rs = window_rs[0]
+        if compute_mean_cmp_stats:
+            return w_rs['rs'], w_rs['analyze_annotations'], w_rs['mean_cmp_rs']
+        return w_rs['rs'], w_rs['analyze_annotations']
+    return window_rs
+
+
+def parallel_test_for_diff_than_mean_vls(ps: dict, n_workers: int = None, block_size: int = 1000,
+                                         results_format: str = 'pickle'):
+    """ Post-processes fit models, comparing in parallel, if the mean for one transition is different that others.
+
+    See the function test_for_diff_than_mean_vls for details of statistical testing.
+
+    The main purpose of this function is to:
+
+     1) Load results from initial fitting a model
+
+     2) Check if post-processed results comparing means for the initial model fit exist.
+
+     3) If no post-processed results exist, to produce them, using parallel computation to speed up processing.
+
+    Args:
+
+        ps: Parameter dictionary specifying:
+
+            save_folder: The folder with the results to be post-processed are saved as well as the folder in which
+            the new post-processed results will be saved
+
+            basic_rs_file: The file with the basic results, which are to be post_processed.  This can be either
+            a pickle file or the folder of a results store.
+
+        n_workers: The number of worker processes to use.  If None, the number of cpus on the machine will be used.
+
+        block_size: The number of rois each worker processes at a time.
+
+        results_format: The format to save post-processed results in.  Either 'pickle' or 'columnar' (see the
+        results_store module).
+
+    Returns:
+
+        None.  The post-processed results will be saved in a file in the save_folder with a filename that is
+        of the form <basic_rs_file>'_mean_cmp_stats.pkl (or in a results store folder of the form
+        <basic_rs_file>_mean_cmp_stats if results_format is 'columnar').
+
+    """
+
+    # First, see if post-processed results exist for this file
+    save_path = _mean_cmp_save_path(ps)
+
+    if not os.path.exists(results_path(save_path, results_format)):
+
+        # Load basic results
+        basic_rs = load_results(Path(ps['save_folder']) / ps['basic_rs_file'])
+        if 'fields' in basic_rs:
+            stats_arrays = {k: basic_rs['fields']['full_stats.' + k] for k in ['beta', 'acm', 'n_grps', 'computed']}
+        else:
+            stats_arrays = {k: np.stack([s[k] for s in basic_rs['full_stats']])
+                            for k in ['beta', 'acm', 'n_grps', 'computed']}
+
+        # Perform stats
+        print('Done loading results from: ' + str(ps['basic_rs_file']))
+        rs = _mean_cmp_results(ps=ps, stats_arrays=stats_arrays, basic_rs=basic_rs, n_workers=n_workers,
+                               block_size=block_size, results_format=results_format)
+
+        # Now save our results
+        save_path = save_results(rs=rs, save_path=save_path, results_format=results_format)
+
+        print('Done.  Results saved to: ' + str(save_path))
+
+    else:
+        print('Found existing post-processed results. File: ' + str(save_path))
+
+
+# Helper functions go here
+
+def _extract_window_dff(subj_event_dff: dict, w_ps: dict) -> dict:
+    """ Extracts mean dff in one window for the events of all subjects.
+
+    subj_event_dff should hold, for each subject, the tuple (prefix_sums, event_index, event_starts, event_stops),
+    where prefix_sums are the dff prefix sums of the subject and event_index is the index of the subject's events in
+    the annotations table.
+
+    Returns a dictionary mapping the index of each event to the tuple (mn_vls, starts_within_event,
+    stops_within_event) calc_mean_dff_batch gives for it.
+    """
+    extracted_dff = dict()
+    for prefix_sums, event_index, event_starts, event_stops in subj_event_dff.values():
+        mn_vls, starts_within_event, stops_within_event = calc_mean_dff_batch(prefix_sums, event_starts, event_stops,
+                                                                              w_ps['window_type'],
+                                                                              w_ps['window_offset'],
+                                                                              w_ps['window_length'])
+        for e_i, index in enumerate(event_index):
+            extracted_dff[index] = (mn_vls[e_i], starts_within_event[e_i], stops_within_event[e_i])
+    return extracted_dff
+
+
+def _fit_init_models_for_window(ps: dict, annotations: pd.DataFrame, extracted_dff: dict, n_analyze_subjs: int,
+                                n_workers: int, block_size: int, results_format: str,
+                                compute_mean_cmp_stats: bool, lags: Sequence[int] = None) -> dict:
+    """ Performs the steps of fit_init_models after dff has been extracted for each event for one window.
+
+    Returns a dictionary with the entries 'rs', 'analyze_annotations' and 'mean_cmp_rs' (see fit_init_models).
+
+    If lags is not None, the dff extracted for each event should be of shape n_lags*n_rois and models are fit for each
+    lag.
+    """
 
     # ==================================================================================================================
-    # Remove any events where the $\Delta F /F$ window fell outside of the recorded data
+    # Remove any events where the $\Delta F /F$ window (or any lag) fell outside of the recorded data
 
-    bad_keys = [k for k, vl in extracted_dff.items() if np.all(np.isnan(vl[0]))]
+    bad_keys = [k for k, vl in extracted_dff.items() if np.any(np.all(np.isnan(vl[0]), axis=-1))]
     for key in bad_keys:
         del extracted_dff[key]
 
-    annotations.drop(bad_keys, axis='index', inplace=True)
+    annotations = annotations.drop(bad_keys, axis='index')
 
     # ==================================================================================================================
     # Put $\Delta F/F$ into annotations table
@@ -438,28 +691,28 @@ def fit_init_models(ps: dict):
     # Now actually calculate our statistics
     dff = np.stack(analyze_annotations['dff'].to_numpy())
 
-    n_analyze_subjs = len(analyze_subjs)
-    n_rois = dff.shape[1]
-    n_cpu = mp.cpu_count()
     if n_analyze_subjs > 1:
         print('Performing stats for multiple subjects.')
-        with mp.Pool(n_cpu) as pool:
-            full_stats = pool.starmap(_init_fit_multi_subj_stats_f, [(x, dff[:, r_i], g, ps['alpha']) for r_i in range(n_rois)])
-
     else:
         print('Performing stats for only one subject.')
-        with mp.Pool(n_cpu) as pool:
-            full_stats = pool.starmap(_init_fit_single_subj_stats_f, [(x, dff[:, r_i], g, ps['alpha']) for r_i in range(n_rois)])
+    if lags is not None:
+        # Fit all lags and rois at once, by treating each (lag, roi) pair as a separate response variable
+        n_lags, n_rois = dff.shape[1:]
+        stats_arrays = _fit_all_rois_arrays(x=x, dff=dff.reshape(n_events, n_lags*n_rois), g=g, alpha=ps['alpha'],
+                                            multi_subj=n_analyze_subjs > 1, n_workers=n_workers,
+                                            block_size=block_size)
+        lag_stats = _lag_stats_from_arrays(stats_arrays=stats_arrays, n_lags=n_lags, n_rois=n_rois)
+    else:
+        stats_arrays = _fit_all_rois_arrays(x=x, dff=dff, g=g, alpha=ps['alpha'], multi_subj=n_analyze_subjs > 1,
+                                            n_workers=n_workers, block_size=block_size)
 
-    # Here we do multiple comparisons corrections
-    p_vls = np.stack([s['non_zero_p'] for s in full_stats])
-    computed_p_vls = np.stack([s['computed'] for s in full_stats])
-    computed_p_vls_matrix = np.tile(computed_p_vls[:, np.newaxis], [1, p_vls.shape[1]])
-    corrected_p_vls_by, corrected_p_vls_bon = apply_multiple_comparisons_corrections(p_vls=p_vls,
-                                                                                     computed_p_vls=computed_p_vls_matrix)
-    for s_i, s in enumerate(full_stats):
-        s['non_zero_p_corrected_by'] = corrected_p_vls_by[s_i, :]
-        s['non_zero_p_corrected_bon'] = corrected_p_vls_bon[s_i, :]
+        # Here we do multiple comparisons corrections
+        p_vls = stats_arrays['non_zero_p']
+        computed_p_vls_matrix = np.tile(stats_arrays['computed'][:, np.newaxis], [1, p_vls.shape[1]])
+        corrected_p_vls_by, corrected_p_vls_bon = apply_multiple_comparisons_corrections(p_vls=p_vls,
+                                                                                         computed_p_vls=computed_p_vls_matrix)
+        full_stats_arrays = {**stats_arrays, 'non_zero_p_corrected_by': corrected_p_vls_by,
+                             'non_zero_p_corrected_bon': corrected_p_vls_bon}
 
     # ==================================================================================================================
     # Now we calculate mean for each transition we analyze
@@ -471,90 +724,156 @@ def fit_init_models(ps: dict):
     # ==================================================================================================================
     # Now save our results
 
-    rs = {'ps': ps, 'full_stats': full_stats, 'beh_trans': analyze_trans, 'var_names': mdl_vars,
+    rs = {'ps': ps, 'beh_trans': analyze_trans, 'var_names': mdl_vars,
           'n_subjs_per_trans': analyzed_n_subjs_per_trans, 'n_trans': analyzed_n_trans, 'mean_trans_vls': mean_trans_vls}
+    if lags is not None:
+        rs['lags'] = np.asarray(lags)
+        rs['lag_stats'] = lag_stats
+    elif results_format == 'columnar':
+        # Stats are saved as the arrays they were computed in, without splitting them up by roi
+        rs['fields'] = {'full_stats.' + k: vls for k, vls in full_stats_arrays.items()}
+    else:
+        rs['full_stats'] = unpack_batch_stats(full_stats_arrays)
 
     if ps['save_folder'] is not None:
-        save_path = Path(ps['save_folder']) / ps['save_name']
-        with open(save_path, 'wb') as f:
-            pickle.dump(rs, f)
+        basic_rs_path = save_results(rs=rs, save_path=Path(ps['save_folder']) / ps['save_name'],
+                                     results_format=results_format)
 
-    # Provide output
-    return rs, analyze_annotations
+    if not compute_mean_cmp_stats:
+        return {'rs': rs, 'analyze_annotations': analyze_annotations, 'mean_cmp_rs': None}
 
+    # ==================================================================================================================
+    # Compare coefficients to the mean of the others in their group, using the fit values we still have in memory
+    print('Performing mean comparison stats.')
+    mean_cmp_ps = {'save_folder': ps['save_folder'],
+                   'basic_rs_file': basic_rs_path.name if ps['save_folder'] is not None else None}
+    mean_cmp_rs = _mean_cmp_results(ps=mean_cmp_ps, stats_arrays=stats_arrays, basic_rs=rs, n_workers=n_workers,
+                                    block_size=block_size, results_format=results_format)
 
-def parallel_test_for_diff_than_mean_vls(ps: dict):
-    """ Post-processes fit models, comparing in parallel, if the mean for one transition is different that others.
+    if ps['save_folder'] is not None:
+        save_path = _mean_cmp_save_path(mean_cmp_ps)
+        save_results(rs=mean_cmp_rs, save_path=save_path, results_format=results_format)
 
-    See the function test_for_diff_than_mean_vls for details of statistical testing.
+    return {'rs': rs, 'analyze_annotations': analyze_annotations, 'mean_cmp_rs': mean_cmp_rs}
 
-    The main purpose of this function is to:
 
-     1) Load results from initial fitting a model
-
-     2) Check if post-processed results comparing means for the initial model fit exist.
+def _fit_all_rois(x: np.ndarray, dff: np.ndarray, g: np.ndarray, alpha: float, multi_subj: bool,
+                  n_workers: int = None, block_size: int = 1000) -> List[dict]:
+    """ Fits initial models to all rois in parallel, returning results in the list-of-dicts full_stats format.
 
-     3) If no post-processed results exist, to produce them, using parallel computation to speed up processing.
-
-    Args:
-
-        ps: Parameter dictionary specifying:
+    The dictionary for each roi has the same keys and types as those produced by _init_fit_multi_subj_stats_f and
+    _init_fit_single_subj_stats_f.
+    """
+    return unpack_batch_stats(_fit_all_rois_arrays(x=x, dff=dff, g=g, alpha=alpha, multi_subj=multi_subj,
+                                                   n_workers=n_workers, block_size=block_size))
 
-            save_folder: The folder with the results to be post-processed are saved as well as the folder in which
-            the new post-processed results will be saved
 
-            basic_rs_file: The file with the basic results, which are to be post_processed.
+def _fit_all_rois_arrays(x: np.ndarray, dff: np.ndarray, g: np.ndarray, alpha: float, multi_subj: bool,
+                         n_workers: int = None, block_size: int = 1000) -> dict:
+    """ Fits initial models to all rois in parallel, returning results as arrays with rois along the first dimension. """
+    n_rois = dff.shape[1]
+    out_specs = grouped_linear_regression_ols_batch_out_specs(n_rois=n_rois, n_vars=x.shape[1])
+    block_f = _init_fit_multi_subj_block_f if multi_subj else _init_fit_single_subj_block_f
+    return run_roi_blocks(block_f=block_f, in_arrays={'x': x, 'dff': dff, 'g': g}, out_specs=out_specs,
+                          n_rois=n_rois, n_workers=n_workers, block_size=block_size, f_kwargs={'alpha': alpha})
 
-    Returns:
 
-        None.  The post-processed results will be saved in a file in the save_folder with a filename that is
-        of the form <basic_rs_file>'_mean_cmp_stats.pkl
+def _lag_stats_from_arrays(stats_arrays: dict, n_lags: int, n_rois: int) -> dict:
+    """ Reshapes stats fit to all (lag, roi) pairs so rois are along the first dimension and lags the second.
 
+    Multiple comparisons corrections are also applied separately for each lag.
     """
+    lag_stats = {k: np.moveaxis(vls.reshape((n_lags, n_rois) + vls.shape[1:]), 0, 1)
+                 for k, vls in stats_arrays.items()}
 
-    # First, see if post-processed results exist for this file
-    save_folder = ps['save_folder']
-    save_name = ps['basic_rs_file'].split('.')[0] + '_mean_cmp_stats.pkl'
-    save_path = Path(save_folder) / save_name
+    n_vars = lag_stats['non_zero_p'].shape[2]
+    lag_stats['non_zero_p_corrected_by'] = np.full(lag_stats['non_zero_p'].shape, np.nan)
+    lag_stats['non_zero_p_corrected_bon'] = np.full(lag_stats['non_zero_p'].shape, np.nan)
+    for l_i in range(n_lags):
+        computed_p_vls = np.tile(lag_stats['computed'][:, l_i, np.newaxis], [1, n_vars])
+        corrected_p_vls_by, corrected_p_vls_bon = apply_multiple_comparisons_corrections(
+            p_vls=lag_stats['non_zero_p'][:, l_i, :], computed_p_vls=computed_p_vls)
+        lag_stats['non_zero_p_corrected_by'][:, l_i, :] = corrected_p_vls_by
+        lag_stats['non_zero_p_corrected_bon'][:, l_i, :] = corrected_p_vls_bon
 
-    if not os.path.exists(save_path):
+    return lag_stats
 
-        # Load basic results
-        with open(Path(ps['save_folder']) / ps['basic_rs_file'], 'rb') as f:
-            basic_rs = pickle.load(f)
 
-        # Perform stats
-        print('Done loading results from: ' + str(ps['basic_rs_file']))
-        var_names = basic_rs['var_names']
+def _mean_cmp_save_path(ps: dict) -> Path:
+    """ Gives the path post-processed mean comparison results are saved to for a set of basic results. """
+    return Path(ps['save_folder']) / (ps['basic_rs_file'].split('.')[0] + '_mean_cmp_stats.pkl')
 
-        n_cpu = mp.cpu_count()
-        with mp.Pool(n_cpu) as pool:
-            all_mean_stats = pool.starmap(test_for_diff_than_mean_vls,
-                                          [(s, var_names, 1e-10, ['beh_before', 'beh']) for s in basic_rs['full_stats']])
 
-        # Here we do multiple comparisons corrections
-        p_vls = np.stack([s['eq_mean_p'] for s in all_mean_stats])
-        computed_p_vls = np.stack([s['computed'] for s in all_mean_stats]).astype('bool')
-        corrected_p_vls_by, corrected_p_vls_bon = apply_multiple_comparisons_corrections(p_vls=p_vls,
-                                                                                         computed_p_vls=computed_p_vls)
-        for s_i, s in enumerate(all_mean_stats):
-            s['eq_mean_p_corrected_by'] = corrected_p_vls_by[s_i, :]
-            s['eq_mean_p_corrected_bon'] = corrected_p_vls_bon[s_i, :]
+def _mean_cmp_results(ps: dict, stats_arrays: dict, basic_rs: dict, n_workers: int = None,
+                      block_size: int = 1000, results_format: str = 'pickle') -> dict:
+    """ Computes mean comparison stats, with multiple comparisons corrections, and packages them for saving.
 
-        # Now save our results
-        rs = {'ps': ps, 'full_stats': all_mean_stats, 'var_names': var_names, 'n_trans': basic_rs['n_trans'],
-              'n_subjs_per_trans': basic_rs['n_subjs_per_trans']}
+    If results_format is 'columnar', the stats are packaged as arrays in a 'fields' entry (see results_to_store) in
+    place of the per-roi dictionaries of full_stats.
+    """
+    var_names = basic_rs['var_names']
+    mean_stats = _test_all_rois_for_diff_than_mean_vls(stats_arrays=stats_arrays, var_names=var_names,
+                                                       mn_th=1e-10, beh_groups=['beh_before', 'beh'],
+                                                       n_workers=n_workers, block_size=block_size)
 
-        with open(save_path, 'wb') as f:
-            pickle.dump(rs, f)
+    # Here we do multiple comparisons corrections
+    corrected_p_vls_by, corrected_p_vls_bon = apply_multiple_comparisons_corrections(
+        p_vls=mean_stats['eq_mean_p'], computed_p_vls=mean_stats['computed'].astype('bool'))
+    mean_stats['eq_mean_p_corrected_by'] = corrected_p_vls_by
+    mean_stats['eq_mean_p_corrected_bon'] = corrected_p_vls_bon
+
+    rs = {'ps': ps, 'var_names': var_names, 'n_trans': basic_rs['n_trans'],
+          'n_subjs_per_trans': basic_rs['n_subjs_per_trans']}
+    if results_format == 'columnar':
+        rs['fields'] = {'full_stats.' + k: vls for k, vls in mean_stats.items()}
+    else:
+        rs['full_stats'] = unpack_batch_stats(mean_stats)
+    return rs
 
-        print('Done.  Results saved to: ' + str(save_path))
 
-    else:
-        print('Found existing post-processed results. File: ' + str(save_path))
+def _test_all_rois_for_diff_than_mean_vls(stats_arrays: dict, var_names: list, mn_th: float, beh_groups: list,
+                                          n_workers: int = None, block_size: int = 1000) -> dict:
+    """ Computes the stats of test_for_diff_than_mean_vls for all rois, in parallel over blocks of rois.
 
+    stats_arrays should hold the beta, acm, n_grps and computed values of the initial fits for all rois, stacked
+    into arrays with rois along the first dimension.  The stats are returned in the same way, as a dictionary of
+    arrays with rois along the first dimension.
+    """
+    n_rois = len(stats_arrays['computed'])
+    n_vars = len(var_names)
+    in_arrays = {k: stats_arrays[k] for k in ['beta', 'acm', 'n_grps', 'computed']}
+    out_specs = {'beta': ((n_rois, n_vars), np.float64, np.nan),
+                 'eq_mean_p': ((n_rois, n_vars), np.float64, np.nan),
+                 'computed': ((n_rois, n_vars), np.float64, 0)}
+    return run_roi_blocks(block_f=_diff_than_mean_block_f, in_arrays=in_arrays, out_specs=out_specs,
+                          n_rois=n_rois, n_workers=n_workers, block_size=block_size,
+                          f_kwargs={'var_names': var_names, 'mn_th': mn_th, 'beh_groups': beh_groups})
+
+
+def _init_fit_multi_subj_block_f(in_arrays, out_arrays, rois, alpha):
+    stats = grouped_linear_regression_ols_batch(x=in_arrays['x'], y=in_arrays['dff'][:, rois], g=in_arrays['g'],
+                                                alpha=alpha)
+    for k, vl in stats.items():
+        out_arrays[k][rois] = vl
+
+
+def _init_fit_single_subj_block_f(in_arrays, out_arrays, rois, alpha):
+    for r_i in range(rois.start, rois.stop):
+        stats = _init_fit_single_subj_stats_f(in_arrays['x'], in_arrays['dff'][:, r_i], in_arrays['g'], alpha)
+        # c_ints are only returned for rois stats are computed for; they are otherwise left as nan
+        for k, vl in stats.items():
+            if k in out_arrays:
+                out_arrays[k][r_i] = vl
+
+
+def _diff_than_mean_block_f(in_arrays, out_arrays, rois, var_names, mn_th, beh_groups):
+    mean_stats = test_for_diff_than_mean_vls_batch(beta=in_arrays['beta'][rois], acm=in_arrays['acm'][rois],
+                                                   n_grps=in_arrays['n_grps'][rois],
+                                                   computed=in_arrays['computed'][rois],
+                                                   var_names=var_names, mn_th=mn_th, beh_groups=beh_groups)
+    for k in out_arrays.keys():
+        out_arrays[k][rois] = mean_stats[k]
 
-# Helper functions go here
 
 def _init_fit_multi_subj_stats_f(x_i, y_i, g_i, alpha_i, y_std_th=1E-10):
 
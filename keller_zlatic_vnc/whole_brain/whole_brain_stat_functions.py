@@ -5,7 +5,7 @@ import os
 import os.path
 from pathlib import Path
 import pickle
-from typing import Sequence, Tuple
+from typing import List, Sequence, Tuple
 
 import numpy as np
 import matplotlib.cm
@@ -29,11 +29,21 @@ from keller_zlatic_vnc.data_processing import extract_transitions
 from keller_zlatic_vnc.linear_modeling import one_hot_from_table
 from keller_zlatic_vnc.visualization import gen_coef_p_vl_cmap
 from keller_zlatic_vnc.visualization import visualize_coef_p_vl_max_projs
+from keller_zlatic_vnc.whole_brain.batched_stats import grouped_linear_regression_ols_batch
+from keller_zlatic_vnc.whole_brain.batched_stats import grouped_linear_regression_ols_batch_out_specs
+from keller_zlatic_vnc.whole_brain.batched_stats import paired_grouped_perm_test_batch
+from keller_zlatic_vnc.whole_brain.parallel import run_roi_blocks
+from keller_zlatic_vnc.whole_brain.results_store import save_results
+
+# The keys of the per-roi stats dictionaries saved in full_stats by the whole brain testing functions
+_SERIAL_STATS_KEYS = ('non_zero_p', 'c_ints', 'beta')
 
 
 def whole_brain_other_ref_testing(data_file: Path, test_type: str, cut_off_time: float, manip_type: str,
                                    save_folder: Path, save_str: str, min_n_subjects_per_beh: int = 3,
-                                   beh_ref: str = 'Q', combine_turns_for_analysis: bool = False, alpha: float = .05) -> Path:
+                                   beh_ref: str = 'Q', combine_turns_for_analysis: bool = False, alpha: float = .05,
+                                   engine: str = 'serial', n_jobs: int = 1, block_size: int = 1000,
+                                   results_format: str = 'pickle') -> Path:
     """ Runs tests of a particular type across all voxels in the brain, comparing one condition vs all others.
 
     Test results will be saved in a file.
@@ -71,6 +81,19 @@ def whole_brain_other_ref_testing(data_file: Path, test_type: str, cut_off_time:
 
         alpha: The alpha level for thresholding significance
 
+        engine: The engine to fit models with.  Either:
+            'serial' - models are fit one roi at a time in the calling process
+            'batched' - models are fit for blocks of rois at once with batched matrix operations, spread across
+            n_jobs worker processes.  Results are the same as with the serial engine.
+
+        n_jobs: The number of worker processes to use with the batched engine.  If None, the number of cpus on the
+        machine will be used.
+
+        block_size: The number of rois each worker fits models for at a time with the batched engine.
+
+        results_format: The format to save results in.  Either 'pickle' or 'columnar' (see the results_store
+        module).  Columnar results are saved in a folder instead of a .pkl file.
+
     Returns:
 
         The path to the saved results.
@@ -78,10 +101,13 @@ def whole_brain_other_ref_testing(data_file: Path, test_type: str, cut_off_time:
     Raises:
         ValueError: If manip_type is not one of the expected strings.
         ValueError: If test_type is not one of the expected strings.
+        ValueError: If engine is not one of the expected strings.
 
     """
     if (manip_type != 'A4') and (manip_type != 'A9') and (manip_type != 'both'):
         raise(ValueError('manip_type must be one of the following strings: A4, A9, both'))
+    if (engine != 'serial') and (engine != 'batched'):
+        raise(ValueError('engine must be one of the following strings: serial, batched'))
 
     # Load data
     with open(data_file, 'rb') as f:
@@ -171,20 +197,12 @@ def whole_brain_other_ref_testing(data_file: Path, test_type: str, cut_off_time:
     else:
         raise (ValueError('The test_type ' + test_type + ' is not recognized.'))
 
-    # Define a function for calculate stats
-    def stats_f(x_i, y_i, g_i, alpha_i):
-        beta, acm, n_grps = grouped_linear_regression_ols_estimator(x=x_i, y=y_i, g=g_i)
-        stats = grouped_linear_regression_acm_stats(beta=beta, acm=acm, n_grps=n_grps, alpha=alpha_i)
-        stats['beta'] = beta
-        return stats
-
     # Calculate stats
     n_rois = dff.shape[1]
     n_test_behs = len(test_behs)
     full_stats = dict()
-    for b_i, b in enumerate(test_behs):
-        print('Running tests for behavior ' + str(b_i + 1) + ' of ' + str(n_test_behs) + ': ' + b)
-
+    beh_designs = dict()
+    for b in test_behs:
         control_behs_ref = list(set(control_behs).difference(beh_ref))
 
         if (test_type == 'state_dependence') or (test_type == 'before_reporting'):
@@ -198,18 +216,40 @@ def whole_brain_other_ref_testing(data_file: Path, test_type: str, cut_off_time:
             raise (ValueError('The test_type ' + test_type + ' is not recognized.'))
 
         one_hot_data_ref = np.concatenate([one_hot_data_ref, np.ones([one_hot_data_ref.shape[0], 1])], axis=1)
-
-        full_stats[b] = [(stats_f(x_i=one_hot_data_ref, y_i=dff[:, r_i], g_i=g, alpha_i=alpha), pull_ind)
-                         for r_i in range(n_rois)]
+        beh_designs[b] = (one_hot_data_ref, pull_ind)
+
+    # With the batched engine and columnar results, stats for all rois are saved as the arrays they are computed in
+    save_arrays = (engine == 'batched') and (results_format == 'columnar')
+    if engine == 'serial':
+        for b_i, (b, (one_hot_data_ref, pull_ind)) in enumerate(beh_designs.items()):
+            print('Running tests for behavior ' + str(b_i + 1) + ' of ' + str(n_test_behs) + ': ' + b)
+            full_stats[b] = [(_fit_roi_stats_f(x_i=one_hot_data_ref, y_i=dff[:, r_i], g_i=g, alpha_i=alpha), pull_ind)
+                             for r_i in range(n_rois)]
+    elif save_arrays:
+        print('Running tests for all ' + str(n_test_behs) + ' behaviors with the batched engine.')
+        beh_arrays = _fit_designs_all_rois_arrays(xs=[d[0] for d in beh_designs.values()], dff=dff, g=g, alpha=alpha,
+                                                  n_jobs=n_jobs, block_size=block_size)
+        full_stats = dict(zip(beh_designs.keys(), beh_arrays))
+    else:
+        print('Running tests for all ' + str(n_test_behs) + ' behaviors with the batched engine.')
+        beh_rs = _fit_designs_all_rois(xs=[d[0] for d in beh_designs.values()], dff=dff, g=g, alpha=alpha,
+                                       n_jobs=n_jobs, block_size=block_size)
+        for (b, (_, pull_ind)), b_rs in zip(beh_designs.items(), beh_rs):
+            full_stats[b] = [(b_rs[r_i], pull_ind) for r_i in range(n_rois)]
 
     # Package results
     beh_stats = dict()
     for b in test_behs:
         beh_stats[b] = dict()
-        beh_stats[b]['p_values'] = [rs_dict['non_zero_p'][rs_pull_ind]
+        if save_arrays:
+            pull_ind = beh_designs[b][1]
+            beh_stats[b]['p_values'] = full_stats[b]['non_zero_p'][:, pull_ind]
+            beh_stats[b]['beta'] = full_stats[b]['beta'][:, pull_ind]
+        else:
+            beh_stats[b]['p_values'] = [rs_dict['non_zero_p'][rs_pull_ind]
+                                        for (rs_dict, rs_pull_ind) in full_stats[b]]
+            beh_stats[b]['beta'] = [rs_dict['beta'][rs_pull_ind]
                                     for (rs_dict, rs_pull_ind) in full_stats[b]]
-        beh_stats[b]['beta'] = [rs_dict['beta'][rs_pull_ind]
-                                for (rs_dict, rs_pull_ind) in full_stats[b]]
 
     # Save results
     save_name = save_str + '_' + data_file.stem + '.pkl'
@@ -223,12 +263,16 @@ def whole_brain_other_ref_testing(data_file: Path, test_type: str, cut_off_time:
 
     rs = dict()
     rs['beh_stats'] = beh_stats
-    rs['full_stats'] = full_stats
+    if save_arrays:
+        rs['fields'] = {'full_stats.' + b + '.' + k: vls for b, b_stats in full_stats.items()
+                        for k, vls in b_stats.items()}
+        rs['full_stats_pull_inds'] = {b: pull_ind for b, (_, pull_ind) in beh_designs.items()}
+    else:
+        rs['full_stats'] = full_stats
     rs['trans_table'] = trans_table
     rs['ps'] = ps
 
-    with open(save_path, 'wb') as f:
-        pickle.dump(rs, f)
+    save_path = save_results(rs=rs, save_path=save_path, results_format=results_format)
 
     print('Saved results to: ' + str(save_path))
 
@@ -238,7 +282,8 @@ def whole_brain_other_ref_testing(data_file: Path, test_type: str, cut_off_time:
 def whole_brain_single_ref_testing(data_file: Path, test_type: str, cut_off_time: float, manip_type: str,
                                    save_folder: Path, save_str: str, min_n_subjects_per_beh: int = 3,
                                    beh_ref: str = 'Q', combine_turns_for_analysis: bool = False,
-                                   alpha: float = .05) -> Path:
+                                   alpha: float = .05, engine: str = 'serial', n_jobs: int = 1,
+                                   block_size: int = 1000, results_format: str = 'pickle') -> Path:
     """ Runs tests of a particular type across all voxels in the brain, comparing one condition vs another.
 
     Test results will be saved in a file.
@@ -276,6 +321,19 @@ def whole_brain_single_ref_testing(data_file: Path, test_type: str, cut_off_time
 
         alpha: The alpha level for thresholding significance
 
+        engine: The engine to fit models with.  Either:
+            'serial' - models are fit one roi at a time in the calling process
+            'batched' - models are fit for blocks of rois at once with batched matrix operations, spread across
+            n_jobs worker processes.  Results are the same as with the serial engine.
+
+        n_jobs: The number of worker processes to use with the batched engine.  If None, the number of cpus on the
+        machine will be used.
+
+        block_size: The number of rois each worker fits models for at a time with the batched engine.
+
+        results_format: The format to save results in.  Either 'pickle' or 'columnar' (see the results_store
+        module).  Columnar results are saved in a folder instead of a .pkl file.
+
     Returns:
 
         The path to the saved results.
@@ -283,10 +341,13 @@ def whole_brain_single_ref_testing(data_file: Path, test_type: str, cut_off_time
     Raises:
         ValueError: If manip_type is not one of the expected strings.
         ValueError: If test_type is not one of the expected strings.
+        ValueError: If engine is not one of the expected strings.
 
     """
     if (manip_type != 'A4') and (manip_type != 'A9') and (manip_type != 'both'):
         raise(ValueError('manip_type must be one of the following strings: A4, A9, both'))
+    if (engine != 'serial') and (engine != 'batched'):
+        raise(ValueError('engine must be one of the following strings: serial, batched'))
 
     # Load data
     with open(data_file, 'rb') as f:
@@ -363,13 +424,6 @@ def whole_brain_single_ref_testing(data_file: Path, test_type: str, cut_off_time
     for u_i, u_id in enumerate(unique_ids):
         g[data['subject_id'] == u_id] = u_i
 
-    # Define a function for calculating stats
-    def stats_f(x_i, y_i, g_i, alpha_i):
-        beta, acm, n_grps = grouped_linear_regression_ols_estimator(x=x_i, y=y_i, g=g_i)
-        stats = grouped_linear_regression_acm_stats(beta=beta, acm=acm, n_grps=n_grps, alpha=alpha_i)
-        stats['beta'] = beta
-        return stats
-
     # Fit models and calculate stats
     before_behs_ref = list(set(before_behs).difference(beh_ref))
     after_behs_ref = list(set(after_behs).difference(beh_ref))
@@ -384,7 +438,18 @@ def whole_brain_single_ref_testing(data_file: Path, test_type: str, cut_off_time
     one_hot_vars_ref = one_hot_vars_ref + ['ref']
 
     n_rois = dff.shape[1]
-    full_stats = [stats_f(x_i=one_hot_data_ref, y_i=dff[:, r_i], g_i=g, alpha_i=alpha) for r_i in range(n_rois)]
+
+    # With the batched engine and columnar results, stats for all rois are saved as the arrays they are computed in
+    save_arrays = (engine == 'batched') and (results_format == 'columnar')
+    if engine == 'serial':
+        full_stats = [_fit_roi_stats_f(x_i=one_hot_data_ref, y_i=dff[:, r_i], g_i=g, alpha_i=alpha)
+                      for r_i in range(n_rois)]
+    elif save_arrays:
+        full_stats = _fit_designs_all_rois_arrays(xs=[one_hot_data_ref], dff=dff, g=g, alpha=alpha, n_jobs=n_jobs,
+                                                  block_size=block_size)[0]
+    else:
+        full_stats = _fit_designs_all_rois(xs=[one_hot_data_ref], dff=dff, g=g, alpha=alpha, n_jobs=n_jobs,
+                                           block_size=block_size)[0]
 
     # Package results
     if (test_type == 'state_dependence') or (test_type == 'before_reporting'):
@@ -400,8 +465,12 @@ def whole_brain_single_ref_testing(data_file: Path, test_type: str, cut_off_time
     beh_stats = dict()
     for b, p_i in zip(test_behs, pull_inds):
         beh_stats[b] = dict()
-        beh_stats[b]['p_values'] = [rs_dict['non_zero_p'][p_i] for rs_dict in full_stats]
-        beh_stats[b]['beta'] = [rs_dict['beta'][p_i] for rs_dict in full_stats]
+        if save_arrays:
+            beh_stats[b]['p_values'] = full_stats['non_zero_p'][:, p_i]
+            beh_stats[b]['beta'] = full_stats['beta'][:, p_i]
+        else:
+            beh_stats[b]['p_values'] = [rs_dict['non_zero_p'][p_i] for rs_dict in full_stats]
+            beh_stats[b]['beta'] = [rs_dict['beta'][p_i] for rs_dict in full_stats]
 
     # Save results
     save_name = save_str + '_' + data_file.stem + '.pkl'
@@ -415,12 +484,14 @@ def whole_brain_single_ref_testing(data_file: Path, test_type: str, cut_off_time
 
     rs = dict()
     rs['beh_stats'] = beh_stats
-    rs['full_stats'] = full_stats
+    if save_arrays:
+        rs['fields'] = {'full_stats.' + k: vls for k, vls in full_stats.items()}
+    else:
+        rs['full_stats'] = full_stats
     rs['trans_table'] = trans_table
     rs['ps'] = ps
 
-    with open(save_path, 'wb') as f:
-        pickle.dump(rs, f)
+    save_path = save_results(rs=rs, save_path=save_path, results_format=results_format)
 
     print('Saved results to: ' + str(save_path))
 
@@ -617,7 +688,7 @@ g
         log_p_vls_image = np.zeros(im_shape, dtype=np.float32)
 
         coefs = rs['beh_stats'][var_name]['beta']
-        p_vls = rs['beh_stats'][var_name]['p_values']
+        p_vls = np.array(rs['beh_stats'][var_name]['p_values'])  # Copy, since results may be memory mapped
         p_vls[np.isnan(p_vls)] = 1.0 # Make sure we visualize any nan p-values as non-significant
         log_p_vls = np.log10(p_vls)
         log_p_vls[np.asarray(p_vls) == 0] = -100.0
@@ -755,7 +826,9 @@ g
 
 
 def whole_brain_stimulus_dep_testing(data_file: Path, manip_type: str, save_folder: Path, save_str: str,
-                               n_perms:int = 10000, pool=None) -> Path:
+                               n_perms:int = 10000, pool=None, results_format: str = 'pickle',
+                               engine: str = 'serial', seed: int = None, perm_block_size: int = 100,
+                               record_max_stats: bool = False, seq_alpha: float = None) -> Path:
     """ Runs tests for stimlus dependence across all voxels in the brain.
 
     Test results will be saved in a file.
@@ -776,16 +849,51 @@ def whole_brain_stimulus_dep_testing(data_file: Path, manip_type: str, save_fold
 
         n_perms: The number of permutation tests to run
 
+        pool: A multiprocessing pool to run tests for rois in parallel with, when using the serial engine.  If None,
+        tests will be run in the calling process.
+
+        results_format: The format to save results in.  Either 'pickle' or 'columnar' (see the results_store
+        module).  Columnar results are saved in a folder instead of a .pkl file.
+
+        engine: The engine to run permutation tests with.  Either:
+            'serial' - each roi is tested on its own with paired_grouped_perm_test, drawing its own permutations
+            'batched' - all rois are tested at once with paired_grouped_perm_test_batch, using a single set of
+            sign flips shared by all rois
+
+        seed: Seed for generating the sign flips with the batched engine.  Results with the batched engine are
+        reproducible for a given seed.
+
+        perm_block_size: The number of permutations to compute statistics for at once with the batched engine.  Memory
+        use is on the order of perm_block_size times the number of rois.
+
+        record_max_stats: True if the maximum statistic across rois should be recorded for each permutation and used
+        to compute FWER adjusted p-values (see paired_grouped_perm_test_batch).  These are saved in the 'p_values_fwer'
+        entry of the beh_stats in the results and the max statistics in the 'perm_max_stats' entry of the results
+        themselves (not of the beh_stats).  Requires the batched engine.
+
+        seq_alpha: If not None, permutations for each roi are stopped early once the p-value for the roi could not
+        be less than or equal to seq_alpha (see paired_grouped_perm_test_batch).  The number of permutations used for
+        each roi is saved in the 'n_perms_used' entry of the beh_stats in the results.  Requires the batched engine and
+        cannot be used with record_max_stats.
+
     Returns:
 
         The path to the saved results.
 
     Raises:
         ValueError: If manip_type is not one of the expected strings.
+        ValueError: If engine is not one of the expected strings.
+        ValueError: If record_max_stats is True or seq_alpha is not None and engine is not 'batched'.
 
     """
     if (manip_type != 'A4') and (manip_type != 'A9') and (manip_type != 'both'):
         raise(ValueError('manip_type must be one of the following strings: A4, A9, both'))
+    if (engine != 'serial') and (engine != 'batched'):
+        raise(ValueError('engine must be one of the following strings: serial, batched'))
+    if record_max_stats and engine != 'batched':
+        raise(ValueError('record_max_stats requires the batched engine'))
+    if (seq_alpha is not None) and engine != 'batched':
+        raise(ValueError('seq_alpha requires the batched engine'))
 
     # Load data
     with open(data_file, 'rb') as f:
@@ -814,30 +922,41 @@ def whole_brain_stimulus_dep_testing(data_file: Path, manip_type: str, save_fold
     # Calculate stats
     n_rois = dff_before.shape[1]
 
-    par_input = [(dff_before[:, r_i], dff_after[:, r_i], g, n_perms) for r_i in range(n_rois)]
-    full_stats = pool.starmap(_stim_stats_f, par_input)
-
-
-    #full_stats = [_stim_stats_f(dff_base=dff_before[:, r_i], dff_cmp=dff_after[:, r_i], g_i=g, n_perms_i=n_perms)
-    #              for r_i in range(n_rois)]
-
-    # Package results
-    beh_stats = {'stim': {'p_values': [d['p'] for d in full_stats],
-                          'beta': [d['beta'] for d in full_stats]}}
+    if engine == 'serial':
+        par_input = [(dff_before[:, r_i], dff_after[:, r_i], g, n_perms) for r_i in range(n_rois)]
+        if pool is not None:
+            full_stats = pool.starmap(_stim_stats_f, par_input)
+        else:
+            full_stats = [_stim_stats_f(*inputs) for inputs in par_input]
+        beh_stats = {'stim': {'p_values': [d['p'] for d in full_stats],
+                              'beta': [d['beta'] for d in full_stats]}}
+    else:
+        perm_stats = paired_grouped_perm_test_batch(x0=dff_before, x1=dff_after, grp_ids=g, n_perms=n_perms,
+                                                    seed=seed, perm_block_size=perm_block_size,
+                                                    record_max_stats=record_max_stats, seq_alpha=seq_alpha)
+        p_vls = perm_stats['p']
+        p_vls[p_vls == 0] = 1/n_perms
+        beh_stats = {'stim': {'p_values': list(p_vls), 'beta': list(perm_stats['beta'])}}
+        if seq_alpha is not None:
+            beh_stats['stim']['n_perms_used'] = list(perm_stats['n_perms_used'])
+        if record_max_stats:
+            beh_stats['stim']['p_values_fwer'] = list(perm_stats['p_fwer'])
 
     # Save results
     save_name = save_str + '_' + data_file.stem + '.pkl'
     save_path = Path(save_folder) / save_name
 
     ps = {'data_file': data_file, 'manip_type': manip_type, 'save_folder': save_folder, 'save_str': save_str,
-          'n_perms': n_perms}
+          'n_perms': n_perms, 'engine': engine, 'seed': seed, 'record_max_stats': record_max_stats,
+          'seq_alpha': seq_alpha}
 
     rs = dict()
     rs['beh_stats'] = beh_stats
     rs['ps'] = ps
+    if record_max_stats:
+        rs['perm_max_stats'] = perm_stats['max_stats']
 
-    with open(save_path, 'wb') as f:
-        pickle.dump(rs, f)
+    save_path = save_results(rs=rs, save_path=save_path, results_format=results_format)
 
     print('Saved results to: ' + str(save_path))
 
@@ -1063,6 +1182,55 @@ def test_for_largest_amplitude_beta(beta: np.ndarray, acm: np.ndarray, n_grps: i
 # Helper functions go here
 
 
+def _fit_roi_stats_f(x_i, y_i, g_i, alpha_i):
+    """ Fits a grouped linear regression model to the dff of one roi and computes stats for it. """
+    beta, acm, n_grps = grouped_linear_regression_ols_estimator(x=x_i, y=y_i, g=g_i)
+    stats = grouped_linear_regression_acm_stats(beta=beta, acm=acm, n_grps=n_grps, alpha=alpha_i)
+    stats['beta'] = beta
+    return stats
+
+
+def _fit_designs_all_rois(xs: Sequence[np.ndarray], dff: np.ndarray, g: np.ndarray, alpha: float, n_jobs: int,
+                          block_size: int) -> List[List[dict]]:
+    """ Fits grouped linear regression models for one or more designs to all rois with the batched engine.
+
+    Returns a list with one entry per design.  Each entry is a list of dictionaries, one per roi, with the same keys
+    and values as those produced by _fit_roi_stats_f ('non_zero_p', 'c_ints' and 'beta').
+    """
+    return [[{k: x_stats[k][r_i] for k in _SERIAL_STATS_KEYS} for r_i in range(dff.shape[1])]
+            for x_stats in _fit_designs_all_rois_arrays(xs=xs, dff=dff, g=g, alpha=alpha, n_jobs=n_jobs,
+                                                        block_size=block_size)]
+
+
+def _fit_designs_all_rois_arrays(xs: Sequence[np.ndarray], dff: np.ndarray, g: np.ndarray, alpha: float,
+                                 n_jobs: int, block_size: int) -> List[dict]:
+    """ Fits models for one or more designs to all rois, returning stats as arrays with rois along the first dimension.
+
+    Returns a list with one dictionary per design, with the keys 'non_zero_p', 'c_ints' and 'beta'.
+    """
+    n_rois = dff.shape[1]
+    in_arrays = {'dff': dff, 'g': g}
+    out_specs = dict()
+    for x_i, x in enumerate(xs):
+        in_arrays['x_' + str(x_i)] = x
+        x_specs = grouped_linear_regression_ols_batch_out_specs(n_rois=n_rois, n_vars=x.shape[1])
+        out_specs.update({k + '_' + str(x_i): x_specs[k] for k in _SERIAL_STATS_KEYS})
+
+    rs = run_roi_blocks(block_f=_fit_designs_block_f, in_arrays=in_arrays, out_specs=out_specs, n_rois=n_rois,
+                        n_workers=n_jobs, block_size=block_size, f_kwargs={'n_designs': len(xs), 'alpha': alpha})
+
+    return [{k: rs[k + '_' + str(x_i)] for k in _SERIAL_STATS_KEYS} for x_i in range(len(xs))]
+
+
+def _fit_designs_block_f(in_arrays, out_arrays, rois, n_designs, alpha):
+    for x_i in range(n_designs):
+        # Stats are computed for all rois, no matter their variance, to match the serial engine
+        stats = grouped_linear_regression_ols_batch(x=in_arrays['x_' + str(x_i)], y=in_arrays['dff'][:, rois],
+                                                    g=in_arrays['g'], alpha=alpha, y_std_th=-np.inf)
+        for k in _SERIAL_STATS_KEYS:
+            out_arrays[k + '_' + str(x_i)][rois] = stats[k]
+
+
 def _stim_stats_f(dff_base, dff_cmp, g_i, n_perms_i):
     beta, p = paired_grouped_perm_test(x0=dff_base, x1=dff_cmp, grp_ids=g_i, n_perms=n_perms_i)
     if p == 0:
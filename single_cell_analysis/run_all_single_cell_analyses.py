@@ -20,10 +20,9 @@ from janelia_core.stats.regression import visualize_coefficient_stats
 from keller_zlatic_vnc.data_processing import calc_dff
 from keller_zlatic_vnc.data_processing import count_unique_subjs_per_transition
 from keller_zlatic_vnc.data_processing import down_select_events
-from keller_zlatic_vnc.data_processing import find_before_and_after_events
 from keller_zlatic_vnc.data_processing import generate_standard_id_for_full_annots
-from keller_zlatic_vnc.data_processing import read_full_annotations
 from keller_zlatic_vnc.data_processing import read_raw_transitions_from_excel
+from keller_zlatic_vnc.data_processing import read_stimulus_annotations
 from keller_zlatic_vnc.data_processing import read_trace_data
 from keller_zlatic_vnc.data_processing import single_cell_extract_dff_with_anotations
 from keller_zlatic_vnc.linear_modeling import one_hot_from_table
@@ -224,7 +223,7 @@ annot_file_names = [Path(p).name for p in annot_file_paths]
 annot_subjs = [generate_standard_id_for_full_annots(fn) for fn in annot_file_names]
 
 # Get stimulus events for each subject we analyze
-subj_events = pd.DataFrame()
+subj_events = []
 
 for subj in list(data['subject_id'].unique()):
 
@@ -235,20 +234,12 @@ for subj in list(data['subject_id'].unique()):
     else:
         ind = ind[0][0]
 
-    # Load the annotations for this subject
-    tbl = read_full_annotations(annot_file_paths[ind])
-
     # Pull out stimulus events for this subject, noting what comes before and after
-    stim_tbl = copy.deepcopy(tbl[tbl['beh'] == 'S'])
-    stim_tbl.insert(0, 'subject_id', subj)
-    stim_tbl.insert(1, 'event_id', range(stim_tbl.shape[0]))
-    if a4_files[ind] == True:
-        stim_tbl.insert(2, 'manipulation_tgt', 'A4')
-    else:
-        stim_tbl.insert(2, 'manipulation_tgt', 'A9')
-    before_after_tbl = find_before_and_after_events(events=stim_tbl, all_events=tbl)
-    stim_annots = pd.concat([stim_tbl, before_after_tbl], axis=1)
-    subj_events = subj_events.append(stim_annots, ignore_index=True)
+    manipulation_tgt = 'A4' if a4_files[ind] == True else 'A9'
+    subj_events.append(read_stimulus_annotations(annot_file_paths[ind], subject_id=subj,
+                                                 manipulation_tgt=manipulation_tgt))
+
+subj_events = pd.concat(subj_events, ignore_index=True)
 
 # ======================================================================================================================
 # Get rid of any events where we could not classify the type of preceeding or succeeding behavior
@@ -117,11 +117,33 @@ base_ps['save_folder'] = r'A:\projects\keller_vnc\results\single_subject\new_mod
 # and a unique number (generated from the time) appended
 base_ps['save_str'] = 'rois_1_5_5'
 
+# True if we should compare coefficients to the mean of the others in their group in the same pass as fitting (saving
+# the same results find_vls_different_than_other_mean.py would, so that script does not need to reload the fits)
+compute_mean_cmp_stats = True
+
 # ======================================================================================================================
 # Generate dictionaries for all combinations of parameters
+#
+# Models for all windows are fit in a single pass for each combination of the other parameters, so data only needs to be
+# loaded once for each of these combinations
 # ======================================================================================================================
 
-comb_ps = form_combinations_from_dict(base_ps)
+window_keys = ['window_offset', 'window_length']
+
+comb_ps = form_combinations_from_dict({k: vl for k, vl in base_ps.items() if k not in window_keys})
+window_combs = form_combinations_from_dict({k: base_ps[k] for k in window_keys})
+
+
+def save_pickup_file(w_ps: dict):
+    """ Saves the parameter dictionary for a window as a seperate file, as soon as results for the window are saved.
+
+    This is so we can pick back up if this script crashes while fitting models for later windows.
+    """
+    pickup_file = Path(w_ps['save_folder']) / ('.' + w_ps['save_name'])
+    with open(pickup_file, 'wb') as f:
+        pickle.dump(w_ps, f)
+    print('Analysis complete.  Results saved to: ' + str(Path(w_ps['save_folder']) / w_ps['save_name']))
+
 
 # ======================================================================================================================
 # Fit models for all combinations of parameters
@@ -145,29 +167,22 @@ if __name__ == '__main__':
         print('Performing analysis ' + str(c_i + 1) + ' of ' + str(len(comb_ps)) + '.')
         print('===========================================================================================================')
 
-        # Before actually running results for this set of parameters, see if a set of results already exists in the save
-        # folder.
-
         # Remove the save_str field from ps here, since we don't want to save it (we replace with with save_name)
         save_str = ps['save_str']
         del ps['save_str']
 
-        results_exist = False
-        for d in existing_param_dicts:
-            if ps == d:
-                results_exist = True
-                break
-
-        if not results_exist:
-            ps['save_name'] = append_ts(save_str, no_underscores=True) + '.pkl'
+        # Before actually running results for this set of parameters, see which windows we already have results for in
+        # the save folder.
+        window_specs = [w for w in window_combs if not any([{**ps, **w} == d for d in existing_param_dicts])]
 
-            fit_init_models(ps)
+        if len(window_specs) > 0:
+            ts_str = append_ts(save_str, no_underscores=True)
+            window_specs = [{**w, 'save_name': ts_str + '_w' + str(w_i) + '.pkl'} for w_i, w in enumerate(window_specs)]
+            if len(window_specs) < len(window_combs):
+                print('Discovered existing results for ' + str(len(window_combs) - len(window_specs)) + ' windows.')
 
-            # Save the parameter dictionary as a seperate file - this is so we can pick back up if this script crashes
-            pickup_file = Path(ps['save_folder']) / ('.' + ps['save_name'])
-            with open(pickup_file, 'wb') as f:
-                pickle.dump(ps, f)
-            print('Analysis complete.  Results saved to: ' + str(Path(ps['save_folder']) / ps['save_name']))
+            fit_init_models(ps, compute_mean_cmp_stats=compute_mean_cmp_stats, window_specs=window_specs,
+                            window_done_f=save_pickup_file)
         else:
             print('Discovered existing results.  ')
 
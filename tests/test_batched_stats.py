@@ -0,0 +1,128 @@
+""" Tests for the batched_stats module.
+
+Batched statistics are compared to the per-ROI functions they replace on random data.
+"""
+
+import numpy as np
+import pytest
+
+from keller_zlatic_vnc.whole_brain import batched_stats
+from keller_zlatic_vnc.whole_brain import spontaneous
+from keller_zlatic_vnc.whole_brain import whole_brain_stat_functions
+
+
+def _gen_fit_data(n_subjs=8, n_smps_per_subj=10, n_vars=4, n_rois=15, seed=0):
+    rng = np.random.default_rng(seed)
+    n_smps = n_subjs*n_smps_per_subj
+    x = np.concatenate([rng.standard_normal([n_smps, n_vars - 1]), np.ones([n_smps, 1])], axis=1)
+    y = np.matmul(x, rng.standard_normal([n_vars, n_rois])) + rng.standard_normal([n_smps, n_rois])
+    y[:, 0] = 1.0  # An roi without variance, which stats should not be computed for
+    g = np.repeat(np.arange(n_subjs), n_smps_per_subj)
+    return x, y, g
+
+
+def _assert_same_roi_stats(a, b):
+    assert set(a.keys()) == set(b.keys())
+    for k in a.keys():
+        assert type(a[k]) == type(b[k]) or (np.isscalar(a[k]) and np.isscalar(b[k]))
+        np.testing.assert_allclose(a[k], b[k], rtol=1e-7, atol=1e-10, equal_nan=True)
+
+
+def _ref_paired_grouped_perm_test(x0, x1, grp_ids, flips):
+    """ Computes permutation p-values one variable at a time, using a given set of sign flips. """
+    grps, grp_inds = np.unique(grp_ids, return_inverse=True)
+    n_smps, n_vars = x0.shape
+    beta = np.zeros(n_vars)
+    p_vls = np.zeros(n_vars)
+    std_stats = np.zeros([len(flips) + 1, n_vars])
+    for v_i in range(n_vars):
+        grp_sums = np.asarray([np.sum(x1[grp_inds == g_i, v_i] - x0[grp_inds == g_i, v_i])
+                               for g_i in range(len(grps))])
+        beta[v_i] = np.sum(grp_sums)/n_smps
+        perm_vls = np.abs(np.matmul(flips, grp_sums)/n_smps)
+        p_vls[v_i] = np.mean(perm_vls >= np.abs(beta[v_i])*(1 - 1E-10))
+        null_std = np.sqrt(np.sum(grp_sums**2))
+        std_stats[:, v_i] = np.concatenate([[np.abs(beta[v_i])], perm_vls])*n_smps/null_std
+    return beta, p_vls, std_stats
+
+
+@pytest.mark.parametrize('block_size', [1, 4, 100])
+def test_grouped_ols_batch_matches_per_roi_fits(block_size):
+    x, y, g = _gen_fit_data()
+    batch_stats = batched_stats.unpack_batch_stats(
+        batched_stats.grouped_linear_regression_ols_batch(x=x, y=y, g=g, alpha=.05, block_size=block_size))
+
+    for r_i in range(y.shape[1]):
+        _assert_same_roi_stats(batch_stats[r_i], spontaneous._init_fit_multi_subj_stats_f(x, y[:, r_i], g, .05))
+    assert not batch_stats[0]['computed']
+    assert 'c_ints' not in batch_stats[0]
+
+
+def test_diff_than_mean_batch_matches_per_roi_tests():
+    x, y, g = _gen_fit_data(n_vars=6)
+    var_names = ['before_F', 'before_B', 'before_Q', 'after_F', 'after_B', 'ref']
+    fit_stats = batched_stats.grouped_linear_regression_ols_batch(x=x, y=y, g=g, alpha=.05)
+
+    # An roi with all coefficients equal, which should still be processed even though it was computed
+    fit_stats['beta'][1, :] = 1.0
+
+    batch_stats = batched_stats.test_for_diff_than_mean_vls_batch(beta=fit_stats['beta'], acm=fit_stats['acm'],
+                                                                  n_grps=fit_stats['n_grps'],
+                                                                  computed=fit_stats['computed'],
+                                                                  var_names=var_names)
+    roi_fit_stats = batched_stats.unpack_batch_stats(fit_stats)
+    for r_i in range(y.shape[1]):
+        roi_stats = whole_brain_stat_functions.test_for_diff_than_mean_vls(stats=roi_fit_stats[r_i],
+                                                                          var_names=var_names)
+        for k in ['beta', 'eq_mean_p', 'computed']:
+            np.testing.assert_allclose(batch_stats[k][r_i], roi_stats[k], rtol=1e-7, atol=1e-10, equal_nan=True)
+
+
+@pytest.mark.parametrize('perm_block_size', [1, 7, 1000])
+def test_paired_grouped_perm_test_batch_matches_per_variable_tests(perm_block_size):
+    rng = np.random.default_rng(1)
+    n_smps, n_vars, n_perms = 30, 10, 200
+    grp_ids = np.repeat(np.arange(10), 3)
+    x0 = rng.standard_normal([n_smps, n_vars])
+    x1 = x0 + rng.standard_normal([n_smps, n_vars]) + np.linspace(0, 1, n_vars)
+
+    stats = batched_stats.paired_grouped_perm_test_batch(x0=x0, x1=x1, grp_ids=grp_ids, n_perms=n_perms, seed=2,
+                                                         perm_block_size=perm_block_size, record_max_stats=True)
+
+    flips = batched_stats.grouped_sign_flips(n_perms=n_perms, n_grps=10, seed=2)
+    ref_beta, ref_p_vls, ref_std_stats = _ref_paired_grouped_perm_test(x0, x1, grp_ids, flips)
+    np.testing.assert_allclose(stats['beta'], ref_beta)
+    np.testing.assert_allclose(stats['p'], ref_p_vls)
+
+    # FWER adjusted p-values, from the max standardized statistic over variables for each permutation
+    ref_max_stats = np.max(ref_std_stats[1:, :], axis=1)
+    np.testing.assert_allclose(stats['max_stats'], ref_max_stats)
+    ref_p_fwer = np.mean(ref_max_stats[:, np.newaxis] >= ref_std_stats[0, :]*(1 - 1E-10), axis=0)
+    np.testing.assert_allclose(stats['p_fwer'], np.maximum(ref_p_fwer, 1/n_perms))
+    assert np.all(stats['p_fwer'] >= stats['p'])
+
+
+@pytest.mark.parametrize('perm_block_size', [1, 16, 1000])
+def test_sequential_perm_test_agrees_with_full_test(perm_block_size):
+    rng = np.random.default_rng(3)
+    n_smps, n_vars, n_perms, seq_alpha = 20, 40, 500, .05
+    grp_ids = np.arange(n_smps)
+    x0 = rng.standard_normal([n_smps, n_vars])
+    x1 = x0 + rng.standard_normal([n_smps, n_vars]) + np.linspace(0, 1.5, n_vars)
+
+    full_stats = batched_stats.paired_grouped_perm_test_batch(x0=x0, x1=x1, grp_ids=grp_ids, n_perms=n_perms, seed=4)
+    seq_stats = batched_stats.paired_grouped_perm_test_batch(x0=x0, x1=x1, grp_ids=grp_ids, n_perms=n_perms, seed=4,
+                                                             perm_block_size=perm_block_size, seq_alpha=seq_alpha)
+
+    # Variables which use all permutations get the same p-values, and no decisions at seq_alpha change
+    used_all = seq_stats['n_perms_used'] == n_perms
+    np.testing.assert_allclose(seq_stats['p'][used_all], full_stats['p'][used_all])
+    np.testing.assert_array_equal(seq_stats['p'] <= seq_alpha, full_stats['p'] <= seq_alpha)
+    assert np.any(~used_all)
+
+
+def test_westfall_young_p_vls():
+    max_stats = np.asarray([1.0, 2.0, 3.0, 4.0])
+    p_vls = batched_stats.westfall_young_p_vls(stats=np.asarray([0.5, 2.0, 3.5, 5.0, np.nan]), max_stats=max_stats)
+    # No permutation has a max statistic as large as the fourth statistic, so its p-value is floored at 1/n_perms
+    np.testing.assert_allclose(p_vls, [1.0, .75, .25, .25, np.nan])
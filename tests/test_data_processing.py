@@ -0,0 +1,537 @@
+""" Tests for the data_processing module. """
+
+import copy
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from keller_zlatic_vnc import data_processing
+from keller_zlatic_vnc.data_processing import apply_cutoff_times
+from keller_zlatic_vnc.data_processing import calc_dff
+from keller_zlatic_vnc.data_processing import calc_dff_chunked
+from keller_zlatic_vnc.data_processing import calc_dff_prefix_sums
+from keller_zlatic_vnc.data_processing import calc_window_means
+from keller_zlatic_vnc.data_processing import count_transitions
+from keller_zlatic_vnc.data_processing import count_unique_subjs_per_transition
+from keller_zlatic_vnc.data_processing import extract_peri_event_dff
+from keller_zlatic_vnc.data_processing import find_before_and_after_events
+from keller_zlatic_vnc.data_processing import find_clean_events
+from keller_zlatic_vnc.data_processing import find_interval_overlap_counts
+from keller_zlatic_vnc.data_processing import find_quiet_periods
+from keller_zlatic_vnc.data_processing import find_quiet_periods_for_params
+from keller_zlatic_vnc.data_processing import find_usable_partial_overlap_events
+from keller_zlatic_vnc.data_processing import get_basic_clean_annotations_from_full
+from keller_zlatic_vnc.data_processing import read_clean_annotations
+from keller_zlatic_vnc.data_processing import read_full_annotations
+from keller_zlatic_vnc.data_processing import read_stimulus_annotations
+from keller_zlatic_vnc.data_processing import whole_brain_extract_dff_with_annotations
+
+# Columns of full annotation csv files, in the order they are written, and the behaviors they mark
+_FULL_ANNOT_COLS = {'fw': 'F', 'bw': 'B', 'stim': 'S', 'hunch': 'H', 'turn': 'T', 'other': 'O', 'HP': 'P',
+                    'left turn': 'TL', 'right turn': 'TR'}
+
+
+def _ref_find_before_and_after_events(events: pd.DataFrame, all_events: pd.DataFrame) -> pd.DataFrame:
+    """ The original implementation of find_before_and_after_events, which searches all events for each event. """
+    before_after_events_dict = dict()
+
+    all_event_indices = all_events.index.to_numpy()
+    for ind in events.index:
+        cur_start = events.loc[ind, 'start']
+        cur_end = events.loc[ind, 'end']
+
+        pull_indices = all_event_indices[all_event_indices != ind]
+        pull_start = all_events['start'][pull_indices].to_numpy()
+        pull_end = all_events['end'][pull_indices].to_numpy()
+
+        before_time_diffs = (pull_end - cur_start).astype('float')
+        before_time_diffs[(pull_end - cur_end) >= 0] = -np.inf
+        max_inds = np.argwhere(before_time_diffs == np.max(before_time_diffs)).squeeze(axis=1)
+        if len(max_inds) == 1:
+            before_index = pull_indices[max_inds[0]]
+            row_data = [all_events['beh'][before_index], all_events['start'][before_index],
+                        all_events['end'][before_index]]
+        else:
+            row_data = [np.nan, np.nan, np.nan]
+
+        after_time_diffs = (pull_start - cur_end).astype('float')
+        after_time_diffs[(pull_start - cur_start) <= 0] = np.inf
+        min_inds = np.argwhere(after_time_diffs == np.min(after_time_diffs)).squeeze(axis=1)
+        if len(min_inds) == 1:
+            after_index = pull_indices[min_inds[0]]
+            row_data += [all_events['beh'][after_index], all_events['start'][after_index],
+                         all_events['end'][after_index]]
+        else:
+            row_data += [np.nan, np.nan, np.nan]
+
+        before_after_events_dict[ind] = row_data
+
+    before_after_events = pd.DataFrame.from_dict(before_after_events_dict, orient='index',
+                                                 columns=['beh_before', 'beh_before_start', 'beh_before_end',
+                                                          'beh_after', 'beh_after_start', 'beh_after_end'])
+
+    return before_after_events.astype({'beh_before_start': pd.Int64Dtype(), 'beh_before_end': pd.Int64Dtype(),
+                                       'beh_after_start': pd.Int64Dtype(), 'beh_after_end': pd.Int64Dtype()})
+
+
+def _gen_events(rng, n_all_events, max_time, max_len):
+    """ Generates random events, with coarse times so there are many ties and events with the same start and end. """
+    starts = rng.integers(0, max_time, n_all_events)
+    all_events = pd.DataFrame({'start': starts, 'end': starts + rng.integers(0, max_len, n_all_events),
+                               'beh': rng.choice(['F', 'B', 'Q', 'S'], n_all_events)},
+                              index=rng.permutation(3*n_all_events)[:n_all_events])
+
+    events = all_events.iloc[rng.permutation(n_all_events)[:rng.integers(1, n_all_events + 1)]].copy()
+
+    # Shift some events of interest, so their rows in all_events no longer match them
+    shift_rows = rng.random(len(events)) < .3
+    events.loc[shift_rows, 'start'] += rng.integers(-3, 4, np.sum(shift_rows))
+    events.loc[shift_rows, 'end'] += rng.integers(-3, 4, np.sum(shift_rows))
+
+    # Add some events of interest which are not in all_events
+    n_new = rng.integers(0, 3)
+    new_starts = rng.integers(0, max_time, n_new)
+    new_events = pd.DataFrame({'start': new_starts, 'end': new_starts + rng.integers(0, max_len, n_new),
+                               'beh': 'S'}, index=3*n_all_events + np.arange(n_new))
+
+    return pd.concat([events, new_events]), all_events
+
+
+@pytest.mark.parametrize('n_all_events', [2, 3, 5, 20, 100])
+def test_find_before_and_after_events_matches_original(n_all_events):
+    rng = np.random.default_rng(n_all_events)
+    for _ in range(100):
+        max_time = rng.integers(1, 2*n_all_events + 2)
+        events, all_events = _gen_events(rng, n_all_events=n_all_events, max_time=max_time, max_len=4)
+        pd.testing.assert_frame_equal(find_before_and_after_events(events=events, all_events=all_events),
+                                      _ref_find_before_and_after_events(events=events, all_events=all_events))
+
+
+def test_find_before_and_after_events_returns_lone_candidate():
+    all_events = pd.DataFrame({'start': [10, 20], 'end': [30, 25], 'beh': ['F', 'S']})
+    before_after = find_before_and_after_events(events=all_events.iloc[[1]], all_events=all_events)
+
+    # The only other event contains the event of interest, but is still returned as its before and after events
+    assert before_after['beh_before'].iloc[0] == 'F'
+    assert before_after['beh_after'].iloc[0] == 'F'
+
+
+@pytest.mark.parametrize('out_of_range', ['nan', 'slice'])
+def test_calc_window_means(out_of_range):
+    rng = np.random.default_rng(0)
+    dff = rng.standard_normal([30, 5]).astype(np.float32)
+    starts = rng.integers(-35, 35, 200)
+    stops = starts + rng.integers(-2, 10, 200)
+
+    mn_vls = calc_window_means(calc_dff_prefix_sums(dff), starts=starts, stops=stops, out_of_range=out_of_range)
+
+    for w_i, (start, stop) in enumerate(zip(starts, stops)):
+        window_vls = dff[start:stop, :]
+        if (out_of_range == 'nan' and (start < 0 or stop > dff.shape[0])) or window_vls.shape[0] == 0:
+            assert np.all(np.isnan(mn_vls[w_i]))
+        else:
+            np.testing.assert_allclose(mn_vls[w_i], np.mean(window_vls, axis=0, dtype=np.float64), rtol=1e-6)
+
+
+@pytest.mark.parametrize('chunk_n_time_pts, chunk_n_rois', [(1000, None), (7, None), (4, 3)])
+def test_calc_dff_chunked_matches_calc_dff(chunk_n_time_pts, chunk_n_rois):
+    rng = np.random.default_rng(1)
+    f = rng.uniform(1, 2, [25, 8])
+    b = rng.uniform(1, 2, [25, 8])
+
+    dff = calc_dff_chunked(f=f, b=b, background=.1, ep=.5, chunk_n_time_pts=chunk_n_time_pts,
+                           chunk_n_rois=chunk_n_rois)
+
+    assert dff.dtype == np.float32
+    np.testing.assert_allclose(dff, calc_dff(f=f, b=b, background=.1, ep=.5), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('window_type', ['start_aligned', 'start_end_aligned'])
+def test_whole_brain_extract_dff_with_annotations(window_type):
+    rng = np.random.default_rng(3)
+    dff = rng.standard_normal([50, 4])
+    starts = rng.integers(0, 45, 8)
+    event_tbl = pd.DataFrame({'subject_id': 's0', 'manipulation_tgt': 'A4', 'event_id': np.arange(8),
+                              'beh_before': 'F', 'beh_after': 'B', 'beh': 'S', 'start': starts,
+                              'end': starts + rng.integers(1, 5, 8)}, index=np.arange(8)[::-1])
+
+    tbl, dff_matrix = whole_brain_extract_dff_with_annotations(dff=dff, event_tbl=event_tbl, align_col='start',
+                                                               ref_offset=-2, window_l=3, window_type=window_type,
+                                                               end_align_col='end', end_ref_offset=1)
+    obj_tbl = whole_brain_extract_dff_with_annotations(dff=dff, event_tbl=event_tbl, align_col='start',
+                                                       ref_offset=-2, window_l=3, window_type=window_type,
+                                                       end_align_col='end', end_ref_offset=1,
+                                                       return_dff_matrix=False)
+
+    assert dff_matrix.dtype == np.float32
+    assert 'dff' not in tbl.columns
+    pd.testing.assert_frame_equal(tbl, obj_tbl.drop(columns='dff'))
+    for e_i, (start, end) in enumerate(zip(starts, event_tbl['end'])):
+        stop = start + 1 if window_type == 'start_aligned' else end + 1
+        ref_vls = np.mean(dff[start - 2:stop, :], axis=0)
+        np.testing.assert_allclose(dff_matrix[e_i], ref_vls, rtol=1e-6)
+        np.testing.assert_allclose(obj_tbl['dff'][e_i], ref_vls)
+
+
+@pytest.mark.parametrize('chunk_n_events', [1, 4, 100])
+def test_extract_peri_event_dff(tmp_path, chunk_n_events):
+    rng = np.random.default_rng(2)
+    dff = rng.standard_normal([40, 6])
+    event_tbl = pd.DataFrame({'start': rng.integers(-5, 45, 10)})
+    lags = [-3, -1, 0, 2, 5]
+
+    for out_file in [None, tmp_path / 'tensor.npy']:
+        tensor = extract_peri_event_dff(dff=dff, event_tbl=event_tbl, align_col='start', lags=lags, ref_offset=1,
+                                        out_file=out_file, chunk_n_events=chunk_n_events)
+        for e_i, start in enumerate(event_tbl['start']):
+            for l_i, lag in enumerate(lags):
+                t = start + 1 + lag
+                if 0 <= t < dff.shape[0]:
+                    np.testing.assert_allclose(tensor[e_i, l_i, :], dff[t, :], rtol=1e-6)
+                else:
+                    assert np.all(np.isnan(tensor[e_i, l_i, :]))
+
+
+def _ref_find_overlapping_ints(query_int, all_other_ints, all_other_rows):
+    """ The original search for intervals overlapping a query interval, from find_usable_partial_overlap_events. """
+    start_ind = query_int[0]
+    stop_ind = query_int[1] - 1
+    all_other_ints[:, 1] = all_other_ints[:, 1] - 1
+
+    start_overlaps = np.logical_and(all_other_ints[:, 0] >= start_ind, all_other_ints[:, 0] <= stop_ind)
+    stop_overlaps = np.logical_and(all_other_ints[:, 1] >= start_ind, all_other_ints[:, 1] <= stop_ind)
+    contained_overlaps = np.logical_and(all_other_ints[:, 0] >= start_ind, all_other_ints[:, 1] <= stop_ind)
+    contained_within_overlaps = np.logical_and(all_other_ints[:, 0] <= start_ind, all_other_ints[:, 1] >= stop_ind)
+
+    return {'start': all_other_rows[start_overlaps], 'stop': all_other_rows[stop_overlaps],
+            'contained': all_other_rows[contained_overlaps],
+            'contained_within': all_other_rows[contained_within_overlaps]}
+
+
+def _ref_find_usable_partial_overlap_events(ints):
+    """ The original implementation of find_usable_partial_overlap_events, which searches all intervals for each. """
+    n_events = ints.shape[0]
+    good_rows = np.zeros(n_events, dtype=bool)
+    for e_i in range(n_events):
+        cur_rows = np.delete(np.arange(n_events), e_i)
+        overlaps = _ref_find_overlapping_ints(ints[e_i, :], ints[cur_rows, :], cur_rows)
+        if (len(overlaps['contained_within']) == 0 and len(overlaps['contained']) == 0 and
+                len(overlaps['stop']) <= 1 and len(overlaps['start']) == 0):
+            good_rows[e_i] = True
+    return good_rows
+
+
+def _gen_ints(rng, n_ints, max_time, max_len, min_len=0):
+    """ Generates random intervals, in slice convention, with many ties and repeated intervals. """
+    starts = rng.integers(0, max_time, n_ints)
+    ints = np.stack([starts, starts + rng.integers(min_len, max_len + 1, n_ints)], axis=1)
+    if n_ints > 3:
+        ints[1] = ints[0]
+        ints[3] = ints[3] - ints[3, 0] + ints[2, 1]
+    return ints
+
+
+@pytest.mark.parametrize('n_ints, max_time, max_len', [(1, 10, 3), (2, 5, 3), (10, 20, 5), (200, 100, 8),
+                                                       (200, 1000, 8), (300, 30, 30)])
+def test_find_interval_overlap_counts_matches_original(n_ints, max_time, max_len):
+    rng = np.random.default_rng(n_ints + max_time)
+    for _ in range(5):
+        ints = _gen_ints(rng, n_ints, max_time, max_len)
+        overlap_counts = find_interval_overlap_counts(ints)
+
+        for i in range(n_ints):
+            other_rows = np.delete(np.arange(n_ints), i)
+            ref_overlaps = _ref_find_overlapping_ints(ints[i, :], ints[other_rows, :], other_rows)
+            for k, ref_rows in ref_overlaps.items():
+                assert overlap_counts[k][i] == len(ref_rows)
+
+
+@pytest.mark.parametrize('n_ints, max_time, max_len', [(1, 10, 3), (2, 5, 3), (10, 20, 5), (200, 100, 8),
+                                                       (200, 1000, 8), (300, 30, 30)])
+def test_find_usable_partial_overlap_events_matches_original(n_ints, max_time, max_len):
+    rng = np.random.default_rng(n_ints*max_time)
+    for _ in range(5):
+        ints = _gen_ints(rng, n_ints, max_time, max_len)
+        np.testing.assert_array_equal(find_usable_partial_overlap_events(ints),
+                                      _ref_find_usable_partial_overlap_events(ints))
+
+
+@pytest.mark.parametrize('n_events, max_time, max_len', [(1, 10, 3), (10, 20, 5), (200, 400, 8), (300, 30, 30)])
+def test_find_clean_events(n_events, max_time, max_len):
+    rng = np.random.default_rng(n_events + 1)
+    for _ in range(5):
+        # Annotations have inclusive ends, so the shortest events start and end on the same time point
+        ints = _gen_ints(rng, n_events, max_time, max_len, min_len=1)
+        annots = pd.DataFrame({'start': ints[:, 0], 'end': ints[:, 1] - 1})
+
+        np.testing.assert_array_equal(find_clean_events(annots, clean_def='po'),
+                                      _ref_find_usable_partial_overlap_events(ints))
+
+        # Disjoint events share no time point with any other event
+        shared = ((np.maximum(ints[:, 0:1], ints[:, 0]) < np.minimum(ints[:, 1:2], ints[:, 1])) &
+                  ~np.eye(n_events, dtype=bool))
+        np.testing.assert_array_equal(find_clean_events(annots, clean_def='dj'), ~np.any(shared, axis=1))
+
+
+@pytest.mark.parametrize('starts, ends, clean', [
+    # Touching events share their boundary time point, so neither is disjoint
+    ([0, 3], [3, 5], [False, False]),
+    # Adjacent events, which do not share a time point, are disjoint
+    ([0, 4], [3, 5], [True, True]),
+    # Identical events overlap each other
+    ([2, 2, 8], [4, 4, 9], [False, False, True]),
+    # Single time point events are disjoint unless another event includes their time point
+    ([0, 1, 3, 5], [0, 1, 6, 5], [True, True, False, False]),
+    ([0, 0], [0, 0], [False, False])])
+def test_find_clean_events_disjoint_edge_cases(starts, ends, clean):
+    annots = pd.DataFrame({'start': starts, 'end': ends})
+    np.testing.assert_array_equal(find_clean_events(annots, clean_def='dj'), clean)
+
+
+def _ref_count_transitions(table, behs=None, count_subjs=False):
+    """ The original implementations of count_transitions and count_unique_subjs_per_transition. """
+    if behs is None:
+        behs = list(set(table['beh_before'].unique().tolist() + table['beh_after'].unique().tolist()))
+        behs.sort()
+
+    counts = np.zeros([len(behs), len(behs)])
+    for b_i, b_b in enumerate(behs):
+        for a_i, a_b in enumerate(behs):
+            trans_rows = np.logical_and((table['beh_before'] == b_b).to_numpy(), (table['beh_after'] == a_b).to_numpy())
+            if count_subjs:
+                counts[b_i, a_i] = len(table[trans_rows]['subject_id'].unique())
+            else:
+                counts[b_i, a_i] = len(table[trans_rows])
+
+    return pd.DataFrame(counts, index=behs, columns=behs)
+
+
+@pytest.mark.parametrize('behs', [None, ['F', 'B', 'Q'], ['Q', 'H', 'X', 'F'], []])
+def test_count_transitions_matches_original(behs):
+    rng = np.random.default_rng(5)
+    for n_rows in [0, 1, 10, 200]:
+        # Subjects include nan, which is counted as one more subject
+        subjs = np.asarray(['s0', 's1', 's2', np.nan], dtype=object)
+        table = pd.DataFrame({'beh_before': rng.choice(['F', 'B', 'Q', 'TL', 'H'], n_rows),
+                              'beh_after': rng.choice(['F', 'B', 'Q', 'TR'], n_rows),
+                              'subject_id': subjs[rng.integers(0, 4, n_rows)]}, index=rng.permutation(n_rows))
+
+        pd.testing.assert_frame_equal(count_transitions(table, behs=behs), _ref_count_transitions(table, behs=behs))
+        pd.testing.assert_frame_equal(count_unique_subjs_per_transition(table, behs=behs),
+                                      _ref_count_transitions(table, behs=behs, count_subjs=True))
+
+
+def _ref_find_quiet_periods(annots, q_th, q_start_offset, q_end_offset):
+    """ The original implementation of find_quiet_periods, which searches all events for each event. """
+    first_end = annots['end'].min()
+    last_start = annots['start'].max()
+
+    all_starts = annots['start'].to_numpy()
+    all_ends = annots['end'].to_numpy()
+
+    quiet_starts = []
+    quiet_ends = []
+    for end in all_ends:
+        if end > first_end and end < last_start:
+            search_starts = all_starts[all_ends > end]
+            smallest_delta = np.min(search_starts - end) - 1
+            if smallest_delta >= q_th:
+                quiet_starts.append(end + q_start_offset)
+                quiet_ends.append(end + smallest_delta - q_end_offset + 1)
+
+    return pd.DataFrame({'start': quiet_starts, 'end': quiet_ends, 'beh': ['Q'] * len(quiet_starts)})
+
+
+@pytest.mark.parametrize('n_events, max_time, max_len', [(1, 10, 3), (2, 20, 3), (10, 100, 5), (100, 1000, 30),
+                                                         (40, 600, 60)])
+def test_find_quiet_periods_for_params_matches_original(n_events, max_time, max_len):
+    rng = np.random.default_rng(n_events + max_time)
+    params = [(1, 1, 1), (3, 1, 1), (3, 2, 2), (5.5, 3, 2), (10, 4, 7), (40, 1, 40)]
+    for _ in range(10):
+        # Long events nest and overlap many shorter events, and some events share starts or ends
+        starts = rng.integers(0, max_time, n_events)
+        annots = pd.DataFrame({'start': starts, 'end': starts + rng.integers(0, max_len, n_events)},
+                              index=rng.permutation(n_events))
+        if n_events > 3:
+            annots.iloc[1, :] = [annots.iloc[0, 0], annots.iloc[0, 1] + 3]
+            annots.iloc[2, :] = [min(annots.iloc[2, 0], annots.iloc[3, 1]), annots.iloc[3, 1]]
+
+        quiet_tbls = find_quiet_periods_for_params(annots, params=params)
+
+        assert len(quiet_tbls) == len(params)
+        for quiet_tbl, (q_th, q_start_offset, q_end_offset) in zip(quiet_tbls, params):
+            ref_quiet_tbl = _ref_find_quiet_periods(annots, q_th, q_start_offset, q_end_offset)
+            pd.testing.assert_frame_equal(quiet_tbl, ref_quiet_tbl)
+            pd.testing.assert_frame_equal(find_quiet_periods(annots, q_th, q_start_offset, q_end_offset),
+                                          ref_quiet_tbl)
+
+
+def _write_full_annot_csv(file, seed, n_events=60):
+    """ Writes a full annotation csv file with a sequence of events separated by gaps of random length.
+
+    Some events are marked with more than one behavior or no behavior, and all turns are marked with a direction.
+    """
+    rng = np.random.default_rng(seed)
+    starts = 1 + np.cumsum(rng.integers(1, 12, n_events))
+    starts = starts + np.concatenate([[0], np.cumsum(rng.integers(2, 10, n_events - 1))])
+    ends = starts + rng.integers(0, 8, n_events)
+    marks = pd.DataFrame(np.nan, index=np.arange(n_events), columns=list(_FULL_ANNOT_COLS.keys()))
+    for e_i in range(n_events):
+        for col in rng.choice(['fw', 'bw', 'stim', 'hunch', 'turn', 'other', 'HP'], rng.integers(0, 3),
+                              replace=False):
+            marks.loc[e_i, col] = 1
+        if marks.loc[e_i, 'turn'] == 1:
+            marks.loc[e_i, rng.choice(['left turn', 'right turn'])] = 1
+    annots = pd.concat([pd.DataFrame({'START': starts, 'END': ends}), marks], axis=1)
+    annots.to_csv(file, sep=';', index=False)
+
+    # Files written with different seeds always have different modification times
+    mtime_ns = (seed + 1)*10**12
+    os.utime(file, ns=(mtime_ns, mtime_ns))
+
+
+def _ref_read_full_annotations(file):
+    """ The original implementation of read_full_annotations, which finds the behavior of one event at a time. """
+    basic_behs = ['F', 'B', 'S', 'H', 'T', 'O', 'P']
+    turn_behs = ['TL', 'TR']
+
+    annots = pd.read_csv(file, delimiter=';')
+    col_mapper = {k: _FULL_ANNOT_COLS.get(k) for k in annots.columns}
+    col_mapper['START'] = 'start'
+    col_mapper['END'] = 'end'
+    annots.rename(columns=col_mapper, inplace=True)
+
+    beh_col_dict = dict()
+    for r in annots.index:
+        match_ind = np.argwhere(np.logical_not(np.isnan(annots.loc[r, basic_behs].to_numpy(dtype=float))))
+        if not match_ind.size == 0:
+            beh = basic_behs[match_ind[0][0]]
+            if beh == 'T':
+                turn_match_ind = np.argwhere(np.logical_not(np.isnan(annots.loc[r, turn_behs].to_numpy(dtype=float))))
+                beh = turn_behs[turn_match_ind[0][0]]
+            beh_col_dict[r] = beh
+        else:
+            beh_col_dict[r] = np.nan
+
+    formatted_annots = annots[['start', 'end']].copy()
+    formatted_annots['beh'] = pd.Series(beh_col_dict)
+    formatted_annots[['start', 'end']] = formatted_annots[['start', 'end']] - 1
+    return formatted_annots
+
+
+def _ref_read_clean_annotations(file, q_th, q_start_offset, q_end_offset, clean_def, co_th, subject_id):
+    """ The clean annotation stage as it was run before it was a single function. """
+    tbl = _ref_read_full_annotations(file)
+    quiet_tbl = _ref_find_quiet_periods(annots=tbl, q_th=q_th, q_start_offset=q_start_offset,
+                                        q_end_offset=q_end_offset)
+    tbl = pd.concat([tbl, quiet_tbl], ignore_index=True)
+    tbl['subject_id'] = subject_id
+    tbl = get_basic_clean_annotations_from_full(tbl, clean_def=clean_def)
+    return apply_cutoff_times(annots=tbl, co_th=co_th)
+
+
+def _ref_read_stimulus_annotations(file, subject_id, manipulation_tgt):
+    """ The stimulus annotation stage as it was run before it was a single function. """
+    tbl = _ref_read_full_annotations(file)
+    stim_tbl = copy.deepcopy(tbl[tbl['beh'] == 'S'])
+    stim_tbl.insert(0, 'subject_id', subject_id)
+    stim_tbl.insert(1, 'event_id', range(stim_tbl.shape[0]))
+    stim_tbl.insert(2, 'manipulation_tgt', manipulation_tgt)
+    before_after_tbl = _ref_find_before_and_after_events(events=stim_tbl, all_events=tbl)
+    return pd.concat([stim_tbl, before_after_tbl], axis=1)
+
+
+def _raise_if_called(*args, **kwargs):
+    raise(RuntimeError('Annotations should have been read from the cache.'))
+
+
+def test_read_full_annotations_matches_original_and_caches(tmp_path, monkeypatch):
+    monkeypatch.delenv(data_processing.ANNOT_CACHE_DIR_ENV_VAR, raising=False)
+    file = tmp_path / 'annots.csv'
+    cache_dir = tmp_path / 'cache'
+    _write_full_annot_csv(file, seed=0)
+    ref_annots = _ref_read_full_annotations(file)
+    assert ref_annots['beh'].isna().any()
+
+    pd.testing.assert_frame_equal(read_full_annotations(file), ref_annots)
+    pd.testing.assert_frame_equal(read_full_annotations(file, cache_dir=cache_dir), ref_annots)
+    assert len(list(cache_dir.glob('*.pkl'))) == 1
+
+    # Cached annotations are read without parsing the csv file
+    with monkeypatch.context() as m:
+        m.setattr(pd, 'read_csv', _raise_if_called)
+        pd.testing.assert_frame_equal(read_full_annotations(file, cache_dir=cache_dir), ref_annots)
+
+    # Changing the file gives a new cache entry
+    _write_full_annot_csv(file, seed=1)
+    new_ref_annots = _ref_read_full_annotations(file)
+    pd.testing.assert_frame_equal(read_full_annotations(file, cache_dir=cache_dir), new_ref_annots)
+    assert len(list(cache_dir.glob('*.pkl'))) == 2
+
+    # The cache folder can be provided with an environment variable
+    monkeypatch.setenv(data_processing.ANNOT_CACHE_DIR_ENV_VAR, str(cache_dir))
+    with monkeypatch.context() as m:
+        m.setattr(pd, 'read_csv', _raise_if_called)
+        pd.testing.assert_frame_equal(read_full_annotations(file), new_ref_annots)
+
+
+def test_read_clean_annotations_matches_original_and_caches(tmp_path, monkeypatch):
+    monkeypatch.delenv(data_processing.ANNOT_CACHE_DIR_ENV_VAR, raising=False)
+    file = tmp_path / 'annots.csv'
+    cache_dir = tmp_path / 'cache'
+    _write_full_annot_csv(file, seed=2)
+    ps = {'q_th': 4, 'q_start_offset': 1, 'q_end_offset': 1, 'clean_def': 'po', 'co_th': 3, 'subject_id': 's0'}
+
+    ref_annots = _ref_read_clean_annotations(file, **ps)
+    assert len(ref_annots) > 0
+    pd.testing.assert_frame_equal(read_clean_annotations(file, **ps), ref_annots)
+    pd.testing.assert_frame_equal(read_clean_annotations(file, cache_dir=cache_dir, **ps), ref_annots)
+
+    # Cached annotations are read without running the stage
+    with monkeypatch.context() as m:
+        m.setattr(data_processing, 'read_full_annotations', _raise_if_called)
+        pd.testing.assert_frame_equal(read_clean_annotations(file, cache_dir=cache_dir, **ps), ref_annots)
+
+    # Changing any parameter or the contents of the file gives a new cache entry
+    n_entries = len(list(cache_dir.glob('*_clean_*.pkl')))
+    for k, vl in [('q_th', 6), ('q_start_offset', 2), ('q_end_offset', 2), ('clean_def', 'dj'), ('co_th', 1),
+                  ('subject_id', 's1')]:
+        new_ps = dict(ps, **{k: vl})
+        pd.testing.assert_frame_equal(read_clean_annotations(file, cache_dir=cache_dir, **new_ps),
+                                      _ref_read_clean_annotations(file, **new_ps))
+        n_entries += 1
+        assert len(list(cache_dir.glob('*_clean_*.pkl'))) == n_entries
+
+    _write_full_annot_csv(file, seed=3)
+    pd.testing.assert_frame_equal(read_clean_annotations(file, cache_dir=cache_dir, **ps),
+                                  _ref_read_clean_annotations(file, **ps))
+    assert len(list(cache_dir.glob('*_clean_*.pkl'))) == n_entries + 1
+
+
+def test_read_stimulus_annotations_matches_original_and_caches(tmp_path, monkeypatch):
+    monkeypatch.delenv(data_processing.ANNOT_CACHE_DIR_ENV_VAR, raising=False)
+    file = tmp_path / 'annots.csv'
+    cache_dir = tmp_path / 'cache'
+    _write_full_annot_csv(file, seed=4)
+
+    ref_annots = _ref_read_stimulus_annotations(file, 's0', 'A4')
+    assert len(ref_annots) > 0
+    pd.testing.assert_frame_equal(read_stimulus_annotations(file, 's0', 'A4'), ref_annots)
+    pd.testing.assert_frame_equal(read_stimulus_annotations(file, 's0', 'A4', cache_dir=cache_dir), ref_annots)
+
+    with monkeypatch.context() as m:
+        m.setattr(data_processing, 'read_full_annotations', _raise_if_called)
+        pd.testing.assert_frame_equal(read_stimulus_annotations(file, 's0', 'A4', cache_dir=cache_dir), ref_annots)
+
+    for subject_id, manipulation_tgt in [('s1', 'A4'), ('s0', 'A9')]:
+        pd.testing.assert_frame_equal(read_stimulus_annotations(file, subject_id, manipulation_tgt,
+                                                                cache_dir=cache_dir),
+                                      _ref_read_stimulus_annotations(file, subject_id, manipulation_tgt))
+    assert len(list(cache_dir.glob('*_stim_*.pkl'))) == 3
+
+    _write_full_annot_csv(file, seed=5)
+    pd.testing.assert_frame_equal(read_stimulus_annotations(file, 's0', 'A4', cache_dir=cache_dir),
+                                  _ref_read_stimulus_annotations(file, 's0', 'A4'))
+    assert len(list(cache_dir.glob('*_stim_*.pkl'))) == 4
@@ -0,0 +1,119 @@
+""" Tests for the dff_cache module. """
+
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from keller_zlatic_vnc import dff_cache
+from keller_zlatic_vnc.data_processing import calc_dff
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    """ Creates a dataset file, and replaces loading of datasets so fluorescence and baseline come from its folder.
+
+    Fluorescence and baseline are returned as h5py datasets, as they are for datasets with data stored in hdf5 files.
+
+    Returns the dataset file and a list holding the number of times the dataset has been loaded.
+    """
+    dataset_folder = tmp_path / 'dataset'
+    os.makedirs(dataset_folder)
+    rng = np.random.default_rng(0)
+    np.save(dataset_folder / 'f.npy', rng.uniform(1, 2, [30, 6]))
+    np.save(dataset_folder / 'b.npy', rng.uniform(1, 2, [30, 6]))
+    dataset_file = dataset_folder / 'dataset.pkl'
+    dataset_file.write_bytes(b'')
+
+    n_loads = [0]
+    h5_files = []
+
+    def _load_dataset_f_and_b(dataset_file, f_ts_str, bl_ts_str):
+        n_loads[0] += 1
+        folder = os.path.dirname(dataset_file)
+        h5_file = h5py.File(os.path.join(os.path.dirname(folder), 'data_' + str(n_loads[0]) + '.h5'), 'w')
+        h5_files.append(h5_file)
+        for ts_str in [f_ts_str, bl_ts_str]:
+            h5_file.create_dataset(ts_str, data=np.load(os.path.join(folder, ts_str + '.npy')))
+        return h5_file[f_ts_str], h5_file[bl_ts_str]
+
+    monkeypatch.setattr(dff_cache, '_load_dataset_f_and_b', _load_dataset_f_and_b)
+    monkeypatch.delenv(dff_cache.CACHE_DIR_ENV_VAR, raising=False)
+    yield dataset_file, n_loads
+    for h5_file in h5_files:
+        h5_file.close()
+
+
+def _load_dff(dataset_file, cache_dir, **kwargs):
+    return dff_cache.load_dff(dataset_file=dataset_file, f_ts_str='f', bl_ts_str='b', background=.1, ep=.5,
+                              cache_dir=cache_dir, **kwargs)
+
+
+def test_cached_and_uncached_dff_match(tmp_path, dataset):
+    dataset_file, n_loads = dataset
+    folder = dataset_file.parent
+    ref_dff = calc_dff(f=np.load(folder / 'f.npy'), b=np.load(folder / 'b.npy'), background=.1, ep=.5)
+
+    uncached_dff = _load_dff(dataset_file, cache_dir=None)
+    first_dff = _load_dff(dataset_file, cache_dir=tmp_path / 'cache')
+    second_dff = _load_dff(dataset_file, cache_dir=tmp_path / 'cache')
+
+    # Without a cache, dff is calculated at the precision of the dataset, as with calc_dff
+    assert uncached_dff.dtype == ref_dff.dtype
+    np.testing.assert_array_equal(uncached_dff, ref_dff)
+
+    # Cached dff is stored in single precision
+    for dff in [first_dff, second_dff]:
+        assert dff.dtype == np.float32
+        np.testing.assert_allclose(dff, ref_dff, rtol=1e-5, atol=1e-6)
+    np.testing.assert_array_equal(first_dff, second_dff)
+    assert isinstance(second_dff, np.memmap)
+
+    # The second cached load should not have loaded the dataset
+    assert n_loads[0] == 2
+
+
+def test_cache_dir_from_env_var(tmp_path, dataset, monkeypatch):
+    dataset_file, _ = dataset
+    monkeypatch.setenv(dff_cache.CACHE_DIR_ENV_VAR, str(tmp_path / 'cache'))
+    _load_dff(dataset_file, cache_dir=None)
+    assert len(list((tmp_path / 'cache').glob('*.npy'))) == 1
+
+
+def test_entries_are_recalculated_when_parameters_or_data_change(tmp_path, dataset):
+    dataset_file, n_loads = dataset
+    cache_dir = tmp_path / 'cache'
+    _load_dff(dataset_file, cache_dir=cache_dir)
+    dff_cache.load_dff(dataset_file=dataset_file, f_ts_str='f', bl_ts_str='b', background=.2, ep=.5,
+                       cache_dir=cache_dir)
+    assert len(list(cache_dir.glob('*.npy'))) == 2
+
+    # Changing a file in the dataset folder invalidates entries for the dataset
+    f_file = dataset_file.parent / 'f.npy'
+    np.save(f_file, 2*np.load(f_file))
+    os.utime(f_file, ns=(os.stat(f_file).st_atime_ns, os.stat(f_file).st_mtime_ns + 10**9))
+    n_prev_loads = n_loads[0]
+    dff = _load_dff(dataset_file, cache_dir=cache_dir)
+    assert n_loads[0] == n_prev_loads + 1
+    np.testing.assert_allclose(dff, _load_dff(dataset_file, cache_dir=None), rtol=1e-5, atol=1e-6)
+
+
+def test_lru_entries_are_evicted(tmp_path, dataset):
+    dataset_file, n_loads = dataset
+    cache_dir = tmp_path / 'cache'
+    entry_bytes = 30*6*4 + 128
+    for background in [.1, .2, .3]:
+        dff_cache.load_dff(dataset_file=dataset_file, f_ts_str='f', bl_ts_str='b', background=background, ep=.5,
+                           cache_dir=cache_dir, max_cache_bytes=2*entry_bytes)
+        # Make sure entries have distinct use times
+        for entry_file in cache_dir.glob('*.npy'):
+            os.utime(entry_file, (0, os.stat(entry_file).st_mtime - 10))
+
+    assert len(list(cache_dir.glob('*.npy'))) == 2
+    assert len(list(cache_dir.glob('*.json'))) == 2
+
+    # The entry for the first background was the least recently used, so it must be recalculated
+    n_prev_loads = n_loads[0]
+    _load_dff(dataset_file, cache_dir=cache_dir, max_cache_bytes=2*entry_bytes)
+    assert n_loads[0] == n_prev_loads + 1
@@ -0,0 +1,151 @@
+""" Tests for the linear_modeling module. """
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+
+from keller_zlatic_vnc.linear_modeling import one_hot_from_table
+from keller_zlatic_vnc.linear_modeling import spont_beh_one_hot_encoding
+
+
+def _ref_one_hot_from_table(table, beh_before, beh_after, enc_subjects=False, enc_beh_interactions=False,
+                            beh_interactions=None, beh_before_str='beh_before', beh_after_str='beh_after'):
+    """ The original implementation of one_hot_from_table, which encodes one variable at a time. """
+    n_smps = len(table)
+
+    encoding = np.zeros([n_smps, 0])
+    var_strs = []
+
+    if beh_before is not None:
+        beh_before_enc = np.zeros([n_smps, len(beh_before)])
+        for b_i in range(len(beh_before)):
+            beh_before_enc[:, b_i][table[beh_before_str] == beh_before[b_i]] = True
+            var_strs.append(beh_before_str + '_' + beh_before[b_i])
+        encoding = np.concatenate([encoding, beh_before_enc], axis=1)
+
+    if beh_after is not None:
+        beh_after_enc = np.zeros([n_smps, len(beh_after)])
+        for b_i in range(len(beh_after)):
+            beh_after_enc[:, b_i][table[beh_after_str] == beh_after[b_i]] = True
+            var_strs.append(beh_after_str + '_' + beh_after[b_i])
+        encoding = np.concatenate([encoding, beh_after_enc], axis=1)
+
+    if enc_beh_interactions:
+        beh_i_encoding = np.zeros([n_smps, len(beh_before)*len(beh_after)])
+        i_col = 0
+        for bb_i in range(len(beh_before)):
+            before_enc = np.zeros(n_smps)
+            before_enc[table[beh_before_str] == beh_before[bb_i]] = True
+            for ba_i in range(len(beh_after)):
+                after_enc = np.zeros(n_smps)
+                after_enc[table[beh_after_str] == beh_after[ba_i]] = True
+                beh_i_encoding[:, i_col] = before_enc*after_enc
+                var_strs.append('beh_interact_' + beh_before[bb_i] + beh_after[ba_i])
+                i_col += 1
+        encoding = np.concatenate([encoding, beh_i_encoding], axis=1)
+
+    if beh_interactions is not None:
+        beh_i_encoding = np.zeros([n_smps, len(beh_interactions)])
+        for bb_i in range(len(beh_interactions)):
+            before_enc = np.zeros(n_smps)
+            after_enc = np.zeros(n_smps)
+            before_enc[table[beh_before_str] == beh_interactions[bb_i][0]] = True
+            after_enc[table[beh_after_str] == beh_interactions[bb_i][1]] = True
+            beh_i_encoding[:, bb_i] = before_enc*after_enc
+            var_strs.append('beh_interact_' + beh_interactions[bb_i][0] + beh_interactions[bb_i][1])
+        encoding = np.concatenate([encoding, beh_i_encoding], axis=1)
+
+    if enc_subjects:
+        unique_sub_ids = table['subject_id'].unique()
+        sub_id_enc = np.zeros([n_smps, len(unique_sub_ids)])
+        for s_i, sub_id in enumerate(unique_sub_ids):
+            sub_id_enc[:, s_i][table['subject_id'] == sub_id] = True
+            var_strs.append('subject_' + sub_id)
+        encoding = np.concatenate([encoding, sub_id_enc], axis=1)
+
+    return [encoding, var_strs]
+
+
+def _ref_spont_beh_one_hot_encoding(tbl, prev_str, suc_str, prev_ref='Q'):
+    """ The original implementation of spont_beh_one_hot_encoding, which encodes one event at a time. """
+    before_behs = np.asarray(list(set(list(tbl[prev_str].unique())) - set([prev_ref])))
+    after_behs = np.asarray(tbl[suc_str].unique())
+
+    all_vars = ['before_' + b for b in before_behs] + ['after_' + b for b in after_behs]
+    n_before_behs = len(before_behs)
+
+    one_hot = np.zeros([tbl.shape[0], len(all_vars)])
+    for ev_i in range(tbl.shape[0]):
+        before_match = np.argwhere(before_behs == tbl[prev_str].iloc[ev_i])
+        if len(before_match) > 0:
+            one_hot[ev_i, before_match[0][0]] = 1
+        after_match = np.argwhere(after_behs == tbl[suc_str].iloc[ev_i])
+        one_hot[ev_i, n_before_behs + after_match[0][0]] = 1
+
+    return one_hot, all_vars
+
+
+def _gen_table(rng, n_smps, behs):
+    return pd.DataFrame({'beh_before': rng.choice(behs, n_smps), 'beh_after': rng.choice(behs, n_smps),
+                         'subject_id': rng.choice(['s' + str(s_i) for s_i in range(5)], n_smps)},
+                        index=rng.permutation(n_smps))
+
+
+def _gen_behs(rng, behs, max_n):
+    """ Picks behaviors to encode, which can include repeats and behaviors that are not in a table. """
+    return list(rng.choice(behs + ['X'], rng.integers(0, max_n + 1)))
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_one_hot_from_table_matches_original(sparse):
+    rng = np.random.default_rng(0)
+    behs = ['F', 'B', 'Q', 'TL', 'TR', 'H']
+    for _ in range(200):
+        table = _gen_table(rng, rng.integers(0, 40), behs)
+        interaction_type = rng.choice(['none', 'all', 'some'])
+        beh_before = None if rng.random() < .2 and interaction_type != 'all' else _gen_behs(rng, behs, 5)
+        beh_after = None if rng.random() < .2 and interaction_type != 'all' else _gen_behs(rng, behs, 5)
+        beh_interactions = None
+        if interaction_type == 'some':
+            beh_interactions = [tuple(rng.choice(behs + ['X'], 2)) for _ in range(rng.integers(0, 6))]
+        kwargs = {'beh_before': beh_before, 'beh_after': beh_after, 'enc_subjects': bool(rng.random() < .5),
+                  'enc_beh_interactions': interaction_type == 'all', 'beh_interactions': beh_interactions}
+
+        encoding, var_strs = one_hot_from_table(table, sparse=sparse, **kwargs)
+        ref_encoding, ref_var_strs = _ref_one_hot_from_table(table, **kwargs)
+
+        assert var_strs == ref_var_strs
+        if sparse:
+            assert scipy.sparse.isspmatrix_csr(encoding)
+            encoding = encoding.toarray()
+        assert encoding.shape == ref_encoding.shape
+        np.testing.assert_array_equal(encoding, ref_encoding)
+
+
+def test_one_hot_from_table_with_custom_column_names():
+    rng = np.random.default_rng(1)
+    table = _gen_table(rng, 30, ['F', 'B', 'Q']).rename(columns={'beh_before': 'prev', 'beh_after': 'next'})
+    kwargs = {'beh_before': ['F', 'Q'], 'beh_after': ['B'], 'enc_beh_interactions': True,
+              'beh_before_str': 'prev', 'beh_after_str': 'next'}
+
+    encoding, var_strs = one_hot_from_table(table, **kwargs)
+    ref_encoding, ref_var_strs = _ref_one_hot_from_table(table, **kwargs)
+    assert var_strs == ref_var_strs
+    np.testing.assert_array_equal(encoding, ref_encoding)
+
+
+def test_spont_beh_one_hot_encoding_matches_original():
+    rng = np.random.default_rng(2)
+    behs = ['F', 'B', 'Q', 'TL', 'TR', 'H']
+    for _ in range(200):
+        tbl = _gen_table(rng, rng.integers(1, 40), list(rng.choice(behs, rng.integers(1, 6))))
+        prev_ref = rng.choice(behs)
+
+        one_hot, all_vars = spont_beh_one_hot_encoding(tbl, prev_str='beh_before', suc_str='beh_after',
+                                                       prev_ref=prev_ref)
+        ref_one_hot, ref_all_vars = _ref_spont_beh_one_hot_encoding(tbl, prev_str='beh_before',
+                                                                    suc_str='beh_after', prev_ref=prev_ref)
+
+        assert all_vars == ref_all_vars
+        np.testing.assert_array_equal(one_hot, ref_one_hot)
@@ -0,0 +1,33 @@
+""" Tests for the parallel module. """
+
+import numpy as np
+import pytest
+
+from keller_zlatic_vnc.whole_brain.parallel import run_roi_blocks
+
+
+def _scale_block_f(in_arrays, out_arrays, rois, scale):
+    out_arrays['scaled'][:, rois] = scale*in_arrays['vls'][:, rois]
+    out_arrays['sums'][rois] = np.sum(in_arrays['vls'][:, rois], axis=0) + in_arrays['offset']
+    out_arrays['positive'][rois] = np.all(in_arrays['vls'][:, rois] > 0, axis=0)
+
+
+@pytest.mark.parametrize('n_workers', [1, 2])
+@pytest.mark.parametrize('block_size', [1, 3, 100])
+def test_run_roi_blocks(n_workers, block_size):
+    rng = np.random.default_rng(0)
+    n_rois = 11
+    vls = rng.standard_normal([5, n_rois])
+    vls[:, 2] = np.abs(vls[:, 2])
+    out_specs = {'scaled': ((5, n_rois), np.float64, np.nan),
+                 'sums': ((n_rois,), np.float64, np.nan),
+                 'positive': ((n_rois,), np.bool_, False)}
+
+    out_arrays = run_roi_blocks(block_f=_scale_block_f, in_arrays={'vls': vls, 'offset': np.asarray(1.0)},
+                                out_specs=out_specs, n_rois=n_rois, n_workers=n_workers, block_size=block_size,
+                                f_kwargs={'scale': 2.0})
+
+    np.testing.assert_allclose(out_arrays['scaled'], 2.0*vls)
+    np.testing.assert_allclose(out_arrays['sums'], np.sum(vls, axis=0) + 1.0)
+    np.testing.assert_array_equal(out_arrays['positive'], np.all(vls > 0, axis=0))
+    assert out_arrays['positive'].dtype == np.bool_
@@ -0,0 +1,121 @@
+""" Tests for the results_store module. """
+
+import numpy as np
+import pytest
+
+from keller_zlatic_vnc.whole_brain import spontaneous
+from keller_zlatic_vnc.whole_brain.batched_stats import grouped_linear_regression_ols_batch
+from keller_zlatic_vnc.whole_brain.batched_stats import unpack_batch_stats
+from keller_zlatic_vnc.whole_brain.results_store import load_results
+from keller_zlatic_vnc.whole_brain.results_store import load_results_field
+from keller_zlatic_vnc.whole_brain.results_store import load_results_store
+from keller_zlatic_vnc.whole_brain.results_store import results_path
+from keller_zlatic_vnc.whole_brain.results_store import results_to_store
+from keller_zlatic_vnc.whole_brain.results_store import save_results
+
+
+def _gen_stats_arrays(n_rois=7, n_vars=3, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.concatenate([rng.standard_normal([40, n_vars - 1]), np.ones([40, 1])], axis=1)
+    y = rng.standard_normal([40, n_rois])
+    y[:, 2] = 0.0  # Stats are not computed for this roi, so it has no c_ints
+    return grouped_linear_regression_ols_batch(x=x, y=y, g=np.repeat(np.arange(8), 5), alpha=.05)
+
+
+def _gen_rs(n_rois=7):
+    return {'ps': {'alpha': .05}, 'var_names': ['before_F', 'after_B', 'ref'],
+            'full_stats': unpack_batch_stats(_gen_stats_arrays(n_rois=n_rois)),
+            'beh_stats': {'F': {'p_values': np.linspace(0, 1, n_rois), 'beta': np.arange(n_rois, dtype=float)}}}
+
+
+def test_round_trip_of_roi_dicts(tmp_path):
+    rs = _gen_rs()
+    results_to_store(rs=rs, folder=tmp_path / 'store')
+    loaded_rs = load_results_store(tmp_path / 'store')
+
+    assert loaded_rs['ps'] == rs['ps']
+    assert loaded_rs['var_names'] == rs['var_names']
+    for k in ['beta', 'acm', 'non_zero_p', 'n_grps', 'computed']:
+        np.testing.assert_array_equal(loaded_rs['fields']['full_stats.' + k],
+                                      np.stack([s[k] for s in rs['full_stats']]))
+
+    # c_ints are missing for the roi stats were not computed for, so they are stored as nan
+    c_ints = loaded_rs['fields']['full_stats.c_ints']
+    assert c_ints.shape == (7, 2, 3)
+    assert np.all(np.isnan(c_ints[2]))
+    for r_i in [0, 1, 3, 4, 5, 6]:
+        np.testing.assert_array_equal(c_ints[r_i], rs['full_stats'][r_i]['c_ints'])
+
+    for k in ['p_values', 'beta']:
+        np.testing.assert_array_equal(loaded_rs['beh_stats']['F'][k], rs['beh_stats']['F'][k])
+
+    np.testing.assert_array_equal(load_results_field(tmp_path / 'store', 'full_stats.beta', var='after_B'),
+                                  np.stack([s['beta'][1] for s in rs['full_stats']]))
+
+
+def test_round_trip_of_behavior_roi_dicts(tmp_path):
+    roi_stats = _gen_rs()['full_stats']
+    rs = {'full_stats': {'F': [(s, np.arange(3)) for s in roi_stats],
+                         'B': [(s, np.arange(2)) for s in roi_stats[::-1]]}}
+    results_to_store(rs=rs, folder=tmp_path / 'store')
+    loaded_rs = load_results_store(tmp_path / 'store')
+
+    np.testing.assert_array_equal(loaded_rs['fields']['full_stats.F.beta'], np.stack([s['beta'] for s in roi_stats]))
+    np.testing.assert_array_equal(loaded_rs['fields']['full_stats.B.beta'],
+                                  np.stack([s['beta'] for s in roi_stats[::-1]]))
+    np.testing.assert_array_equal(loaded_rs['full_stats_pull_inds']['B'], np.arange(2))
+
+
+def test_round_trip_of_lag_stats(tmp_path):
+    n_lags, n_rois = 4, 5
+    stats_arrays = _gen_stats_arrays(n_rois=n_lags*n_rois)
+    lag_stats = spontaneous._lag_stats_from_arrays(stats_arrays, n_lags=n_lags, n_rois=n_rois)
+    np.testing.assert_array_equal(lag_stats['beta'][3, 2], stats_arrays['beta'][2*n_rois + 3])
+
+    results_to_store(rs={'lag_stats': lag_stats, 'lags': np.arange(n_lags)}, folder=tmp_path / 'store')
+    loaded_rs = load_results_store(tmp_path / 'store')
+
+    np.testing.assert_array_equal(loaded_rs['lags'], np.arange(n_lags))
+    for k, vls in lag_stats.items():
+        assert loaded_rs['fields']['lag_stats.' + k].shape == vls.shape
+        np.testing.assert_array_equal(loaded_rs['fields']['lag_stats.' + k], vls)
+
+
+def test_float_dtype(tmp_path):
+    rs = _gen_rs()
+    results_to_store(rs=rs, folder=tmp_path / 'store', float_dtype=np.float32)
+    fields = load_results_store(tmp_path / 'store')['fields']
+
+    assert fields['full_stats.beta'].dtype == np.float32
+    assert fields['full_stats.computed'].dtype == np.bool_
+    np.testing.assert_allclose(fields['full_stats.beta'], np.stack([s['beta'] for s in rs['full_stats']]), rtol=1e-6)
+
+
+@pytest.mark.parametrize('results_format', ['pickle', 'columnar'])
+def test_save_and_load_results(tmp_path, results_format):
+    rs = _gen_rs()
+    path = save_results(rs=rs, save_path=tmp_path / 'rs.pkl', results_format=results_format)
+    assert path == results_path(tmp_path / 'rs.pkl', results_format)
+
+    loaded_rs = load_results(path)
+    if results_format == 'pickle':
+        loaded_beta = np.stack([s['beta'] for s in loaded_rs['full_stats']])
+    else:
+        loaded_beta = loaded_rs['fields']['full_stats.beta']
+    np.testing.assert_array_equal(loaded_beta, np.stack([s['beta'] for s in rs['full_stats']]))
+
+
+def test_stacked_fields_match_roi_dicts(tmp_path):
+    stats_arrays = _gen_stats_arrays()
+    rs = {'var_names': ['before_F', 'after_B', 'ref'],
+          'fields': {'full_stats.' + k: vls for k, vls in stats_arrays.items()}}
+    results_to_store(rs=rs, folder=tmp_path / 'fields')
+    results_to_store(rs={'var_names': rs['var_names'], 'full_stats': unpack_batch_stats(stats_arrays)},
+                     folder=tmp_path / 'roi_dicts')
+
+    fields = load_results_store(tmp_path / 'fields')
+    ref_fields = load_results_store(tmp_path / 'roi_dicts')
+    assert fields['var_names'] == ref_fields['var_names']
+    assert list(fields['fields'].keys()) == list(ref_fields['fields'].keys())
+    for name, vls in ref_fields['fields'].items():
+        np.testing.assert_array_equal(fields['fields'][name], vls)
@@ -0,0 +1,101 @@
+""" Tests for the spontaneous module. """
+
+import numpy as np
+import pytest
+
+from keller_zlatic_vnc.data_processing import calc_dff_prefix_sums
+from keller_zlatic_vnc.whole_brain import spontaneous
+
+
+def _assert_same_roi_stats(a, b):
+    assert set(a.keys()) == set(b.keys())
+    for k in a.keys():
+        assert type(a[k]) == type(b[k]) or (np.isscalar(a[k]) and np.isscalar(b[k]))
+        np.testing.assert_allclose(a[k], b[k], rtol=1e-7, atol=1e-10, equal_nan=True)
+
+
+@pytest.mark.parametrize('multi_subj', [True, False])
+@pytest.mark.parametrize('n_workers', [1, 2])
+def test_fit_all_rois_matches_per_roi_fits(multi_subj, n_workers):
+    rng = np.random.default_rng(0)
+    n_smps, n_vars, n_rois = 60, 3, 9
+    x = np.concatenate([rng.standard_normal([n_smps, n_vars - 1]), np.ones([n_smps, 1])], axis=1)
+    dff = rng.standard_normal([n_smps, n_rois])
+    dff[:, 4] = 2.0
+    g = np.repeat(np.arange(6), 10) if multi_subj else np.zeros(n_smps)
+
+    full_stats = spontaneous._fit_all_rois(x=x, dff=dff, g=g, alpha=.05, multi_subj=multi_subj, n_workers=n_workers,
+                                           block_size=4)
+
+    stats_f = spontaneous._init_fit_multi_subj_stats_f if multi_subj else spontaneous._init_fit_single_subj_stats_f
+    for r_i in range(n_rois):
+        _assert_same_roi_stats(full_stats[r_i], stats_f(x, dff[:, r_i], g, .05))
+
+
+@pytest.mark.parametrize('window_type, window_offset, window_length', [('whole_event', None, None),
+                                                                      ('start_locked', -3, 4),
+                                                                      ('start_locked', 2, 6)])
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')  # calc_mean_dff warns for empty windows
+def test_calc_mean_dff_batch_matches_calc_mean_dff(window_type, window_offset, window_length):
+    rng = np.random.default_rng(1)
+    dff = rng.standard_normal([50, 6])
+    starts = rng.integers(-5, 50, 40)
+    stops = starts + rng.integers(0, 10, 40)
+
+    mn_vls, starts_within, stops_within = spontaneous.calc_mean_dff_batch(
+        prefix_sums=calc_dff_prefix_sums(dff), starts=starts, stops=stops, window_type=window_type,
+        window_offset=window_offset, window_length=window_length)
+
+    for e_i in range(len(starts)):
+        ref_mn_vls, ref_starts_within, ref_stops_within = spontaneous.calc_mean_dff(
+            x=dff, start=starts[e_i], stop=stops[e_i], window_type=window_type, window_offset=window_offset,
+            window_length=window_length)
+        np.testing.assert_allclose(mn_vls[e_i], np.broadcast_to(ref_mn_vls, [6]), equal_nan=True)
+        assert starts_within[e_i] == ref_starts_within
+        assert stops_within[e_i] == ref_stops_within
+
+
+def test_extract_window_dff_matches_calc_mean_dff_batch():
+    rng = np.random.default_rng(2)
+    subj_event_dff = dict()
+    subj_dff = dict()
+    for s_i, event_index in enumerate([[3, 0, 7], [5, 1], [2, 4, 6, 8]]):
+        subj_dff[s_i] = rng.standard_normal([40, 5])
+        starts = rng.integers(0, 35, len(event_index))
+        subj_event_dff[s_i] = (calc_dff_prefix_sums(subj_dff[s_i]), np.asarray(event_index), starts,
+                               starts + rng.integers(1, 6, len(event_index)))
+    w_ps = {'window_type': 'start_locked', 'window_offset': -2, 'window_length': 5}
+
+    extracted_dff = spontaneous._extract_window_dff(subj_event_dff=subj_event_dff, w_ps=w_ps)
+
+    assert sorted(extracted_dff.keys()) == list(range(9))
+    for s_i, (_, event_index, starts, stops) in subj_event_dff.items():
+        for e_i, index in enumerate(event_index):
+            ref_mn_vls, ref_starts_within, ref_stops_within = spontaneous.calc_mean_dff(
+                x=subj_dff[s_i], start=starts[e_i], stop=stops[e_i], window_type='start_locked', window_offset=-2,
+                window_length=5)
+            np.testing.assert_allclose(extracted_dff[index][0], ref_mn_vls, equal_nan=True)
+            assert extracted_dff[index][1:] == (ref_starts_within, ref_stops_within)
+
+
+def test_columnar_mean_cmp_results_match_roi_dicts():
+    rng = np.random.default_rng(3)
+    n_smps, n_rois = 60, 7
+    x = np.concatenate([rng.standard_normal([n_smps, 3]), np.ones([n_smps, 1])], axis=1)
+    dff = rng.standard_normal([n_smps, n_rois])
+    dff[:, 2] = 1.0
+    stats_arrays = spontaneous._fit_all_rois_arrays(x=x, dff=dff, g=np.repeat(np.arange(6), 10), alpha=.05,
+                                                    multi_subj=True, n_workers=1)
+    basic_rs = {'var_names': ['beh_before_F', 'beh_before_B', 'beh_H', 'ref_Q_Q'], 'n_trans': None,
+                'n_subjs_per_trans': None}
+
+    rs = spontaneous._mean_cmp_results(ps=dict(), stats_arrays=stats_arrays, basic_rs=basic_rs, n_workers=1,
+                                       results_format='pickle')
+    columnar_rs = spontaneous._mean_cmp_results(ps=dict(), stats_arrays=stats_arrays, basic_rs=basic_rs,
+                                                n_workers=1, results_format='columnar')
+
+    assert 'full_stats' not in columnar_rs
+    assert list(columnar_rs['fields'].keys()) == ['full_stats.' + k for k in rs['full_stats'][0].keys()]
+    for k in rs['full_stats'][0].keys():
+        np.testing.assert_array_equal(columnar_rs['fields']['full_stats.' + k],
+                                      np.stack([s[k] for s in rs['full_stats']]))
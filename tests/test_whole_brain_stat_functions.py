@@ -0,0 +1,157 @@
+""" Tests for the whole_brain_stat_functions module. """
+
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from janelia_core.stats.regression import grouped_linear_regression_acm_stats
+from janelia_core.stats.regression import grouped_linear_regression_ols_estimator
+
+from keller_zlatic_vnc.data_processing import count_unique_subjs_per_transition
+from keller_zlatic_vnc.linear_modeling import one_hot_from_table
+from keller_zlatic_vnc.whole_brain.results_store import load_results_store
+from keller_zlatic_vnc.whole_brain.whole_brain_stat_functions import whole_brain_other_ref_testing
+from keller_zlatic_vnc.whole_brain.whole_brain_stat_functions import whole_brain_single_ref_testing
+
+
+def _gen_data_file(folder, n_subjs=6, n_events_per_subj=25, n_rois=12, seed=0):
+    rng = np.random.default_rng(seed)
+    n_events = n_subjs*n_events_per_subj
+    event_annots = pd.DataFrame({'Smp ID': np.repeat(['s' + str(s_i) for s_i in range(n_subjs)], n_events_per_subj),
+                                 'Beh Before': rng.choice(['F', 'B', 'Q'], n_events),
+                                 'Beh After': rng.choice(['F', 'B', 'H', 'Q'], n_events),
+                                 'Trans Time': rng.uniform(0, 2, n_events),
+                                 'Tgt Site': rng.choice(['A4', 'A9'], n_events)})
+    for col in ['dff_before', 'dff_after', 'dff_during']:
+        event_annots[col] = list(rng.standard_normal([n_events, n_rois]))
+
+    data_file = folder / 'data.pkl'
+    with open(data_file, 'wb') as f:
+        pickle.dump({'event_annots': event_annots}, f)
+    return data_file
+
+
+def _assert_same(a, b):
+    if isinstance(a, dict):
+        assert set(a.keys()) == set(b.keys())
+        for k in a.keys():
+            _assert_same(a[k], b[k])
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b)
+        for a_i, b_i in zip(a, b):
+            _assert_same(a_i, b_i)
+    else:
+        assert type(a) == type(b) or (np.isscalar(a) and np.isscalar(b))
+        np.testing.assert_allclose(a, b, rtol=1e-7, atol=1e-10, equal_nan=True)
+
+
+def _load_rs(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _ref_stats_f(x, y, g, alpha):
+    """ Computes stats for one roi as the serial engine always has. """
+    beta, acm, n_grps = grouped_linear_regression_ols_estimator(x=x, y=y, g=g)
+    stats = grouped_linear_regression_acm_stats(beta=beta, acm=acm, n_grps=n_grps, alpha=alpha)
+    stats['beta'] = beta
+    return stats
+
+
+def _ref_full_stats(data_file, rs, test_f, test_type):
+    """ Recomputes full_stats one roi at a time for the events that were used in a test. """
+    trans_table = rs['trans_table']
+    with open(data_file, 'rb') as f:
+        event_annots = pickle.load(f)['event_annots']
+    dff_col = 'dff_after' if test_type == 'state_dependence' else 'dff_before'
+    dff = np.stack(event_annots[dff_col].to_numpy()[trans_table.index])
+    g = pd.factorize(trans_table['subject_id'])[0].astype(float)
+
+    def _fit(x):
+        x = np.concatenate([x, np.ones([x.shape[0], 1])], axis=1)
+        return [_ref_stats_f(x, dff[:, r_i], g, .05) for r_i in range(dff.shape[1])]
+
+    if test_f == whole_brain_single_ref_testing:
+        before_behs = sorted(set(trans_table['beh_before']).difference('Q'))
+        after_behs = sorted(set(trans_table['beh_after']).difference('Q'))
+        return _fit(one_hot_from_table(trans_table, beh_before=before_behs, beh_after=after_behs)[0])
+
+    trans_subj_cnts = count_unique_subjs_per_transition(trans_table)
+    if test_type == 'state_dependence':
+        beh_sum = trans_subj_cnts.sum(axis=0)
+    else:
+        beh_sum = trans_subj_cnts.sum(axis=1)
+    control_behs_ref = list(set(beh_sum[beh_sum > 0].index).difference('Q'))
+    full_stats = dict()
+    for b in rs['full_stats'].keys():
+        if test_type == 'state_dependence':
+            x, x_vars = one_hot_from_table(trans_table, beh_before=[b], beh_after=control_behs_ref)
+            pull_ind = 0
+        else:
+            x, x_vars = one_hot_from_table(trans_table, beh_before=control_behs_ref, beh_after=[b])
+            pull_ind = len(x_vars) - 1
+        full_stats[b] = [(roi_stats, pull_ind) for roi_stats in _fit(x)]
+    return full_stats
+
+
+@pytest.mark.parametrize('test_f', [whole_brain_other_ref_testing, whole_brain_single_ref_testing])
+@pytest.mark.parametrize('test_type', ['state_dependence', 'prediction_dependence'])
+def test_default_serial_output_matches_baseline(tmp_path, test_f, test_type):
+    data_file = _gen_data_file(tmp_path)
+    rs = _load_rs(test_f(data_file=data_file, test_type=test_type, cut_off_time=1.0, manip_type='both',
+                         save_folder=tmp_path, save_str='serial'))
+
+    assert set(rs.keys()) == {'beh_stats', 'full_stats', 'trans_table', 'ps'}
+    assert set(rs['ps'].keys()) == {'data_file', 'test_type', 'cut_off_time', 'manip_type', 'save_folder',
+                                    'save_str', 'min_n_subjects_per_beh', 'beh_ref', 'alpha'}
+
+    full_stats = rs['full_stats']
+    roi_stats = full_stats if isinstance(full_stats, list) else [s for b_s in full_stats.values() for s, _ in b_s]
+    for s in roi_stats:
+        assert list(s.keys()) == ['non_zero_p', 'c_ints', 'beta']
+
+    ref_full_stats = _ref_full_stats(data_file, rs, test_f, test_type)
+    _assert_same(full_stats, ref_full_stats)
+    if isinstance(full_stats, dict):
+        for b, b_stats in rs['beh_stats'].items():
+            pull_ind = ref_full_stats[b][0][1]
+            np.testing.assert_array_equal(b_stats['beta'], [s['beta'][pull_ind] for s, _ in ref_full_stats[b]])
+            np.testing.assert_array_equal(b_stats['p_values'],
+                                          [s['non_zero_p'][pull_ind] for s, _ in ref_full_stats[b]])
+
+
+@pytest.mark.parametrize('test_f', [whole_brain_other_ref_testing, whole_brain_single_ref_testing])
+@pytest.mark.parametrize('test_type', ['state_dependence', 'prediction_dependence'])
+def test_serial_and_batched_engines_match(tmp_path, test_f, test_type):
+    data_file = _gen_data_file(tmp_path)
+
+    rs = dict()
+    for engine, n_jobs in [('serial', 1), ('batched', 1), ('batched', 2)]:
+        save_str = engine + '_' + str(n_jobs)
+        save_path = test_f(data_file=data_file, test_type=test_type, cut_off_time=1.0, manip_type='both',
+                           save_folder=tmp_path, save_str=save_str, engine=engine, n_jobs=n_jobs, block_size=5)
+        rs[save_str] = _load_rs(save_path)
+
+    for save_str in ['batched_1', 'batched_2']:
+        _assert_same(rs['serial_1']['beh_stats'], rs[save_str]['beh_stats'])
+        _assert_same(rs['serial_1']['full_stats'], rs[save_str]['full_stats'])
+
+
+@pytest.mark.parametrize('test_f', [whole_brain_other_ref_testing, whole_brain_single_ref_testing])
+def test_batched_columnar_results_match_serial(tmp_path, test_f):
+    data_file = _gen_data_file(tmp_path)
+
+    rs = dict()
+    for engine in ['serial', 'batched']:
+        save_path = test_f(data_file=data_file, test_type='prediction_dependence', cut_off_time=1.0,
+                           manip_type='both', save_folder=tmp_path, save_str=engine, engine=engine, n_jobs=1,
+                           block_size=5, results_format='columnar')
+        rs[engine] = load_results_store(save_path)
+
+    assert rs['batched']['fields'].keys() == rs['serial']['fields'].keys()
+    for name, vls in rs['serial']['fields'].items():
+        np.testing.assert_allclose(rs['batched']['fields'][name], vls, rtol=1e-7, atol=1e-10, equal_nan=True)
+    assert rs['batched'].get('full_stats_pull_inds') == rs['serial'].get('full_stats_pull_inds')
+    assert rs['batched'].keys() == rs['serial'].keys()
@@ -38,6 +38,15 @@ manip_types = ['both'] #['A4', 'A9', 'both']
 # Parameters for tests
 n_perms = 10000
 
+# The engine to run permutation tests with ('serial' or 'batched') and the seed for generating permutations with the
+# batched engine
+engine = 'batched'
+seed = 1
+
+# If not None, permutations for each roi are stopped once its p-value could not fall at or below this level (batched
+# engine only)
+seq_alpha = None
+
 # Location of overlay files
 # Specify where we find overlay files
 overlay_files = [r'\\dm11\bishoplab\projects\keller_vnc\data\overlays\horz_mean.png',
@@ -85,7 +94,10 @@ for data_file, roi_group in zip(data_files, roi_groups):
                            'manip_type': manip_type,
                            'save_folder': cur_save_folder,
                            'save_str': desc_str,
-                           'n_perms': n_perms},
+                           'n_perms': n_perms,
+                           'engine': engine,
+                           'seed': seed,
+                           'seq_alpha': seq_alpha},
                             {'roi_group': roi_group,
                               'save_str': desc_str + '_' + data_file_stem}))
 